@@ -14,12 +14,62 @@ querying, adding, deleting and updating attributes.
 
 import bottle
 from bottle import request
+import clusto
+from clusto import schema
+from clustoapi import timing
 from clustoapi import util
+import json
+import re
+import sqlalchemy
 
 
 app = bottle.Bottle()
 app.config['source_module'] = __name__
 
+# Same rule Driver._check_attr_name enforces for keys and subkeys
+ATTR_NAME = re.compile(r'^[A-Za-z_]+[0-9A-Za-z_-]*$')
+ATTR_FIELDS = ('key', 'value', 'subkey', 'number')
+VALUE_COLUMNS = ('int_value', 'string_value', 'datetime_value', 'relation_id')
+
+
+def _check_attrs(attrs):
+    """
+Validates and typecasts a list of attributes in place, so none is written
+unless all of them can be. Returns an error response, ``None`` if they are
+all fine.
+"""
+
+    if not isinstance(attrs, list):
+        return util.dumps('Provide an attribute or a list of attributes', 400)
+    for attr in attrs:
+        if not isinstance(attr, dict):
+            return util.dumps('Every attribute must be an object, not %s' % (json.dumps(attr),), 400)
+        for k in ('key', 'value'):
+            if k not in attr.keys():
+                bottle.abort(412, 'Provide at least "key" and "value"')
+
+        for k in ('key', 'subkey'):
+            if attr.get(k) is not None and not ATTR_NAME.match(unicode(attr[k])):
+                return util.dumps(
+                    'Attribute name %s is invalid. Attribute names may not contain periods or comas.' % (attr[k],), 400
+                )
+
+        if attr.get('number') is not None:
+            try:
+                attr['number'] = int(attr['number'])
+            except (TypeError, ValueError) as ve:
+                return util.dumps('%s' % (ve,), 400)
+
+        mask = attr.pop('mask', '%Y-%m-%dT%H:%M:%S.%f')
+        if 'datatype' in attr:
+            datatype = attr.pop('datatype')
+            attr['value'] = util.typecast(attr['value'], datatype, mask=mask)
+
+        unknown = sorted(set(attr) - set(ATTR_FIELDS))
+        if unknown:
+            return util.dumps('Unknown attribute fields: %s' % (', '.join(unknown),), 400)
+    return None
+
 
 def _write_attrs(method, name, **kwargs):
     """
@@ -59,25 +109,15 @@ Returns a response for the methods calling it.
     # Adds support for bulk attr posting.
     attrs = [kwargs] if isinstance(kwargs, dict) else kwargs
     # Check for malformed data or missing pieces before adding any attrs.
-    for attr in attrs:
-        for k in ('key', 'value'):
-            if k not in attr.keys():
-                bottle.abort(412, 'Provide at least "key" and "value"')
-
-        if 'number' in attr:
-            try:
-                attr['number'] = int(attr['number'])
-            except ValueError as ve:
-                return util.dumps('%s' % (ve,), 400)
-
-        if 'datatype' in attr:
-            datatype = attr.pop('datatype')
-            mask = attr.pop('mask', '%Y-%m-%dT%H:%M:%S.%f')
-            attr['value'] = util.typecast(attr['value'], datatype, mask=mask)
+    error = _check_attrs(attrs)
+    if error:
+        return error
 
-    for attr in attrs:
-        getattr(obj, method + '_attr')(**attr)
+    written = [getattr(obj, method + '_attr')(**attr) for attr in attrs]
 
+    minimal, headers = util.return_minimal()
+    if minimal:
+        return util.dumps([util.unclusto(_) for _ in written], code, headers=headers)
     return util.dumps([util.unclusto(_) for _ in obj.attrs()], code)
 
 
@@ -319,6 +359,25 @@ with the ``datetime`` python object as the datatype.
 Will add two attributes in bulk by stating
 that the content type is ``application/json``.
 
+.. code:: bash
+
+    $ ${post} -H 'Clusto-Return: minimal' -d 'key=group' -d 'subkey=minimal' -d 'value=web' ${server_url}/attribute/addattrserver
+    [
+        {
+            "datatype": "string",
+            "key": "group",
+            "number": null,
+            "subkey": "minimal",
+            "value": "web"
+        }
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+With ``Clusto-Return: minimal`` (or ``Prefer: return=minimal``) only the
+attributes just written are returned, rather than every attribute of the
+object.
+
 """
 
     return _write_attrs('add', name, **kwargs)
@@ -546,6 +605,21 @@ add an attribute (the only attribute so far), then it will delete it.
 
 This example should add two attributes with the same key, but different
 subkey, then it will delete only the second value.
+
+.. code:: bash
+
+    $ ${delete_i} -H 'Prefer: return=minimal' ${server_url}/attribute/deleteserver2/group | grep -e '^Preference-Applied' -e '^ '
+    Preference-Applied: return=minimal
+        {
+            "datatype": "string",
+            "key": "group",
+            "number": null,
+            "subkey": null,
+            "value": "engineering"
+        }
+
+With ``Prefer: return=minimal`` (or ``Clusto-Return: minimal``) it returns
+the attributes deleted instead of the ones left.
 """
 
     kwargs = dict(request.params.items())
@@ -558,5 +632,692 @@ subkey, then it will delete only the second value.
         qkwargs['subkey'] = subkey
     if number:
         qkwargs['number'] = number
+    minimal, headers = util.return_minimal()
+    if minimal:
+        # Only what is about to be deleted, serialized while it still exists
+        deleted = [util.unclusto(_) for _ in obj.attr_query(**qkwargs)]
+        obj.del_attrs(**qkwargs)
+        return util.dumps(deleted, headers=headers)
     obj.del_attrs(**qkwargs)
     return util.dumps([util.unclusto(_) for _ in obj.attrs()])
+
+
+def _attr_columns(attr):
+    """
+Returns the ``entity_attrs`` columns a checked attribute is stored in, set
+the same way ``Attribute`` sets them.
+"""
+
+    value = attr['value']
+    datatype = schema.Attribute.get_type(value)
+    subkey = attr.get('subkey')
+    columns = {
+        'key': unicode(attr['key']),
+        'subkey': unicode(subkey) if subkey is not None else None,
+        'number': attr.get('number'),
+        'datatype': datatype,
+    }
+    columns.update((_, None) for _ in VALUE_COLUMNS)
+    if datatype == 'int':
+        columns['int_value'] = int(value)
+    elif datatype == 'datetime':
+        columns['datetime_value'] = value
+    elif datatype == 'relation':
+        columns['relation_id'] = getattr(value, 'entity', value).entity_id
+    elif datatype == 'json':
+        columns['string_value'] = unicode(json.dumps(value))
+    elif value is not None:
+        columns['string_value'] = unicode(value)
+    return columns
+
+
+def _keytuple(columns):
+    return (columns['key'], columns['subkey'], columns['number'])
+
+
+def _same_value(row, columns):
+    "Whether an attribute, or its row, holds the value of the given columns"
+
+    return row.datatype == columns['datatype'] and all(getattr(row, _) == columns[_] for _ in VALUE_COLUMNS)
+
+
+def _current_attrs(entity_ids, keys=None):
+    """
+Returns the attribute rows of the given entities, only those with one of
+``keys`` if given, as ``{entity_id: [row]}``, in as few queries as the
+database allows.
+"""
+
+    table = schema.ATTR_TABLE
+    ids = sorted(entity_ids)
+    result = {}
+    with timing.phase('lookup'):
+        for start in range(0, len(ids), util.NAMES_PER_QUERY):
+            where = [
+                table.c.entity_id.in_(ids[start:start + util.NAMES_PER_QUERY]),
+                table.c.deleted_at_version == None,  # noqa
+            ]
+            if keys is not None:
+                where.append(table.c.key.in_(sorted(keys)))
+            query = sqlalchemy.select([
+                table.c.attr_id, table.c.entity_id, table.c.key, table.c.subkey, table.c.number, table.c.datatype,
+            ] + [table.c[_] for _ in VALUE_COLUMNS]).where(sqlalchemy.and_(*where)).order_by(table.c.attr_id)
+            for row in clusto.SESSION.execute(query):
+                result.setdefault(row['entity_id'], []).append(row)
+    return result
+
+
+def _write_rows(entities, add, delete, update=()):
+    """
+Deletes the attribute rows (or attributes) in ``delete`` and inserts the
+``add`` columns, like ``Attribute.delete`` and ``Attribute`` do, but in
+batches. ``update`` pairs rows with the columns to store in them instead,
+rows are replaced rather than updated when versioning, as ``set_attr``
+does. ``entities`` maps the ids of the entities they belong to to their
+``Entity``. Returns what was written, for ``_expire``.
+"""
+
+    table = schema.ATTR_TABLE
+    if update and clusto.SESSION.clusto_versioning_enabled:
+        delete = list(delete) + [row for row, _ in update]
+        add = list(add) + [dict(columns, entity_id=row.entity_id) for row, columns in update]
+        update = ()
+    version = clusto.SESSION.execute(schema.working_version()).scalar()
+    for row in delete:
+        schema.audit_log.info(
+            'delete attribute entity=%s key=%s subkey=%s number=%s datatype=%s',
+            entities[row.entity_id].name, row.key, row.subkey, row.number, row.datatype,
+        )
+    ids = [_.attr_id for _ in delete]
+    for start in range(0, len(ids), util.NAMES_PER_QUERY):
+        where = table.c.attr_id.in_(ids[start:start + util.NAMES_PER_QUERY])
+        if clusto.SESSION.clusto_versioning_enabled:
+            clusto.SESSION.execute(table.update().where(where).values(deleted_at_version=version))
+        else:
+            clusto.SESSION.execute(table.delete().where(where))
+
+    for columns in add:
+        columns['version'] = version
+        schema.audit_log.info(
+            'create attribute entity=%s key=%s subkey=%s number=%s datatype=%s',
+            entities[columns['entity_id']].name, columns['key'], columns['subkey'], columns['number'],
+            columns['datatype'],
+        )
+    for start in range(0, len(add), util.NAMES_PER_QUERY):
+        clusto.SESSION.execute(table.insert(), add[start:start + util.NAMES_PER_QUERY])
+
+    values = []
+    for row, columns in update:
+        schema.audit_log.info(
+            'set attribute entity=%s key=%s subkey=%s number=%s datatype=%s',
+            entities[row.entity_id].name, row.key, row.subkey, row.number, columns['datatype'],
+        )
+        # Bound parameters can't be named like the columns they set
+        value = dict(('_%s' % (_,), columns[_]) for _ in ('datatype',) + VALUE_COLUMNS)
+        value['_attr_id'] = row.attr_id
+        values.append(value)
+    if values:
+        statement = table.update().where(table.c.attr_id == sqlalchemy.bindparam('_attr_id')).values(
+            dict((_, sqlalchemy.bindparam('_%s' % (_,))) for _ in ('datatype',) + VALUE_COLUMNS)
+        )
+        for start in range(0, len(values), util.NAMES_PER_QUERY):
+            clusto.SESSION.execute(statement, values[start:start + util.NAMES_PER_QUERY])
+    # The statements bypass the ORM, tell clusto this transaction wrote something
+    clusto.SESSION.flushed.update(entities.values())
+    written = set((_['entity_id'], _['key'], _['subkey']) for _ in add)
+    written.update((_.entity_id, _.key, _.subkey) for _ in list(delete) + [row for row, _ in update])
+    return written
+
+
+def _expire(entities, written):
+    """
+Expires the memcached attributes ``_write_rows`` wrote once they are
+committed, like ``del_attrs`` does. ``written`` holds ``(entity id, key,
+subkey)`` tuples. The memcache keys are worked out from them rather than
+with ``Driver.expire``, which only finds the attributes still there and
+without a subkey.
+"""
+
+    if not clusto.SESSION.memcache:
+        return
+    keys = set()
+    for entity_id, key, subkey in written:
+        name = entities[entity_id].name
+        keys.add(str('%s.%s' % (name, key)))
+        if subkey:
+            keys.add(str('%s.%s.%s' % (name, key, subkey)))
+    for key in sorted(keys):
+        clusto.SESSION.memcache.delete(key)
+
+
+def _bulk_targets():
+    """
+Resolves the targets of a bulk write, either every member of the ``pool``
+parameter or the entities the JSON body maps to their attributes. Returns
+``(targets, error)``, ``targets`` being a list of ``(Entity, attributes)``.
+"""
+
+    try:
+        body = request.json
+    except ValueError as ve:
+        return None, util.dumps('%s' % (ve,), 400)
+
+    pool = request.query.get('pool')
+    if pool is not None:
+        obj, status, msg = util.get(pool)
+        if not obj:
+            return None, util.dumps(msg, status)
+        attrs = [body] if isinstance(body, dict) else body
+        error = _check_attrs(attrs)
+        if error:
+            return None, error
+        table = schema.ATTR_TABLE
+        members = sqlalchemy.select([table.c.relation_id]).where(sqlalchemy.and_(
+            table.c.entity_id == obj.entity.entity_id,
+            table.c.key == u'_contains',
+            table.c.deleted_at_version == None,  # noqa
+        ))
+        with timing.phase('lookup'):
+            entities = schema.Entity.query().filter(schema.Entity.entity_id.in_(members)).order_by(schema.Entity.name)
+            return [(_, attrs) for _ in entities], None
+
+    if not isinstance(body, dict) or not body:
+        return None, util.dumps(
+            'Provide a JSON object mapping entity names to their attributes, or a "pool" and a list of attributes', 400
+        )
+    found = util.get_by_names(body.keys())
+    missing = sorted(set(body) - set(found))
+    if missing:
+        return None, util.dumps('Objects %s do not exist' % (','.join(missing),), 404)
+    targets = []
+    for name, attrs in sorted(body.items()):
+        attrs = [attrs] if isinstance(attrs, dict) else attrs
+        error = _check_attrs(attrs)
+        if error:
+            return None, error
+        targets.append((found[name].entity, attrs))
+    return targets, None
+
+
+def _bulk_write_attrs(method):
+    """
+Helper for the bulk versions of POST and PUT: works out which rows to add and
+which to replace for every target and writes them all in one transaction.
+"""
+
+    targets, error = _bulk_targets()
+    if error:
+        return error
+
+    try:
+        targets = [(entity, [_attr_columns(_) for _ in attrs]) for entity, attrs in targets]
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+
+    entities = dict((entity.entity_id, entity) for entity, _ in targets)
+    current = {}
+    if method == 'set':
+        keys = set(columns['key'] for _, attrs in targets for columns in attrs)
+        current = _current_attrs(entities.keys(), keys)
+
+    add, delete = [], []
+    changed, unchanged = [], []
+    for entity, attrs in targets:
+        rows = []
+        if method == 'add':
+            rows = attrs
+        else:
+            existing = {}
+            for row in current.get(entity.entity_id, []):
+                existing.setdefault(_keytuple(row), []).append(row)
+            # Like calling set_attr for every one of them, the last one wins
+            wanted = dict((_keytuple(_), _) for _ in attrs)
+            for keytuple, columns in sorted(wanted.items()):
+                matches = existing.get(keytuple, [])
+                if len(matches) > 1:
+                    return util.dumps(
+                        'Cannot set %s on %s, it matches more than one attribute' % (
+                            ':'.join(unicode(_) for _ in keytuple if _ is not None), entity.name,
+                        ), 409
+                    )
+                if matches and _same_value(matches[0], columns):
+                    continue
+                delete.extend(matches)
+                rows.append(columns)
+        add.extend(dict(_, entity_id=entity.entity_id) for _ in rows)
+        (changed if rows else unchanged).append(u'/%s/%s' % (entity.driver, entity.name))
+
+    if add or delete:
+        try:
+            clusto.begin_transaction()
+            written = _write_rows(entities, add, delete)
+            clusto.commit()
+        except Exception:
+            clusto.rollback_transaction()
+            raise
+        _expire(entities, written)
+
+    return util.dumps({
+        'action': method,
+        'added': len(add),
+        'replaced': len(delete),
+        'changed': changed,
+        'unchanged': unchanged,
+    }, 201 if method == 'add' else 200)
+
+
+@app.post('/')
+def add_attrs():
+    """
+Adds attributes to many objects at once, in a single transaction. The body
+is either a JSON object mapping object names to the attribute (or list of
+attributes) to add to each, or the list of attributes to add to every member
+of the pool given as the ``pool`` parameter. Attributes take the same fields
+as in ``add_attr``, all of them are checked before anything is written.
+
+Returns how many attributes were ``added`` and which objects ``changed``.
+
+Examples:
+
+.. code:: bash
+
+    $ ${post} -d 'name=bulkattrserver1' -d 'name=bulkattrserver2' ${server_url}/entity/basicserver
+    [
+        "/basicserver/bulkattrserver1",
+        "/basicserver/bulkattrserver2"
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'name=bulkattrpool' ${server_url}/entity/pool
+    [
+        "/pool/bulkattrpool"
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'device=bulkattrserver1' -d 'device=bulkattrserver2' -d 'action=insert' ${server_url}/entity/pool/bulkattrpool
+    {
+        "action": "insert",
+        "changed": [
+            "/basicserver/bulkattrserver1",
+            "/basicserver/bulkattrserver2"
+        ],
+        "count": 2,
+        "driver": "pool",
+        "name": "bulkattrpool",
+        "unchanged": []
+    }
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${post} -H 'Content-Type: application/json' -d '${sample_bulk_attrs}' ${server_url}/attribute/
+    {
+        "action": "add",
+        "added": 2,
+        "changed": [
+            "/basicserver/bulkattrserver1",
+            "/basicserver/bulkattrserver2"
+        ],
+        "replaced": 0,
+        "unchanged": []
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -H 'Content-Type: application/json' -d '[{"key": "port", "value": "80", "datatype": "int"}]' '${server_url}/attribute/?pool=bulkattrpool'
+    {
+        "action": "add",
+        "added": 2,
+        "changed": [
+            "/basicserver/bulkattrserver1",
+            "/basicserver/bulkattrserver2"
+        ],
+        "replaced": 0,
+        "unchanged": []
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${get} ${server_url}/attribute/bulkattrserver2
+    [
+        {
+            "datatype": "int",
+            "key": "port",
+            "number": null,
+            "subkey": null,
+            "value": 80
+        },
+        {
+            "datatype": "string",
+            "key": "rack",
+            "number": null,
+            "subkey": null,
+            "value": "r2"
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
+Nothing is written if any object doesn't exist or any attribute is wrong:
+
+.. code:: bash
+
+    $ ${post} -H 'Content-Type: application/json' -d '${sample_bulk_attrs_missing}' ${server_url}/attribute/
+    "Objects nonserver do not exist"
+    HTTP: 404
+    Content-type: application/json
+
+    $ ${post} -H 'Content-Type: application/json' -d '${sample_bulk_attrs_invalid}' ${server_url}/attribute/
+    "invalid literal for int() with base 10: 'one'"
+    HTTP: 400
+    Content-type: application/json
+
+"""
+
+    return _bulk_write_attrs('add')
+
+
+@app.put('/')
+def set_attrs():
+    """
+Sets attributes of many objects at once, in a single transaction. Takes the
+same body and ``pool`` parameter as ``add_attrs``, and like ``set_attr``
+replaces the attribute with the same key, subkey and number, if there is
+one. Attributes that already have the wanted value are left alone, so only
+the objects that actually ``changed`` are written to.
+
+Example:
+
+.. code:: bash
+
+    $ ${put} -H 'Content-Type: application/json' -d '[{"key": "rack", "value": "r2"}]' '${server_url}/attribute/?pool=bulkattrpool'
+    {
+        "action": "set",
+        "added": 1,
+        "changed": [
+            "/basicserver/bulkattrserver1"
+        ],
+        "replaced": 1,
+        "unchanged": [
+            "/basicserver/bulkattrserver2"
+        ]
+    }
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${get} ${server_url}/attribute/bulkattrserver1/rack
+    [
+        {
+            "datatype": "string",
+            "key": "rack",
+            "number": null,
+            "subkey": null,
+            "value": "r2"
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
+A ``null`` value is stored without any value, like clusto stores ``None``
+
+.. code:: bash
+
+    $ ${put} -H 'Content-Type: application/json' -d '{"bulkattrserver1": [{"key": "rack", "value": null}]}' ${server_url}/attribute/
+    {
+        "action": "set",
+        "added": 1,
+        "changed": [
+            "/basicserver/bulkattrserver1"
+        ],
+        "replaced": 1,
+        "unchanged": []
+    }
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${get} ${server_url}/attribute/bulkattrserver1/rack
+    [
+        {
+            "datatype": "string",
+            "key": "rack",
+            "number": null,
+            "subkey": null,
+            "value": null
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
+"""
+
+    return _bulk_write_attrs('set')
+
+
+def _attr_view(attr, columns):
+    "What ``util.unclusto`` would return for a checked attribute once written"
+
+    return {
+        'key': columns['key'],
+        'value': util.unclusto(attr['value']),
+        'subkey': columns['subkey'],
+        'number': columns['number'],
+        'datatype': columns['datatype'],
+    }
+
+
+@app.put('/<name>')
+def sync_attrs(name):
+    """
+Makes the attributes of this object be exactly the ones in the JSON body,
+a list taking the same fields as ``add_attr``. It works out the fewest
+changes that get there and writes only those, in one transaction:
+attributes already there are left alone, attributes with the same key,
+subkey and number but another value are ``updated``, and the rest are
+``added`` or ``deleted``. Returns those changes, all of them empty when the
+object was already in sync, in which case nothing is written.
+
+ *  Optional ``key`` parameters limit the sync to attributes with those
+    keys, everything else is left as it is
+ *  Hidden attributes (whose key starts with ``_``) are only synced when
+    their key is given
+ *  Optional ``driver`` parameter, like in ``attrs``
+
+Examples:
+
+.. code:: bash
+
+    $ ${post} -d 'name=syncattrserver' ${server_url}/entity/basicserver
+    [
+        "/basicserver/syncattrserver"
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'key=owner' -d 'value=joe' ${server_url}/attribute/syncattrserver
+    [
+        {
+            "datatype": "string",
+            "key": "owner",
+            "number": null,
+            "subkey": null,
+            "value": "joe"
+        }
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -H 'Content-Type: application/json' -d '${sample_json_attrs}' -o /dev/null ${server_url}/attribute/syncattrserver
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${put} -H 'Content-Type: application/json' -d '${sample_sync_attrs}' ${server_url}/attribute/syncattrserver
+    {
+        "added": [
+            {
+                "datatype": "string",
+                "key": "rack",
+                "number": null,
+                "subkey": null,
+                "value": "r1"
+            }
+        ],
+        "deleted": [
+            {
+                "datatype": "string",
+                "key": "owner",
+                "number": null,
+                "subkey": null,
+                "value": "joe"
+            }
+        ],
+        "updated": [
+            {
+                "datatype": "string",
+                "key": "group",
+                "number": null,
+                "subkey": "admin",
+                "value": "nginx"
+            }
+        ]
+    }
+    HTTP: 200
+    Content-type: application/json
+
+Syncing again changes nothing:
+
+.. code:: bash
+
+    $ ${put} -H 'Content-Type: application/json' -d '${sample_sync_attrs}' ${server_url}/attribute/syncattrserver
+    {
+        "added": [],
+        "deleted": [],
+        "updated": []
+    }
+    HTTP: 200
+    Content-type: application/json
+
+Only the ``rack`` attributes are synced here, so the ``group`` ones stay:
+
+.. code:: bash
+
+    $ ${put} -H 'Content-Type: application/json' -d '[]' '${server_url}/attribute/syncattrserver?key=rack'
+    {
+        "added": [],
+        "deleted": [
+            {
+                "datatype": "string",
+                "key": "rack",
+                "number": null,
+                "subkey": null,
+                "value": "r1"
+            }
+        ],
+        "updated": []
+    }
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${get} ${server_url}/attribute/syncattrserver
+    [
+        {
+            "datatype": "string",
+            "key": "group",
+            "number": null,
+            "subkey": "admin",
+            "value": "nginx"
+        },
+        {
+            "datatype": "string",
+            "key": "group",
+            "number": null,
+            "subkey": "member",
+            "value": "webapp"
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${put} -H 'Content-Type: application/json' -d '[{"key": "owner", "value": "joe"}]' '${server_url}/attribute/syncattrserver?key=rack'
+    "Attribute owner is not one of the keys being synced: rack"
+    HTTP: 400
+    Content-type: application/json
+
+"""
+
+    obj, status, msg = util.get(name, request.query.get('driver'))
+    if not obj:
+        return util.dumps(msg, status)
+    try:
+        body = request.json
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+
+    attrs = [body] if isinstance(body, dict) else body
+    error = _check_attrs(attrs)
+    if error:
+        return error
+    keys = request.query.getall('key')
+    for attr in attrs:
+        if keys and attr['key'] not in keys:
+            return util.dumps(
+                'Attribute %s is not one of the keys being synced: %s' % (attr['key'], ', '.join(keys)), 400
+            )
+        if not keys and unicode(attr['key']).startswith('_'):
+            return util.dumps('Hidden attributes like %s can only be synced by their key' % (attr['key'],), 400)
+    try:
+        wanted = [(attr, _attr_columns(attr)) for attr in attrs]
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+
+    with timing.phase('lookup'):
+        current = [_ for _ in obj.attrs(ignore_hidden=not keys) if not keys or _.key in keys]
+    unmatched = {}
+    for attr in current:
+        unmatched.setdefault((attr.key, attr.subkey, attr.number), []).append(attr)
+
+    # Attributes already there are kept, the others update one with the
+    # same key, subkey and number if there's any left, or are added
+    leftover = []
+    for attr, columns in wanted:
+        candidates = unmatched.get(_keytuple(columns), [])
+        same = [_ for _ in candidates if _same_value(_, columns)]
+        if same:
+            candidates.remove(same[0])
+        else:
+            leftover.append((attr, columns))
+    add, update = [], []
+    for attr, columns in leftover:
+        candidates = unmatched.get(_keytuple(columns))
+        if candidates:
+            update.append((candidates.pop(0), attr, columns))
+        else:
+            add.append((attr, columns))
+    remaining = set(id(_) for attrs in unmatched.values() for _ in attrs)
+    delete = [_ for _ in current if id(_) in remaining]
+
+    result = {
+        'added': [_attr_view(attr, columns) for attr, columns in add],
+        'updated': [_attr_view(attr, columns) for _, attr, columns in update],
+        'deleted': [util.unclusto(_) for _ in delete],
+    }
+    if add or update or delete:
+        entity = obj.entity
+        try:
+            clusto.begin_transaction()
+            written = _write_rows(
+                {entity.entity_id: entity},
+                [dict(columns, entity_id=entity.entity_id) for _, columns in add],
+                delete,
+                [(row, columns) for row, _, columns in update],
+            )
+            # Loaded attributes would keep their old values until the commit
+            for row, _, _ in update:
+                clusto.SESSION.expire(row)
+            clusto.commit()
+        except Exception:
+            clusto.rollback_transaction()
+            raise
+        _expire({entity.entity_id: entity}, written)
+
+    return util.dumps(result)
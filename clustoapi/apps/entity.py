@@ -16,7 +16,14 @@ manipulation.
 import bottle
 from bottle import request
 import clusto
+from clusto import schema
+from clusto.drivers.base import Driver
+from clusto.drivers.categories.pool import ExclusivePool, Pool
+from clusto.exceptions import PoolException
+from clustoapi import timing
 from clustoapi import util
+import sqlalchemy
+import types
 
 
 app = bottle.Bottle(autojson=False)
@@ -85,7 +92,8 @@ The following example should fail because there is no driver ``nondriver``:
             kwargs['clusto_drivers'] = [clusto.driverlist[driver]]
         else:
             return util.dumps('The requested driver "%s" does not exist' % (driver,), 412)
-    ents = clusto.get_entities(**kwargs)
+    with timing.phase('lookup'):
+        ents = clusto.get_entities(**kwargs)
     if current:
         ents, total = util.page(ents, current=current, per=per)
         headers['Clusto-Pages'] = total
@@ -157,6 +165,29 @@ a ``pool`` driver. As all objects are validated prior to creation, if any of
 them already exists the return code will be 202 (Accepted) and you will get
 an extra header ``Warnings`` with the message.
 
+All the names are looked up at once and the missing ones are created in a
+single transaction, so either all of them are created or none is. With the
+``Clusto-Return: detail`` header you get what happened to every name
+instead:
+
+.. code:: bash
+
+    $ ${post} -H 'Clusto-Return: detail' -d 'name=createpool1' -d 'name=createpool3' ${server_url}/entity/pool
+    [
+        {
+            "entity": "/pool/createpool1",
+            "name": "createpool1",
+            "status": "exists"
+        },
+        {
+            "entity": "/pool/createpool3",
+            "name": "createpool3",
+            "status": "created"
+        }
+    ]
+    HTTP: 202
+    Content-type: application/json
+
 """
 
     if driver not in clusto.driverlist:
@@ -165,16 +196,26 @@ an extra header ``Warnings`` with the message.
     names = request.params.getall('name')
     request.params.pop('name')
 
-    found = []
-    for name in names:
-        try:
-            found.append(util.unclusto(clusto.get_by_name(name)))
-        except LookupError:
-            pass
+    existing = dict((k, util.unclusto(v)) for k, v in util.get_by_names(names).items())
+    found = [existing[unicode(_)] for _ in names if unicode(_) in existing]
 
+    missing = sorted(set(unicode(_) for _ in names) - set(existing))
+    try:
+        clusto.begin_transaction()
+        created = _create(cls, missing)
+        clusto.commit()
+    except Exception:
+        clusto.rollback_transaction()
+        raise
+
+    detail = request.headers.get('Clusto-Return', '').lower() == 'detail'
     result = []
     for name in names:
-        result.append(util.unclusto(clusto.get_or_create(name, cls)))
+        key = unicode(name)
+        obj = existing.get(key) or created[key]
+        if detail:
+            obj = {'name': name, 'entity': obj, 'status': 'exists' if key in existing else 'created'}
+        result.append(obj)
 
     headers = {}
     if found:
@@ -186,6 +227,30 @@ an extra header ``Warnings`` with the message.
     return util.dumps(result, code, headers=headers)
 
 
+def _create(cls, names):
+    """
+Creates objects of the given driver, like ``cls(name)`` does for every name,
+but inserting them in batches and without looking the names up again, the
+caller already knows they don't exist. Returns ``{name: path}``.
+"""
+
+    version = clusto.SESSION.execute(schema.working_version()).scalar()
+    for start in range(0, len(names), util.NAMES_PER_QUERY):
+        clusto.SESSION.execute(schema.ENTITY_TABLE.insert(), [
+            {'name': name, 'type': cls._clusto_type, 'driver': cls._driver_name, 'version': version}
+            for name in names[start:start + util.NAMES_PER_QUERY]
+        ])
+    created = util.get_by_names(names)
+    for obj in created.values():
+        schema.audit_log.info('create entity %s driver=%s type=%s', obj.name, cls._driver_name, cls._clusto_type)
+        for key, value in cls._properties.iteritems():
+            if value is not None:
+                setattr(obj, key, value)
+    # The inserts bypass the ORM, tell clusto this transaction wrote something
+    clusto.SESSION.flushed.update(obj.entity for obj in created.values())
+    return dict((name, util.unclusto(obj)) for name, obj in created.items())
+
+
 @app.delete('/<driver>/<name>')
 def delete(driver, name):
     """
@@ -302,7 +367,7 @@ Will yield a 409 (Conflict) because the object ``showpool`` is not a
 @app.post('/<driver>/<name>')
 def action(driver, name):
     """
-Inserts/removes the given device from the request parameters into/from the object
+Inserts/removes the given devices from the request parameters into/from the object
 
 Example:
 
@@ -328,14 +393,14 @@ Example:
 
     $ ${post} -d 'device=server1' -d 'action=insert' ${server_url}/entity/pool/pool1
     {
-        "attrs": [],
-        "contents": [
+        "action": "insert",
+        "changed": [
             "/basicserver/server1"
         ],
+        "count": 1,
         "driver": "pool",
         "name": "pool1",
-        "parents": [],
-        "type": "pool"
+        "unchanged": []
     }
     HTTP: 200
     Content-type: application/json
@@ -344,12 +409,14 @@ Example:
 
     $ ${post} -d 'device=server1' -d 'action=remove' ${server_url}/entity/pool/pool1
     {
-        "attrs": [],
-        "contents": [],
+        "action": "remove",
+        "changed": [
+            "/basicserver/server1"
+        ],
+        "count": 0,
         "driver": "pool",
         "name": "pool1",
-        "parents": [],
-        "type": "pool"
+        "unchanged": []
     }
     HTTP: 200
     Content-type: application/json
@@ -382,19 +449,36 @@ Examples:
     HTTP: 201
     Content-type: application/json
 
+.. code:: bash
+
+    $ ${post} -d 'device=server2' -d 'action=insert' ${server_url}/entity/pool/pool2
+    {
+        "action": "insert",
+        "changed": [
+            "/basicserver/server2"
+        ],
+        "count": 1,
+        "driver": "pool",
+        "name": "pool2",
+        "unchanged": []
+    }
+    HTTP: 200
+    Content-type: application/json
+
 .. code:: bash
 
     $ ${post} -d 'device=server2' -d 'device=server3' -d 'action=insert' ${server_url}/entity/pool/pool2
     {
-        "attrs": [],
-        "contents": [
-            "/basicserver/server2",
+        "action": "insert",
+        "changed": [
             "/basicserver/server3"
         ],
+        "count": 2,
         "driver": "pool",
         "name": "pool2",
-        "parents": [],
-        "type": "pool"
+        "unchanged": [
+            "/basicserver/server2"
+        ]
     }
     HTTP: 200
     Content-type: application/json
@@ -403,12 +487,15 @@ Examples:
 
     $ ${post} -d 'device=server2' -d 'device=server3' -d 'action=remove' ${server_url}/entity/pool/pool2
     {
-        "attrs": [],
-        "contents": [],
+        "action": "remove",
+        "changed": [
+            "/basicserver/server2",
+            "/basicserver/server3"
+        ],
+        "count": 0,
         "driver": "pool",
         "name": "pool2",
-        "parents": [],
-        "type": "pool"
+        "unchanged": []
     }
     HTTP: 200
     Content-type: application/json
@@ -417,9 +504,17 @@ The above will:
 
 #.  Create a pool entity called ``pool2``
 #.  Create two basicserver entities called ``server2`` and ``server3``
-#.  Insert both basicserver entities into the pool entity
+#.  Insert ``server2`` into the pool entity
+#.  Insert both basicserver entities into the pool entity, which only
+    changes ``server3`` as ``server2`` is already in it
 #.  Remove both basicserver entities from the pool entity
 
+Devices are looked up at once and compared with the contents of the object
+as sets, and all of them are inserted or removed in a single transaction.
+The response sums up what changed (``changed``), what was already as
+requested (``unchanged``) and how many contents the object has now
+(``count``), use ``show`` to get the object itself.
+
 """
 
     obj, status, msg = util.get(name, driver)
@@ -430,29 +525,374 @@ The above will:
 
     if not action:
         bottle.abort(400, 'Parameter \'action\' is required.')
+    if action not in ('insert', 'remove'):
+        bottle.abort(400, '%s is not a valid action.' % (action))
+
+    found = util.get_by_names(devices)
+    notfound = [_ for _ in devices if unicode(_) not in found]
+    if notfound:
+        bottle.abort(404, 'Objects %s do not exist and cannot be used with "%s"' % (','.join(notfound), name,))
 
     devobjs = []
-    notfound = []
+    seen = set()
     for device in devices:
+        devobj = found[unicode(device)]
+        if devobj.entity.entity_id not in seen:
+            seen.add(devobj.entity.entity_id)
+            devobjs.append(devobj)
+
+    members = {}
+    for attr in obj.content_attrs():
+        members.setdefault(attr.relation_id, []).append(attr)
+    changed, unchanged = [], []
+    for devobj in devobjs:
+        if (devobj.entity.entity_id in members) == (action == 'remove'):
+            changed.append(devobj)
+        else:
+            unchanged.append(devobj)
+
+    # Serialized before committing, that expires every object
+    result = {
+        'name': obj.name,
+        'driver': obj.driver,
+        'action': action,
+        'changed': [util.unclusto(_) for _ in changed],
+        'unchanged': [util.unclusto(_) for _ in unchanged],
+        'count': len(members) + len(changed) if action == 'insert' else len(members) - len(changed),
+    }
+    if changed:
         try:
-            devobjs.append(clusto.get_by_name(device))
-        except LookupError:
-            notfound.append(device)
+            clusto.begin_transaction()
+            if action == 'insert':
+                _insert(obj, changed)
+            else:
+                _remove(obj, [attr for _ in changed for attr in members[_.entity.entity_id]])
+            clusto.commit()
+        except Exception:
+            clusto.rollback_transaction()
+            raise
+
+    return util.dumps(result)
 
-    if notfound:
-        bottle.abort(404, 'Objects %s do not exist and cannot be used with "%s"' % (','.join(notfound), name,))
 
-    if action == 'insert':
+def _insert(obj, devobjs):
+    """
+Inserts all of ``devobjs`` into ``obj``, none of which is in it already.
+Objects whose driver has its own rules for inserting are inserted one by
+one, plain pools and drivers get all the checks in one query and all the
+rows in batches.
+"""
+
+    if getattr(type(obj).insert, 'im_func', None) not in (Driver.insert.im_func, Pool.insert.im_func):
         for devobj in devobjs:
-            if devobj not in obj:
-                obj.insert(devobj)
+            obj.insert(devobj)
+        return
+
+    ids = [_.entity.entity_id for _ in devobjs]
+    parents = {}
+    for start in range(0, len(ids), util.NAMES_PER_QUERY):
+        query = sqlalchemy.select([
+            schema.ATTR_TABLE.c.relation_id, schema.ENTITY_TABLE.c.name, schema.ENTITY_TABLE.c.driver,
+        ]).where(sqlalchemy.and_(
+            schema.ATTR_TABLE.c.entity_id == schema.ENTITY_TABLE.c.entity_id,
+            schema.ATTR_TABLE.c.key == u'_contains',
+            schema.ATTR_TABLE.c.relation_id.in_(ids[start:start + util.NAMES_PER_QUERY]),
+            schema.ATTR_TABLE.c.deleted_at_version == None,  # noqa
+            schema.ENTITY_TABLE.c.deleted_at_version == None,  # noqa
+        ))
+        for relation_id, parent, parent_driver in clusto.SESSION.execute(query):
+            parents.setdefault(relation_id, []).append((parent, parent_driver))
+
+    # Same checks, and errors, as Pool.insert and Driver.insert
+    for devobj in devobjs:
+        found = parents.get(devobj.entity.entity_id, [])
+        if isinstance(obj, Pool):
+            if any(_driver == ExclusivePool._driver_name for _, _driver in found):
+                raise PoolException('%s is in ExclusivePool %s' % (devobj, obj))
+        elif found:
+            raise TypeError('%s is already in %s and cannot be inserted into %s.' % (devobj.name, found[0][0], obj.name))
+
+    # Numbers come from the same counter Attribute uses, bumped once
+    counter = schema.Counter.get(obj.entity, '_contains', default=-1)
+    counter.value = schema.Counter.value + len(devobjs)
+    clusto.flush()
+    first = counter.value - len(devobjs) + 1
+    version = clusto.SESSION.execute(schema.working_version()).scalar()
+    rows = []
+    for number, devobj in enumerate(devobjs, first):
+        schema.audit_log.info(
+            'create attribute entity=%s key=_contains subkey=None value=%s number=%s datatype=relation',
+            obj.name, devobj.name, number,
+        )
+        rows.append({
+            'entity_id': obj.entity.entity_id, 'key': u'_contains', 'subkey': None, 'number': number,
+            'datatype': 'relation', 'relation_id': devobj.entity.entity_id, 'version': version,
+        })
+    for start in range(0, len(rows), util.NAMES_PER_QUERY):
+        clusto.SESSION.execute(schema.ATTR_TABLE.insert(), rows[start:start + util.NAMES_PER_QUERY])
+
+
+def _remove(obj, attrs):
+    """
+Removes the given ``_contains`` attributes of ``obj``, like ``Attribute.delete``
+does but in batches.
+"""
+
+    table = schema.ATTR_TABLE
+    # Like ``del_attrs``, expire the cached attributes while they still exist
+    obj.expire(key='_contains')
+    for attr in attrs:
+        schema.audit_log.info(
+            'delete attribute entity=%s key=%s subkey=%s value=%s number=%s datatype=%s',
+            obj.name, attr.key, attr.subkey, attr.relation_id, attr.number, attr.datatype,
+        )
+    clusto.flush()
+    version = clusto.SESSION.execute(schema.working_version()).scalar()
+    ids = [_.attr_id for _ in attrs]
+    for start in range(0, len(ids), util.NAMES_PER_QUERY):
+        where = table.c.attr_id.in_(ids[start:start + util.NAMES_PER_QUERY])
+        if clusto.SESSION.clusto_versioning_enabled:
+            clusto.SESSION.execute(table.update().where(where).values(deleted_at_version=version))
+        else:
+            clusto.SESSION.execute(table.delete().where(where))
+    # The statements bypass the ORM, tell clusto this transaction wrote something
+    clusto.SESSION.flushed.add(obj.entity)
+
+
+def _paths(entity_ids):
+    "Returns ``{entity_id: path}`` for the given entities, as ``util.unclusto`` would"
+
+    ids = sorted(set(entity_ids))
+    paths = {}
+    for start in range(0, len(ids), util.NAMES_PER_QUERY):
+        query = sqlalchemy.select([
+            schema.ENTITY_TABLE.c.entity_id, schema.ENTITY_TABLE.c.driver, schema.ENTITY_TABLE.c.name,
+        ]).where(schema.ENTITY_TABLE.c.entity_id.in_(ids[start:start + util.NAMES_PER_QUERY]))
+        for entity_id, driver, name in clusto.SESSION.execute(query):
+            paths[entity_id] = u'/%s/%s' % (driver, name)
+    return paths
+
+
+def _reconcile(wanted):
+    """
+Makes every object in ``wanted``, a list of ``(object, [devices])``, contain
+exactly those devices. Current members of all of them are looked up at once
+and only the differences are written, in one transaction. Returns a summary
+per object of the devices ``added`` and ``removed``.
+"""
 
-    elif action == 'remove':
+    ids = [obj.entity.entity_id for obj, _ in wanted]
+    members = dict((_, {}) for _ in ids)
+    with timing.phase('lookup'):
+        for start in range(0, len(ids), util.NAMES_PER_QUERY):
+            attrs = schema.Attribute.query().filter(sqlalchemy.and_(
+                schema.Attribute.entity_id.in_(ids[start:start + util.NAMES_PER_QUERY]),
+                schema.Attribute.key == u'_contains',
+            ))
+            for attr in attrs:
+                members[attr.entity_id].setdefault(attr.relation_id, []).append(attr)
+
+    changes = []
+    for obj, devobjs in wanted:
+        current = members[obj.entity.entity_id]
+        keep = set(_.entity.entity_id for _ in devobjs)
+        added, seen = [], set()
         for devobj in devobjs:
-            if devobj in obj:
-                obj.remove(devobj)
+            entity_id = devobj.entity.entity_id
+            if entity_id not in current and entity_id not in seen:
+                seen.add(entity_id)
+                added.append(devobj)
+        removed = sorted(_ for _ in current if _ not in keep)
+        changes.append((obj, added, removed))
+
+    # Serialized before committing, that expires every object
+    paths = _paths(_ for _, _, removed in changes for _ in removed)
+    result = [{
+        'name': obj.name,
+        'driver': obj.driver,
+        'added': [util.unclusto(_) for _ in added],
+        'removed': [paths[_] for _ in removed],
+    } for obj, added, removed in changes]
+
+    if any(added or removed for _, added, removed in changes):
+        try:
+            clusto.begin_transaction()
+            for obj, added, removed in changes:
+                if added:
+                    _insert(obj, added)
+                if removed:
+                    _remove(obj, [attr for _ in removed for attr in members[obj.entity.entity_id][_]])
+            clusto.commit()
+        except Exception:
+            clusto.rollback_transaction()
+            raise
+    return result
+
+
+@app.put('/<driver>/<name>')
+def reconcile(driver, name):
+    """
+Makes the object contain exactly the given devices: the ones missing are
+inserted and the ones not given are removed, in one transaction, looking up
+the current members only once. Returns only the devices ``added`` and
+``removed``, nothing is written when there's nothing to change.
 
-    else:
-        bottle.abort(400, '%s is not a valid action.' % (action))
+The devices are given as ``device`` parameters or as a JSON list, send an
+empty JSON list to remove every member.
+
+Example:
+
+.. code:: bash
+
+    $ ${post} -d 'name=recserver1' -d 'name=recserver2' -d 'name=recserver3' ${server_url}/entity/basicserver
+    [
+        "/basicserver/recserver1",
+        "/basicserver/recserver2",
+        "/basicserver/recserver3"
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'name=recpool1' -d 'name=recpool2' ${server_url}/entity/pool
+    [
+        "/pool/recpool1",
+        "/pool/recpool2"
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${put} -d 'device=recserver1' -d 'device=recserver2' ${server_url}/entity/pool/recpool1
+    {
+        "added": [
+            "/basicserver/recserver1",
+            "/basicserver/recserver2"
+        ],
+        "driver": "pool",
+        "name": "recpool1",
+        "removed": []
+    }
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${put} -d 'device=recserver2' -d 'device=recserver3' ${server_url}/entity/pool/recpool1
+    {
+        "added": [
+            "/basicserver/recserver3"
+        ],
+        "driver": "pool",
+        "name": "recpool1",
+        "removed": [
+            "/basicserver/recserver1"
+        ]
+    }
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${put} -d 'device=recserver2' -d 'device=nonserver' ${server_url}/entity/pool/recpool1
+    "Objects nonserver do not exist and cannot be used with \"recpool1\""
+    HTTP: 404
+    Content-type: application/json
 
-    return show(driver, name)
+    $ ${put} ${server_url}/entity/pool/recpool1
+    "Provide the devices as \"device\" parameters or a JSON list of names"
+    HTTP: 400
+    Content-type: application/json
+
+    $ ${put} -H 'Content-Type: application/json' -d '["recserver1", 2]' ${server_url}/entity/pool/recpool1
+    "Provide the devices as \"device\" parameters or a JSON list of names"
+    HTTP: 400
+    Content-type: application/json
+
+"""
+
+    obj, status, msg = util.get(name, driver)
+    if not obj:
+        return util.dumps(msg, status)
+    try:
+        devices = request.json
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+    if devices is None and 'device' in request.params:
+        devices = request.params.getall('device')
+    if not isinstance(devices, types.ListType) or not all(isinstance(_, types.StringTypes) for _ in devices):
+        return util.dumps('Provide the devices as "device" parameters or a JSON list of names', 400)
+
+    found = util.get_by_names(devices)
+    notfound = [_ for _ in devices if unicode(_) not in found]
+    if notfound:
+        return util.dumps(
+            'Objects %s do not exist and cannot be used with "%s"' % (','.join(notfound), name,), 404
+        )
+    try:
+        result = _reconcile([(obj, [found[unicode(_)] for _ in devices])])
+    except (PoolException, TypeError) as e:
+        return util.dumps('%s' % (e,), 409)
+    return util.dumps(result[0])
+
+
+@app.put('/')
+def reconcile_many():
+    """
+Like ``reconcile``, for many objects at once: the JSON body maps the name
+of every object to the list of devices it should contain. All of them are
+reconciled in a single transaction, returns the devices ``added`` and
+``removed`` from each.
+
+Example:
+
+.. code:: bash
+
+    $ ${put} -H 'Content-Type: application/json' -d '${sample_reconcile}' ${server_url}/entity/
+    [
+        {
+            "added": [],
+            "driver": "pool",
+            "name": "recpool1",
+            "removed": []
+        },
+        {
+            "added": [
+                "/basicserver/recserver1"
+            ],
+            "driver": "pool",
+            "name": "recpool2",
+            "removed": []
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${put} -H 'Content-Type: application/json' -d '{"recpool1": [null]}' ${server_url}/entity/
+    "Provide a JSON object mapping names to lists of device names"
+    HTTP: 400
+    Content-type: application/json
+
+"""
+
+    try:
+        body = request.json
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+    if not isinstance(body, dict) or not body or not all(
+        isinstance(devices, types.ListType) and all(isinstance(_, types.StringTypes) for _ in devices)
+        for devices in body.values()
+    ):
+        return util.dumps('Provide a JSON object mapping names to lists of device names', 400)
+
+    objs = util.get_by_names(body.keys())
+    missing = sorted(set(body) - set(objs))
+    if missing:
+        return util.dumps('Objects %s do not exist' % (','.join(missing),), 404)
+    found = util.get_by_names(set(_ for devices in body.values() for _ in devices))
+    wanted = []
+    for name, devices in sorted(body.items()):
+        notfound = [_ for _ in devices if unicode(_) not in found]
+        if notfound:
+            return util.dumps(
+                'Objects %s do not exist and cannot be used with "%s"' % (','.join(notfound), name,), 404
+            )
+        wanted.append((objs[name], [found[unicode(_)] for _ in devices]))
+    try:
+        return util.dumps(_reconcile(wanted))
+    except (PoolException, TypeError) as e:
+        return util.dumps('%s' % (e,), 409)
@@ -14,12 +14,39 @@ import bottle
 from bottle import request
 import clusto
 from clusto import drivers
+from clusto import schema
+from clusto.exceptions import ResourceException, ResourceNotAvailableException, ResourceTypeException
+from clusto.exceptions import NameException, TransactionException
+from clustoapi import freeranges
+from clustoapi import timing
 from clustoapi import util
+import datetime
+import sqlalchemy
+import uuid
 
 
 app = bottle.Bottle(autojson=False)
 app.config['source_module'] = __name__
 
+# Most resources a single request can allocate
+ALLOCATE_LIMIT = 1000
+
+# Reservations are stored on their manager: one RESERVATION_KEY attribute per
+# reservation, its name as subkey and when it expires as value, and every
+# resource in it as an attribute of the manager itself, keyed like the
+# allocated ones so the manager owns it, next to a RESERVED_SUBKEY attribute
+# with the same number holding the reservation name. That number is taken
+# from the counter allocations use, and kept when the resource is claimed
+RESERVATION_KEY = '_reservation'
+RESERVED_SUBKEY = 'reservation'
+# Seconds a reservation lasts unless asked otherwise, and at most
+RESERVATION_TTL = 300
+RESERVATION_MAX_TTL = 86400
+
+# Counter of an IP manager bumped by every write through the API that takes
+# or frees some of its addresses, tells when its free-range index is stale
+VERSION_KEY = '_addresses'
+
 
 def _get_resource_manager(manager, driver):
     "A wrapper because an extra check has to be made :("
@@ -38,6 +65,482 @@ def _get_resource_manager(manager, driver):
     return obj, status, msg
 
 
+def _count():
+    "Reads the ``count`` parameter, returns ``(count, error response)``"
+
+    count = request.params.get('count')
+    try:
+        count = int(count or 1)
+    except ValueError:
+        return None, util.dumps('The count "%s" is not a number' % (count,), 400)
+    if count < 1:
+        return None, util.dumps('The count has to be at least 1', 400)
+    return count, None
+
+
+def _ip_bounds(resman):
+    """
+Returns the first and last address ``resman`` allocates and its gateway,
+``None`` if it has none in range, as they are stored.
+"""
+
+    net = resman.ipy
+    low = int(net.net().int() + 1 - resman._int_ip_const)
+    high = int(net.broadcast().int() - 1 - resman._int_ip_const)
+    gateway = None
+    if resman.gateway:
+        try:
+            gateway, _ = resman.ensure_type(resman.gateway)
+        except ResourceTypeException:
+            pass
+    return low, high, gateway
+
+
+def _ip_where(resman, low, high):
+    "Matches the rows of the addresses between ``low`` and ``high`` that are taken"
+
+    table = schema.ATTR_TABLE
+    return sqlalchemy.and_(
+        table.c.key == resman._attr_name,
+        table.c.subkey == None,  # noqa
+        table.c.number != None,  # noqa
+        table.c.deleted_at_version == None,  # noqa
+        table.c.int_value.between(low, high),
+    )
+
+
+def _ip_signature(resman, low, high, gateway):
+    """
+Changes whenever an address between ``low`` and ``high`` is taken or freed:
+the ``VERSION_KEY`` counter of the manager, or an aggregate of the addresses
+taken if nothing wrote to it through the API yet.
+"""
+
+    counters = schema.COUNTER_TABLE
+    table = schema.ATTR_TABLE
+    with timing.phase('lookup'):
+        version = clusto.SESSION.execute(sqlalchemy.select([counters.c.value]).where(sqlalchemy.and_(
+            counters.c.entity_id == resman.entity.entity_id,
+            counters.c.attr_key == VERSION_KEY,
+        ))).scalar()
+        if version is not None:
+            return ('version', version)
+        return tuple(clusto.SESSION.execute(sqlalchemy.select([
+            sqlalchemy.func.count(), sqlalchemy.func.max(table.c.attr_id), sqlalchemy.func.sum(table.c.int_value),
+        ]).where(_ip_where(resman, low, high))).first())
+
+
+def _ip_taken(resman, low, high, gateway):
+    "Returns the addresses between ``low`` and ``high`` that are taken, like ``IPManager.available`` sees them"
+
+    table = schema.ATTR_TABLE
+    with timing.phase('lookup'):
+        taken = [_[0] for _ in clusto.SESSION.execute(
+            sqlalchemy.select([table.c.int_value]).where(_ip_where(resman, low, high))
+        )]
+    if gateway is not None:
+        taken.append(gateway)
+    return taken
+
+
+def _free_ranges(resman, refresh=False):
+    """
+Returns the free-interval index of an IP manager along with the key it's
+stored under, building it if the addresses it manages changed since, or if
+asked to ``refresh`` it.
+"""
+
+    bounds = _ip_bounds(resman)
+    key = (resman.entity.entity_id,) + bounds
+    signature = _ip_signature(resman, *bounds)
+    return key, freeranges.get(
+        key, signature, lambda: freeranges.FreeRanges(bounds[0], bounds[1], _ip_taken(resman, *bounds), signature), refresh
+    )
+
+
+def _next_ip(resman, index, key, start):
+    """
+Returns the next free address at or after ``start`` according to the index,
+checking it really is free: the index is rebuilt once if it isn't. It's
+checked with the query the index is built from, ``IPManager.available``
+reads the manager's properties again every time.
+"""
+
+    table = schema.ATTR_TABLE
+    rebuilt = False
+    while True:
+        candidate = index.next(start)
+        if candidate is None:
+            raise ResourceNotAvailableException('out of available ips.')
+        with timing.phase('lookup'):
+            taken = clusto.SESSION.execute(
+                sqlalchemy.select([table.c.attr_id]).where(_ip_where(resman, candidate, candidate)).limit(1)
+            ).first()
+        if taken is None:
+            return candidate
+        if rebuilt:
+            index.take(candidate)
+        else:
+            index.reset(_ip_taken(resman, *key[1:]))
+            rebuilt = True
+
+
+def _indexed(resman):
+    "Returns whether ``resman`` is an IP manager with a free-range index"
+
+    return isinstance(resman, drivers.resourcemanagers.IPManager) and resman.baseip is not None
+
+
+def _touch(resman):
+    "Bumps the ``VERSION_KEY`` counter of an IP manager, in the current transaction"
+
+    if _indexed(resman):
+        schema.Counter.get(resman.entity, VERSION_KEY).next()
+
+
+def _lock(resman):
+    """
+Takes the write lock of the resource manager's row, held until the current
+transaction ends, so allocations from the same manager don't pick the same
+free resource. It is a write rather than ``SELECT ... FOR UPDATE`` so SQLite
+takes its database lock right away too.
+"""
+
+    table = schema.ENTITY_TABLE
+    clusto.SESSION.execute(
+        table.update().where(table.c.entity_id == resman.entity.entity_id).values(version=table.c.version)
+    )
+
+
+def _allocate(resman, pairs):
+    """
+Allocates every ``(thing, resource)`` pair from ``resman`` in one transaction,
+locking the manager once. Returns what was allocated, serialized.
+"""
+
+    index = None
+    try:
+        clusto.begin_transaction()
+        _lock(resman)
+        _expire(resman)
+        if _indexed(resman):
+            key, index = _free_ranges(resman)
+            # Only stored again once committed
+            index = index.copy()
+            start = lastip = resman.attr_value('_lastip')
+        _touch(resman)
+        allocated = []
+        for thing, resource in pairs:
+            if index is not None and resource is ():
+                lastip = _next_ip(resman, index, key, lastip)
+                attr = resman.allocate(thing, lastip, force=True)
+            else:
+                attr = resman.allocate(thing, resource)
+            if index is not None and attr is not None:
+                index.take(attr.value)
+            allocated.append(attr)
+        if index is not None:
+            if lastip != start:
+                resman.set_attr('_lastip', lastip)
+            clusto.flush()
+            index.signature = _ip_signature(resman, *key[1:])
+        # Serialized before committing, that expires every object
+        result = [util.unclusto(_) for _ in allocated]
+        clusto.commit()
+    except Exception:
+        clusto.rollback_transaction()
+        raise
+    if index is not None:
+        freeranges.put(key, index)
+    return result
+
+
+def _deallocate(resman, pairs, report=False):
+    """
+Deallocates every ``(thing, resource)`` pair from ``resman`` in one
+transaction, locking the manager once. When ``report`` is set it returns,
+per thing in the order given, the resources that were actually deallocated.
+"""
+
+    things, ids = [], []
+    for thing, _ in pairs:
+        if thing.entity.entity_id not in ids:
+            things.append(thing)
+            ids.append(thing.entity.entity_id)
+    try:
+        clusto.begin_transaction()
+        _lock(resman)
+        _touch(resman)
+        if report:
+            before = _allocations(resman, ids)
+        for thing, resource in pairs:
+            resman.deallocate(thing, resource=resource)
+        result = None
+        if report:
+            clusto.SESSION.flush()
+            after = _allocations(resman, ids)
+            result = [{
+                'object': util.unclusto(thing),
+                'deallocated': [_ for _ in before[entity_id] if _ not in after[entity_id]],
+            } for thing, entity_id in zip(things, ids)]
+        clusto.commit()
+    except Exception as e:
+        try:
+            clusto.rollback_transaction()
+        except TransactionException:
+            # Deallocating a resource the thing doesn't have rolls back twice
+            pass
+        raise e
+    return result
+
+
+def _reservations(resman):
+    """
+Returns the reservations of ``resman`` as ``{name: (attr_id, expires,
+[(resource, number, [attr_id])])}``, resources in the order they were
+reserved.
+"""
+
+    table = schema.ATTR_TABLE
+    result = {}
+    resources = {}
+    with timing.phase('lookup'):
+        query = sqlalchemy.select([
+            table.c.attr_id, table.c.key, table.c.subkey, table.c.number, table.c.int_value, table.c.string_value,
+            table.c.datetime_value,
+        ]).where(sqlalchemy.and_(
+            table.c.entity_id == resman.entity.entity_id,
+            table.c.key.in_([RESERVATION_KEY, resman._attr_name]),
+            table.c.deleted_at_version == None,  # noqa
+        ))
+        for row in clusto.SESSION.execute(query):
+            if row['key'] == RESERVATION_KEY:
+                result[row['subkey']] = (row['attr_id'], row['datetime_value'], [])
+            else:
+                resources.setdefault(row['number'], []).append(row)
+    for number, rows in sorted(resources.items()):
+        name = [_['string_value'] for _ in rows if _['subkey'] == RESERVED_SUBKEY]
+        value = [_ for _ in rows if _['subkey'] is None]
+        if name and value and name[0] in result:
+            value = value[0]['int_value'] if value[0]['int_value'] is not None else value[0]['string_value']
+            result[name[0]][2].append((value, number, [_['attr_id'] for _ in rows]))
+    return result
+
+
+def _delete(resman, ids):
+    """
+Deletes the attribute rows of ``resman`` with the given ids, like
+``Attribute.delete`` does, only those not deleted yet. Returns how many it
+deleted, so concurrent deletes of the same rows can tell they lost.
+"""
+
+    table = schema.ATTR_TABLE
+    deleted = 0
+    for start in range(0, len(ids), util.NAMES_PER_QUERY):
+        where = sqlalchemy.and_(
+            table.c.attr_id.in_(ids[start:start + util.NAMES_PER_QUERY]),
+            table.c.deleted_at_version == None,  # noqa
+        )
+        if clusto.SESSION.clusto_versioning_enabled:
+            version = clusto.SESSION.execute(schema.working_version()).scalar()
+            statement = table.update().where(where).values(deleted_at_version=version)
+        else:
+            statement = table.delete().where(where)
+        deleted += clusto.SESSION.execute(statement).rowcount
+    schema.audit_log.info('delete attributes entity=%s count=%d', resman.name, deleted)
+    # The statements bypass the ORM, tell clusto this transaction wrote something
+    clusto.SESSION.flushed.add(resman.entity)
+    return deleted
+
+
+def _release(resman, reservation):
+    "Deletes a reservation along with the resources left in it"
+
+    attr_id, _, resources = reservation
+    _touch(resman)
+    _delete(resman, [attr_id] + [_ for _, _number, ids in resources for _ in ids])
+
+
+def _expire(resman, now=None):
+    "Releases the reservations of ``resman`` that expired by ``now``"
+
+    now = now or datetime.datetime.utcnow()
+    for reservation in _reservations(resman).values():
+        if reservation[1] <= now:
+            _release(resman, reservation)
+
+
+def _resource(resman, value):
+    "A reserved resource as the allocation parameters take it"
+
+    if isinstance(resman, drivers.resourcemanagers.IPManager):
+        return str(resman._int_to_ipy(value))
+    return value
+
+
+def _reserve(resman, name, count, ttl):
+    """
+Reserves ``count`` free resources from ``resman`` for ``ttl`` seconds under
+the given reservation ``name``, in one transaction that locks the manager,
+returning expired reservations first. The attribute numbers the resources
+will be allocated with are taken at once, claiming them doesn't need the
+counter.
+"""
+
+    index = None
+    try:
+        clusto.begin_transaction()
+        _lock(resman)
+        now = datetime.datetime.utcnow()
+        _expire(resman, now)
+        if name in _reservations(resman):
+            raise ResourceException('Reservation "%s" already exists' % (name,))
+        if _indexed(resman):
+            # Picked from the free ranges like allocations are
+            key, index = _free_ranges(resman)
+            index = index.copy()
+            start = lastip = resman.attr_value('_lastip')
+        _touch(resman)
+        expires = now + datetime.timedelta(seconds=ttl)
+        resman.add_attr(RESERVATION_KEY, expires, subkey=name)
+        # Incremented before it's read, so concurrent reservations get their
+        # own numbers
+        counter = schema.Counter.get(clusto.ClustoMeta().entity, resman._attr_name)
+        counter.value = schema.Counter.value + count
+        clusto.flush()
+        first = counter.value - count
+        resources = []
+        for number in range(first, first + count):
+            if index is not None:
+                resource = lastip = _next_ip(resman, index, key, lastip)
+                index.take(resource)
+            else:
+                resource, _ = resman.allocator()
+            resman.add_attr(resman._attr_name, resource, number=number)
+            resman.add_attr(resman._attr_name, name, number=number, subkey=RESERVED_SUBKEY)
+            # So the allocator sees this one taken
+            clusto.flush()
+            resources.append(_resource(resman, resource))
+        if index is not None:
+            if lastip != start:
+                resman.set_attr('_lastip', lastip)
+            clusto.flush()
+            index.signature = _ip_signature(resman, *key[1:])
+        clusto.commit()
+    except Exception:
+        clusto.rollback_transaction()
+        raise
+    if index is not None:
+        freeranges.put(key, index)
+    return {'name': name, 'expires': util.unclusto(expires), 'resources': resources}
+
+
+def _claim(resman, name, pairs):
+    """
+Allocates every ``(thing, resource)`` pair from the resources reserved under
+``name``, the next reserved one when the resource is ``()``, in one
+transaction. Neither the manager nor the attribute counter is locked: the
+reserved resources are taken out of the reservation with conditional
+deletes, nothing is allocated if any of them was taken out already, and
+they are allocated with the numbers they were reserved with.
+"""
+
+    try:
+        clusto.begin_transaction()
+        reservation = _reservations(resman).get(name)
+        if reservation is None or reservation[1] <= datetime.datetime.utcnow():
+            raise ResourceException('Reservation "%s" does not exist or expired' % (name,))
+        attr_id, _, reserved = reservation
+        left = dict((value, (number, ids)) for value, number, ids in reserved)
+        chosen = []
+        for thing, resource in pairs:
+            if resource is ():
+                value = [_ for _, _number, _ids in reserved if _ in left]
+                if not value:
+                    raise ResourceException('Reservation "%s" has no resources left' % (name,))
+                value = value[0]
+            else:
+                value, _ = resman.ensure_type(resource)
+                if value not in left:
+                    raise ResourceException('%s is not reserved by "%s"' % (resource, name,))
+            chosen.append((thing, value) + left.pop(value))
+        ids = [_ for _, _, _, rows in chosen for _ in rows]
+        if not left:
+            ids.append(attr_id)
+        if _delete(resman, ids) != len(ids):
+            raise ResourceException('Reservation "%s" changed while allocating from it' % (name,))
+        allocated = []
+        for thing, value, number, _ in chosen:
+            if resman._record_allocations:
+                # Forced, the reservation kept them free. A number of 1 compares
+                # equal to True in allocate, which then takes a new one from the counter
+                allocated.append(resman.allocate(thing, value, number=number, force=True))
+            else:
+                # Managers that don't record allocations, like the entity name
+                # ones creating the objects, have their own allocate
+                allocated.append(resman.allocate(thing, value))
+        # Serialized before committing, that expires every object
+        result = [util.unclusto(_) for _ in allocated]
+        clusto.commit()
+    except Exception:
+        clusto.rollback_transaction()
+        raise
+    return result
+
+
+# A resource is the attribute its manager reference, the attribute with the
+# ``manager`` subkey, points at by key and number
+REFS = schema.ATTR_TABLE.alias('refs')
+VALUES = schema.ATTR_TABLE.alias('vals')
+
+
+def _allocated(resman, columns, *where):
+    """
+Selects ``columns`` of the resources ``resman`` has allocated that match
+``where``, ``REFS`` being their manager references and ``VALUES`` their
+values.
+"""
+
+    return sqlalchemy.select(columns).where(sqlalchemy.and_(
+        REFS.c.key == resman._attr_name,
+        REFS.c.subkey == u'manager',
+        REFS.c.relation_id == resman.entity.entity_id,
+        REFS.c.deleted_at_version == None,  # noqa
+        VALUES.c.entity_id == REFS.c.entity_id,
+        VALUES.c.key == REFS.c.key,
+        VALUES.c.number == REFS.c.number,
+        VALUES.c.subkey == None,  # noqa
+        VALUES.c.deleted_at_version == None,  # noqa
+        *where
+    ))
+
+
+def _value(row):
+    "The value of a resource row"
+
+    return row['int_value'] if row['datatype'] == 'int' else row['string_value']
+
+
+def _allocations(resman, entity_ids):
+    """
+Returns the resources ``resman`` has allocated to each of the given entities
+as ``{entity_id: [resource value]}``, in as few queries as the database
+allows.
+"""
+
+    ids = sorted(set(entity_ids))
+    result = dict((_, []) for _ in ids)
+    with timing.phase('lookup'):
+        for start in range(0, len(ids), util.NAMES_PER_QUERY):
+            query = _allocated(
+                resman, [VALUES.c.entity_id, VALUES.c.datatype, VALUES.c.int_value, VALUES.c.string_value],
+                REFS.c.entity_id.in_(ids[start:start + util.NAMES_PER_QUERY]),
+            ).order_by(VALUES.c.entity_id, VALUES.c.number)
+            for row in clusto.SESSION.execute(query):
+                result[row['entity_id']].append(_value(row))
+    return result
+
+
 @app.get('/')
 @app.get('/<driver>')
 @app.get('/<driver>/')
@@ -345,6 +848,78 @@ it will create a new ``BasicServer`` object.
 
 Will create a new ``BasicServer`` object from the ``testnames`` resource
 manager with the specific name of ``s99``.
+
+.. code:: bash
+
+    $ ${post} -d 'driver=basicserver' -d 'resource=testserver1' ${server_url}/resourcemanager/simpleentitynamemanager/allocator
+    "Driver with the name testserver1 already exists."
+    HTTP: 409
+    Content-type: application/json
+
+Will return a ``409`` because there's an object called ``testserver1``
+already
+
+Send a ``count`` to allocate that many resources at once, or more than one
+``object`` to allocate one to each (``count`` to each, if also given), and
+optionally a ``resource`` per allocation. It all happens in one transaction
+that locks the manager only once, and the result is the list of allocated
+resources. Nothing is allocated if any of them fails.
+
+.. code:: bash
+
+    $ ${post} -d 'driver=basicserver' -d 'count=2' ${server_url}/resourcemanager/simpleentitynamemanager/allocator
+    [
+        "/basicserver/02",
+        "/basicserver/03"
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+Will create two new ``BasicServer`` objects named by ``allocator``
+
+.. code:: bash
+
+    $ ${post} -d 'object=02' -d 'object=03' ${server_url}/resourcemanager/simplenamemanager/nameman1
+    [
+        {
+            "datatype": "string",
+            "key": "simplename",
+            "number": 0,
+            "subkey": null,
+            "value": "01"
+        },
+        {
+            "datatype": "string",
+            "key": "simplename",
+            "number": 1,
+            "subkey": null,
+            "value": "02"
+        }
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+Will allocate a name from ``nameman1`` to each of them
+
+.. code:: bash
+
+    $ ${post} -d 'object=02' -d 'object=03' -d 'resource=03' -d 'resource=02' ${server_url}/resourcemanager/simplenamemanager/nameman1
+    "Requested resource is not available."
+    HTTP: 409
+    Content-type: application/json
+
+Will return a ``409`` without allocating ``03`` either, because ``02`` is
+already allocated
+
+.. code:: bash
+
+    $ ${post} -d 'object=02' -d 'object=03' -d 'resource=04' -d 'resource=04' ${server_url}/resourcemanager/simplenamemanager/nameman1
+    "Resources can only be allocated once, got \"04\" more than once"
+    HTTP: 400
+    Content-type: application/json
+
+Send a ``reservation`` to allocate from the resources reserved under that
+name instead, see ``reserve``.
 """
 
     obj, status, msg = _get_resource_manager(manager, driver)
@@ -352,23 +927,51 @@ manager with the specific name of ``s99``.
         return util.dumps(msg, status)
     else:
         d = request.params.get('driver')
-        o = request.params.get('object')
-        thing = d or o
-        if not thing:
+        objects = request.params.getall('object')
+        resources = request.params.getall('resource')
+        count = request.params.get('count')
+        if not d and not objects:
             return util.dumps(
                 'Cannot allocate an empty thing, send one of '
                 '"driver", "object"', 404
             )
+        bulk = count is not None or len(objects) > 1 or len(resources) > 1
+        count, error = _count()
+        if error:
+            return error
         if d:
-            thing = clusto.driverlist.get(thing)
+            thing = clusto.driverlist.get(d)
+            if not thing:
+                return util.dumps('Thing was "%s" not found' % (d,), 404)
+            things = [thing] * count
         else:
-            thing = clusto.get_by_name(thing)
-        if not thing:
-            return util.dumps('Thing was "%s" not found' % (d or o,), 404)
-        resource = request.params.get('resource', default=())
-        r = obj.allocate(thing, resource)
+            found = util.get_by_names(objects)
+            missing = [_ for _ in objects if _ not in found]
+            if missing:
+                return util.dumps('Thing was "%s" not found' % ('", "'.join(missing),), 404)
+            things = [found[name] for name in objects for _ in range(count)]
+        if len(things) > ALLOCATE_LIMIT:
+            return util.dumps(
+                'Can not allocate more than %d resources at once, asked for %d' % (ALLOCATE_LIMIT, len(things),), 400
+            )
+        if resources and len(resources) != len(things):
+            return util.dumps(
+                'Got %d resources for %d allocations, send one per allocation or none' % (len(resources), len(things),),
+                400
+            )
+        repeated = sorted(set(_ for _ in resources if resources.count(_) > 1))
+        if repeated:
+            return util.dumps('Resources can only be allocated once, got "%s" more than once' % ('", "'.join(repeated),), 400)
+        reservation = request.params.get('reservation')
+        try:
+            if reservation:
+                allocated = _claim(obj, reservation, zip(things, resources or [()] * len(things)))
+            else:
+                allocated = _allocate(obj, zip(things, resources or [()] * len(things)))
+        except (NameException, ResourceException) as e:
+            return util.dumps('%s' % (e,), 409)
 #       The returned value can be anything such a string, number, or attribute
-        return util.dumps(util.unclusto(r), 201)
+        return util.dumps(allocated if bulk else allocated[0], 201)
 
 
 @app.delete('/<driver>/<manager>')
@@ -451,20 +1054,661 @@ Examples:
     HTTP: 204
     Content-type:
 
+Send more than one ``object``, and optionally a ``resource`` for each, to
+deallocate from all of them in one transaction. The result then lists, per
+object, the resources that were deallocated:
+
+.. code:: bash
+
+    $ ${post} -d 'object=a01' -d 'count=2' ${server_url}/resourcemanager/ipmanager/ipman2
+    [
+        ...
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${delete} -d 'object=a01' -d 'object=testserver1' ${server_url}/resourcemanager/ipmanager/ipman2
+    [
+        {
+            "deallocated": [
+                1084752130,
+                1084752131
+            ],
+            "object": "/basicserver/a01"
+        },
+        {
+            "deallocated": [],
+            "object": "/basicserver/testserver1"
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
 """
 
     resman, status, msg = _get_resource_manager(manager, driver)
     if not resman:
         return util.dumps(msg, status)
     else:
-        obj = request.params.get('object')
-        if not obj:
+        objects = request.params.getall('object')
+        resources = request.params.getall('resource')
+        if not objects:
             return util.dumps(
                 'Cannot deallocate empty, send an object to deallocate',
                 404
             )
-        obj, status, msg = util.get(obj)
-        resource = request.params.get('resource', ())
+        bulk = len(objects) > 1 or len(resources) > 1
+        found = util.get_by_names(objects)
+        missing = [_ for _ in objects if _ not in found]
+        if missing:
+            return util.dumps('Object "%s" not found' % ('", "'.join(missing),), 404)
+        if resources and len(resources) != len(objects):
+            return util.dumps(
+                'Got %d resources for %d objects, send one per object or none' % (len(resources), len(objects),),
+                400
+            )
 #       Attempt to deallocate
-        resman.deallocate(obj, resource=resource)
+        try:
+            result = _deallocate(
+                resman, zip([found[_] for _ in objects], resources or [()] * len(objects)), report=bulk
+            )
+        except ResourceException as re:
+            return util.dumps('%s' % (re,), 409)
+        if bulk:
+            return util.dumps(result)
         return util.dumps(util.unclusto(resman), 204)
+
+
+@app.post('/<driver>/<manager>/reservations')
+def reserve(driver, manager):
+    """
+Reserves a block of ``count`` free resources (1 by default) from the given
+resource manager, for ``ttl`` seconds (300 by default, at most a day). It takes
+one short transaction, after which the resources can be handed out by
+allocating them with the ``reservation`` parameter set to its ``name``,
+which can be given or else is generated. Allocating from a reservation
+locks neither the manager nor the attribute counter, the numbers of the
+reserved resources are taken when reserving, so workers provisioning at
+once don't wait on each other.
+
+The manager itself holds the reserved resources, so nothing else allocates
+them. When the reservation expires, the resources left in it are free
+again; names from a name manager are not reused, they can still be
+allocated explicitly.
+
+Examples:
+
+.. code:: bash
+
+    $ ${post} -d 'name=resnames' -d 'basename=r' ${server_url}/resourcemanager/simplenamemanager
+    {
+        "attrs": [
+            ...
+        ],
+        "contents": [],
+        "count": 0,
+        "driver": "simplenamemanager",
+        "name": "resnames",
+        "parents": [],
+        "type": "resourcemanager"
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'name=worker1' -d 'count=3' ${server_url}/resourcemanager/simplenamemanager/resnames/reservations
+    {
+        "expires": "...",
+        "name": "worker1",
+        "resources": [
+            "r01",
+            "r02",
+            "r03"
+        ]
+    }
+    HTTP: 201
+    Content-type: application/json
+
+Will reserve three names from ``resnames`` as ``worker1``, for five minutes
+
+.. code:: bash
+
+    $ ${post} -d 'object=testserver1' -d 'object=testserver2' -d 'reservation=worker1' ${server_url}/resourcemanager/simplenamemanager/resnames
+    [
+        {
+            "datatype": "string",
+            "key": "simplename",
+            "number": 2,
+            "subkey": null,
+            "value": "r01"
+        },
+        {
+            "datatype": "string",
+            "key": "simplename",
+            "number": 3,
+            "subkey": null,
+            "value": "r02"
+        }
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'object=testserver1' -d 'resource=r01' -d 'reservation=worker1' ${server_url}/resourcemanager/simplenamemanager/resnames
+    "r01 is not reserved by \"worker1\""
+    HTTP: 409
+    Content-type: application/json
+
+    $ ${post} -d 'object=testserver1' ${server_url}/resourcemanager/simplenamemanager/resnames
+    {
+        "datatype": "string",
+        "key": "simplename",
+        "number": 5,
+        "subkey": null,
+        "value": "r04"
+    }
+    HTTP: 201
+    Content-type: application/json
+
+Will allocate the first two reserved names, then refuse ``r01`` because it
+isn't reserved anymore, while an allocation without the reservation skips
+the reserved ``r03``
+
+.. code:: bash
+
+    $ ${post} -d 'name=worker1' ${server_url}/resourcemanager/simplenamemanager/resnames/reservations
+    "Reservation \"worker1\" already exists"
+    HTTP: 409
+    Content-type: application/json
+
+Will return a ``409`` because ``worker1`` is still reserving ``r03``
+
+.. code:: bash
+
+    $ ${post} -d 'name=expnames' -d 'basename=e' ${server_url}/resourcemanager/simplenamemanager
+    {
+        "attrs": [
+            ...
+        ],
+        "contents": [],
+        "count": 0,
+        "driver": "simplenamemanager",
+        "name": "expnames",
+        "parents": [],
+        "type": "resourcemanager"
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'name=worker3' -d 'ttl=1' ${server_url}/resourcemanager/simplenamemanager/expnames/reservations
+    {
+        "expires": "...",
+        "name": "worker3",
+        "resources": [
+            "e01"
+        ]
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ sleep 2
+
+    $ ${post} -d 'object=testserver1' -d 'reservation=worker3' ${server_url}/resourcemanager/simplenamemanager/expnames
+    "Reservation \"worker3\" does not exist or expired"
+    HTTP: 409
+    Content-type: application/json
+
+Will reserve ``e01`` for a second only, it can't be claimed once expired
+
+.. code:: bash
+
+    $ ${post} -d 'name=worker4' ${server_url}/resourcemanager/simplenamemanager/expnames/reservations
+    {
+        "expires": "...",
+        "name": "worker4",
+        "resources": [
+            "e02"
+        ]
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'object=testserver1' -d 'resource=e02' -d 'reservation=worker4' ${server_url}/resourcemanager/simplenamemanager/expnames
+    {
+        "datatype": "string",
+        "key": "simplename",
+        "number": 7,
+        "subkey": null,
+        "value": "e02"
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'object=testserver2' -d 'resource=e02' -d 'reservation=worker4' ${server_url}/resourcemanager/simplenamemanager/expnames
+    "Reservation \"worker4\" does not exist or expired"
+    HTTP: 409
+    Content-type: application/json
+
+Will claim ``e02`` once, with the number it was reserved with, and refuse
+the second claim as the reservation is gone once it's empty
+
+.. code:: bash
+
+    $ ${post} -d 'name=worker5' -d 'count=2' ${server_url}/resourcemanager/simpleentitynamemanager/testnames/reservations
+    {
+        "expires": "...",
+        "name": "worker5",
+        "resources": [
+            "s01",
+            "s02"
+        ]
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'driver=basicserver' -d 'count=2' -d 'reservation=worker5' ${server_url}/resourcemanager/simpleentitynamemanager/testnames
+    [
+        "/basicserver/s01",
+        "/basicserver/s02"
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+Will reserve two names from the entity name manager ``testnames`` and create
+a ``BasicServer`` with each of them
+"""
+
+    obj, status, msg = _get_resource_manager(manager, driver)
+    if not obj:
+        return util.dumps(msg, status)
+    count, error = _count()
+    if error:
+        return error
+    if count > ALLOCATE_LIMIT:
+        return util.dumps(
+            'Can not reserve more than %d resources at once, asked for %d' % (ALLOCATE_LIMIT, count,), 400
+        )
+    ttl = request.params.get('ttl')
+    try:
+        ttl = int(ttl or RESERVATION_TTL)
+    except ValueError:
+        return util.dumps('The ttl "%s" is not a number' % (ttl,), 400)
+    if not 0 < ttl <= RESERVATION_MAX_TTL:
+        return util.dumps('The ttl has to be between 1 and %d seconds' % (RESERVATION_MAX_TTL,), 400)
+    name = request.params.get('name') or uuid.uuid4().hex
+    try:
+        result = _reserve(obj, name, count, ttl)
+    except ResourceException as re:
+        return util.dumps('%s' % (re,), 409)
+    return util.dumps(result, 201)
+
+
+@app.delete('/<driver>/<manager>/reservations/<name>')
+def release(driver, manager, name):
+    """
+Releases the given reservation before it expires, the resources left in it
+are free again. Returns them.
+
+Examples:
+
+.. code:: bash
+
+    $ ${post} -d 'name=worker2' -d 'count=2' ${server_url}/resourcemanager/simplenamemanager/resnames/reservations
+    {
+        "expires": "...",
+        "name": "worker2",
+        "resources": [
+            "r05",
+            "r06"
+        ]
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${delete} ${server_url}/resourcemanager/simplenamemanager/resnames/reservations/worker2
+    {
+        "name": "worker2",
+        "released": [
+            "r05",
+            "r06"
+        ]
+    }
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${delete} ${server_url}/resourcemanager/simplenamemanager/resnames/reservations/worker2
+    "Reservation \"worker2\" does not exist"
+    HTTP: 404
+    Content-type: application/json
+
+"""
+
+    obj, status, msg = _get_resource_manager(manager, driver)
+    if not obj:
+        return util.dumps(msg, status)
+    try:
+        clusto.begin_transaction()
+        reservation = _reservations(obj).get(name)
+        if reservation is not None:
+            _release(obj, reservation)
+        clusto.commit()
+    except Exception:
+        clusto.rollback_transaction()
+        raise
+    if reservation is None:
+        return util.dumps('Reservation "%s" does not exist' % (name,), 404)
+    return util.dumps({'name': name, 'released': [_resource(obj, _) for _, _number, _ids in reservation[2]]})
+
+
+@app.get('/<driver>/<manager>/free')
+def free(driver, manager):
+    """
+Shows how many addresses an IP manager has left and where: the ``size`` of
+its range (without the network, broadcast and gateway addresses), how many
+are ``free`` and ``allocated`` (reserved ones included), the
+``utilization`` as a percentage and the free ``ranges``. The ranges can be
+paginated with the ``Clusto-Page`` and ``Clusto-Per-Page`` headers.
+
+It comes from an index of the free ranges kept by the server, which is also
+what allocations of the next free address use. Addresses freed without going
+through the API are only seen once the index is rebuilt, which
+``refresh=true`` forces.
+
+Examples:
+
+.. code:: bash
+
+    $ ${post} -d 'name=freeman' -d 'gateway=10.1.0.1' -d 'netmask=255.255.255.0' -d 'baseip=10.1.0.0' ${server_url}/resourcemanager/ipmanager
+    {
+        "attrs": [
+            ...
+        ],
+        "contents": [],
+        "count": 0,
+        "driver": "ipmanager",
+        "name": "freeman",
+        "parents": [],
+        "type": "resourcemanager"
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'object=testserver1' -d 'count=2' ${server_url}/resourcemanager/ipmanager/freeman
+    [
+        ...
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'object=testserver2' -d 'resource=10.1.0.10' ${server_url}/resourcemanager/ipmanager/freeman
+    {
+        ...
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${get} ${server_url}/resourcemanager/ipmanager/freeman/free
+    {
+        "allocated": 3,
+        "first": "10.1.0.1",
+        "free": 250,
+        "last": "10.1.0.254",
+        "ranges": [
+            {
+                "first": "10.1.0.4",
+                "last": "10.1.0.9",
+                "size": 6
+            },
+            {
+                "first": "10.1.0.11",
+                "last": "10.1.0.254",
+                "size": 244
+            }
+        ],
+        "size": 253,
+        "utilization": 1.19
+    }
+    HTTP: 200
+    Content-type: application/json
+
+Will allocate ``10.1.0.2`` and ``10.1.0.3`` to ``testserver1`` and
+``10.1.0.10`` to ``testserver2``, and show what's left
+
+.. code:: bash
+
+    $ ${get} -H 'Clusto-Page: 2' -H 'Clusto-Per-Page: 1' ${server_url}/resourcemanager/ipmanager/freeman/free
+    {
+        "allocated": 3,
+        "first": "10.1.0.1",
+        "free": 250,
+        "last": "10.1.0.254",
+        "ranges": [
+            {
+                "first": "10.1.0.11",
+                "last": "10.1.0.254",
+                "size": 244
+            }
+        ],
+        "size": 253,
+        "utilization": 1.19
+    }
+    HTTP: 200
+    Content-type: application/json
+
+Will only show the second free range
+
+.. code:: bash
+
+    $ ${get} ${server_url}/resourcemanager/ipmanager/freeman/free?refresh=true
+    {
+        "allocated": 3,
+        ...
+        "free": 250,
+        ...
+    }
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${get} -H 'Clusto-Page: 1' -H 'Clusto-Per-Page: 0' ${server_url}/resourcemanager/ipmanager/freeman/free
+    "Pages start at 1 and have at least 1 range"
+    HTTP: 400
+    Content-type: application/json
+
+    $ ${get} ${server_url}/resourcemanager/simpleentitynamemanager/testnames/free
+    "The resource manager \"testnames\" is not an IP manager"
+    HTTP: 409
+    Content-type: application/json
+
+"""
+
+    obj, status, msg = _get_resource_manager(manager, driver)
+    if not obj:
+        return util.dumps(msg, status)
+    if not isinstance(obj, drivers.resourcemanagers.IPManager):
+        return util.dumps('The resource manager "%s" is not an IP manager' % (manager,), 409)
+    if obj.baseip is None:
+        return util.dumps('The IP manager "%s" has no base IP' % (manager,), 409)
+    headers = {}
+    try:
+        current = int(request.headers.get('Clusto-Page', default='0'))
+        per = int(request.headers.get('Clusto-Per-Page', default='50'))
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+    if current < 0 or per < 1:
+        return util.dumps('Pages start at 1 and have at least 1 range', 400)
+
+    key, index = _free_ranges(obj, request.query.get('refresh', '').lower() == 'true')
+    low, high, gateway = key[1:]
+    size = high - low + 1 - (1 if gateway is not None else 0)
+    ranges = index.ranges()
+    if current:
+        ranges, total = util.page(ranges, current=current, per=per)
+        headers['Clusto-Pages'] = total
+        headers['Clusto-Per-Page'] = per
+        headers['Clusto-Page'] = current
+    return util.dumps({
+        'first': _resource(obj, low),
+        'last': _resource(obj, high),
+        'size': size,
+        'free': index.free,
+        'allocated': size - index.free,
+        'utilization': round(100.0 * (size - index.free) / size, 2) if size else 0.0,
+        'ranges': [{
+            'first': _resource(obj, first),
+            'last': _resource(obj, last),
+            'size': last - first + 1,
+        } for first, last in ranges],
+    }, headers=headers)
+
+
+@app.get('/<driver>/<manager>/allocations')
+def allocations(driver, manager):
+    """
+Lists what the given resource manager has allocated to whom, one row per
+resource with the ``resource``, the ``thing`` it's allocated to and its
+``number``, sorted by resource. It comes from one query over the resource
+attributes, no entity is loaded.
+
+The resources can be limited to a range with ``first`` and ``last``, and to
+things of the given ``driver``, more than one can be sent. The rows can be
+paginated with the ``Clusto-Page`` and ``Clusto-Per-Page`` headers.
+
+Examples:
+
+.. code:: bash
+
+    $ ${post} -d 'name=auditman' -d 'gateway=10.2.0.1' -d 'netmask=255.255.255.0' -d 'baseip=10.2.0.0' ${server_url}/resourcemanager/ipmanager
+    {
+        "attrs": [
+            ...
+        ],
+        "contents": [],
+        "count": 0,
+        "driver": "ipmanager",
+        "name": "auditman",
+        "parents": [],
+        "type": "resourcemanager"
+    }
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${post} -d 'object=testserver1' -d 'object=testserver2' -d 'object=emptypool' ${server_url}/resourcemanager/ipmanager/auditman
+    [
+        ...
+    ]
+    HTTP: 201
+    Content-type: application/json
+
+    $ ${get} ${server_url}/resourcemanager/ipmanager/auditman/allocations
+    [
+        {
+            "number": 6,
+            "resource": "10.2.0.2",
+            "thing": "/basicserver/testserver1"
+        },
+        {
+            "number": 7,
+            "resource": "10.2.0.3",
+            "thing": "/basicserver/testserver2"
+        },
+        {
+            "number": 8,
+            "resource": "10.2.0.4",
+            "thing": "/pool/emptypool"
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
+Will list the three addresses just allocated
+
+.. code:: bash
+
+    $ ${get} -d 'first=10.2.0.3' -d 'driver=basicserver' ${server_url}/resourcemanager/ipmanager/auditman/allocations
+    [
+        {
+            "number": 7,
+            "resource": "10.2.0.3",
+            "thing": "/basicserver/testserver2"
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
+Will only list the addresses from ``10.2.0.3`` on allocated to servers
+
+.. code:: bash
+
+    $ ${get} -H 'Clusto-Page: 2' -H 'Clusto-Per-Page: 2' ${server_url}/resourcemanager/ipmanager/auditman/allocations
+    [
+        {
+            "number": 8,
+            "resource": "10.2.0.4",
+            "thing": "/pool/emptypool"
+        }
+    ]
+    HTTP: 200
+    Content-type: application/json
+
+Will show the second page, two rows per page
+
+.. code:: bash
+
+    $ ${get} -d 'last=10.3.0.1' ${server_url}/resourcemanager/ipmanager/auditman/allocations
+    "The ip 10.3.0.1 is out of range for this IP manager.  Should be in 10.2.0.0/255.255.255.0"
+    HTTP: 400
+    Content-type: application/json
+
+    $ ${get} -d 'driver=nodriver' ${server_url}/resourcemanager/ipmanager/auditman/allocations
+    "The requested driver \"nodriver\" does not exist"
+    HTTP: 412
+    Content-type: application/json
+
+"""
+
+    obj, status, msg = _get_resource_manager(manager, driver)
+    if not obj:
+        return util.dumps(msg, status)
+    headers = {}
+    try:
+        current = int(request.headers.get('Clusto-Page', default='0'))
+        per = int(request.headers.get('Clusto-Per-Page', default='50'))
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+    if current < 0 or per < 1:
+        return util.dumps('Pages start at 1 and have at least 1 row', 400)
+
+    where = [schema.ENTITY_TABLE.c.entity_id == VALUES.c.entity_id]
+    for param, compare in (('first', '__ge__'), ('last', '__le__')):
+        bound = request.params.get(param)
+        if bound is None:
+            continue
+        try:
+            bound, _ = obj.ensure_type(bound)
+        except ResourceTypeException as rte:
+            return util.dumps('%s' % (rte,), 400)
+        column = VALUES.c.int_value if isinstance(bound, (int, long)) else VALUES.c.string_value
+        where.append(getattr(column, compare)(bound))
+    driver_names = request.params.getall('driver')
+    for name in driver_names:
+        if name not in clusto.driverlist:
+            return util.dumps('The requested driver "%s" does not exist' % (name,), 412)
+    if driver_names:
+        where.append(schema.ENTITY_TABLE.c.driver.in_(driver_names))
+
+    query = _allocated(obj, [
+        VALUES.c.number, VALUES.c.datatype, VALUES.c.int_value, VALUES.c.string_value,
+        schema.ENTITY_TABLE.c.driver, schema.ENTITY_TABLE.c.name,
+    ], *where).order_by(VALUES.c.int_value, VALUES.c.string_value, schema.ENTITY_TABLE.c.name, VALUES.c.number)
+    with timing.phase('lookup'):
+        if current:
+            rows = _allocated(obj, [sqlalchemy.func.count()], *where)
+            total = clusto.SESSION.execute(rows).scalar()
+            headers['Clusto-Pages'] = total / per + (1 if total % per else 0)
+            headers['Clusto-Per-Page'] = per
+            headers['Clusto-Page'] = current
+            query = query.limit(per).offset((current - 1) * per)
+        result = [{
+            'resource': _resource(obj, _value(row)),
+            'thing': '/%s/%s' % (row['driver'], row['name']),
+            'number': row['number'],
+        } for row in clusto.SESSION.execute(query)]
+    return util.dumps(result, headers=headers)
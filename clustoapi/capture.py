@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Traffic capture. When ``apiserver.capture_file`` is set every request is
+appended to that file as one compact JSON line, so real traffic can later be
+replayed against a test server with ``tests/benchmarks/replay.py``:
+
+ *  ``t``: when the request started, in seconds since the epoch
+ *  ``d``: how long it took, in milliseconds
+ *  ``m``, ``p``, ``r``: method, full path and route
+ *  ``q``: query string parameters, ``f``: form parameters, as lists of
+    ``[key, value]`` pairs
+ *  ``b``, ``c``: the raw body and its content type, for bodies that are not
+    forms, like the JSON ones
+ *  ``h``: the ``Clusto-*`` request headers
+ *  ``s``: the response status
+
+Like the slow log, lines are written by a background thread and dropped,
+rather than queued without bounds, if it falls behind. Records that can't be
+written, like those with parameters that are not valid UTF-8, are logged and
+counted as dropped too. Worker processes append to the same file, every line
+is written at once. The operations of a ``/batch`` request are not captured
+on their own, replaying the batch replays them.
+"""
+
+import bottle
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+
+HEADER_PREFIX = 'Clusto-'
+FORM_TYPES = ('application/x-www-form-urlencoded', 'multipart/')
+# Requests whose environment has this key set are not captured
+SKIP_KEY = 'clustoapi.capture.skip'
+
+log = logging.getLogger(__name__)
+
+
+class Writer(object):
+    """
+Appends records to a file from a daemon thread. The thread (and the file)
+are opened lazily so forked workers get their own.
+"""
+
+    def __init__(self, path=None, maxsize=10000):
+        self.queue = Queue.Queue(maxsize)
+        self.path = path
+        self.pid = None
+        self.dropped = 0
+
+    def _run(self, path):
+        failed = 0
+        with open(path, 'a', 0) as f:
+            while True:
+                record = self.queue.get()
+                if failed:
+                    record['dropped'] = record.get('dropped', 0) + failed
+                try:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                    failed = 0
+                except Exception as e:
+                    log.warning('Could not capture %s %s: %s', record.get('m'), record.get('p'), e)
+                    failed = record.get('dropped', 0) + 1
+
+    def put(self, record):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self._run, args=(self.path,), name='clustoapi-capture')
+            thread.daemon = True
+            thread.start()
+        if self.dropped:
+            record['dropped'] = self.dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except Queue.Full:
+            self.dropped += 1
+
+
+WRITER = Writer()
+
+
+def record(route, status, start, elapsed):
+    "Builds the capture record for the request being handled"
+
+    request = bottle.request
+    result = {
+        't': round(start, 3),
+        'd': round(elapsed * 1000, 3),
+        'm': request.method,
+        'p': request.fullpath,
+        'r': route,
+        's': status,
+    }
+    if request.query:
+        result['q'] = list(request.query.allitems())
+    if request.content_length > 0 and request.content_type and not request.content_type.startswith(FORM_TYPES):
+        result['b'] = request.body.read().decode('utf-8', 'replace')
+        result['c'] = request.content_type
+    elif request.forms:
+        result['f'] = list(request.forms.allitems())
+    headers = dict((k, v) for k, v in request.headers.items() if k.startswith(HEADER_PREFIX))
+    if headers:
+        result['h'] = headers
+    return result
+
+
+class Plugin(object):
+    "Bottle plugin that captures every request"
+
+    name = 'capture'
+    api = 2
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix.rstrip('/')
+
+    def apply(self, callback, route):
+        route_name = '%s%s' % (self.prefix, route.rule,)
+
+        def wrapper(*args, **kwargs):
+            if bottle.request.environ.get(SKIP_KEY):
+                return callback(*args, **kwargs)
+            start = time.time()
+            status = 500
+            try:
+                response = callback(*args, **kwargs)
+                if isinstance(response, bottle.HTTPResponse):
+                    status = response.status_code
+                else:
+                    status = bottle.response.status_code
+                return response
+            except bottle.HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                WRITER.put(record(route_name, status, start, time.time() - start))
+
+        return wrapper
+
+
+def install(apps, path):
+    """
+Installs the capture plugin in the given ``{prefix: bottle app}`` mapping,
+writing to ``path``. Safe to call more than once.
+"""
+
+    global WRITER
+    WRITER = Writer(path)
+    for prefix, app in apps.items():
+        app.uninstall(Plugin.name)
+        app.install(Plugin(prefix))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Free-interval index of the IP managers. The free addresses of a manager are
+kept as sorted, disjoint ``[first, last]`` intervals, so the next free one
+is a binary search away and listing what's left doesn't mean listing every
+allocated address.
+
+Every process keeps its own indexes, built from the database the first time
+a manager needs one. Each of them carries the ``signature`` it was built
+with, a version the API bumps on every write to the manager, and is only
+trusted while the database still has the same one, so allocations by other
+processes just cause a rebuild. Addresses taken by clients that don't go
+through the API are found when allocating them fails, which rebuilds the
+index too. Addresses they free are not seen until the next rebuild, which
+the ``refresh`` parameter of ``/free`` forces.
+"""
+
+import bisect
+import threading
+
+
+class FreeRanges(object):
+    """
+Free integers in ``[low, high]`` as sorted, disjoint intervals, ``starts``
+and ``lasts`` holding their bounds. Finding the next free integer takes
+O(log n) on the number of intervals.
+"""
+
+    def __init__(self, low, high, taken=(), signature=None):
+        self.low = low
+        self.high = high
+        self.signature = signature
+        self.reset(taken)
+
+    def reset(self, taken):
+        "Rebuilds the intervals from everything that is ``taken``"
+
+        self.starts, self.lasts = [], []
+        self.free = 0
+        first = self.low
+        for value in sorted(set(_ for _ in taken if self.low <= _ <= self.high)):
+            if value > first:
+                self._append(first, value - 1)
+            first = value + 1
+        if first <= self.high:
+            self._append(first, self.high)
+
+    def _append(self, first, last):
+        self.starts.append(first)
+        self.lasts.append(last)
+        self.free += last - first + 1
+
+    def copy(self):
+        result = FreeRanges.__new__(FreeRanges)
+        result.low, result.high, result.signature = self.low, self.high, self.signature
+        result.starts, result.lasts, result.free = list(self.starts), list(self.lasts), self.free
+        return result
+
+    def next(self, start=None):
+        """
+Returns the first free integer at or after ``start``, wrapping around to
+``low``, ``None`` if there's none left.
+"""
+
+        if not self.starts:
+            return None
+        if start is not None:
+            index = bisect.bisect_right(self.starts, start) - 1
+            if index >= 0 and self.lasts[index] >= start:
+                return start
+            if index + 1 < len(self.starts):
+                return self.starts[index + 1]
+        return self.starts[0]
+
+    def take(self, value):
+        "Marks ``value`` as taken, if it was free"
+
+        index = bisect.bisect_right(self.starts, value) - 1
+        if index < 0 or self.lasts[index] < value:
+            return
+        first, last = self.starts[index], self.lasts[index]
+        del self.starts[index], self.lasts[index]
+        if value < last:
+            self.starts.insert(index, value + 1)
+            self.lasts.insert(index, last)
+        if first < value:
+            self.starts.insert(index, first)
+            self.lasts.insert(index, value - 1)
+        self.free -= 1
+
+    def ranges(self):
+        "Returns the free intervals as ``(first, last)`` pairs"
+
+        return zip(self.starts, self.lasts)
+
+
+INDEXES = {}
+LOCK = threading.Lock()
+
+
+def get(key, signature, build, refresh=False):
+    """
+Returns the index stored under ``key`` if its signature is ``signature``,
+else, or when asked to ``refresh`` it, the one ``build()`` returns, after
+storing it.
+"""
+
+    with LOCK:
+        index = INDEXES.get(key)
+    if refresh or index is None or index.signature != signature:
+        index = build()
+        put(key, index)
+    return index
+
+
+def put(key, index):
+    "Stores ``index`` under ``key``"
+
+    with LOCK:
+        INDEXES[key] = index
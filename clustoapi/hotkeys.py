@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Most requested entity names, pools and attribute keys, served by the
+``/__hotkeys__`` endpoint. Useful to decide what to pre-warm, cache or index,
+and to spot a client hammering the same pool.
+
+Every kind of key is counted with the space saving algorithm: at most
+``apiserver.hotkeys_capacity`` keys are kept, and a new key replaces the
+least requested one, inheriting its count. The count of every key returned
+is never under its true count, and over it by at most its ``error``, so the
+top of the list is accurate as long as it is well above the least counted
+key.
+"""
+
+import threading
+
+
+KINDS = ('entity', 'pool', 'attribute')
+CAPACITY = 100
+
+
+class SpaceSaving(object):
+    """
+Top-k counter over a stream of keys using bounded memory. ``counters`` maps
+every monitored key to a ``[count, error]`` pair.
+"""
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.counters = {}
+        self.total = 0
+
+    def add(self, key, count=1):
+        self.total += count
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0]
+        else:
+            victim = min(self.counters, key=lambda _: self.counters[_][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + count, floor]
+
+    def top(self, limit=None):
+        "Returns the ``limit`` most requested keys, most requested first"
+
+        result = sorted(self.counters.items(), key=lambda _: _[1][0], reverse=True)
+        return [
+            {'key': key, 'count': count, 'error': error}
+            for key, (count, error) in result[:limit]
+        ]
+
+
+class Tracker(object):
+    """
+One ``SpaceSaving`` counter per kind of key, safe to share between threads
+"""
+
+    def __init__(self, capacity=CAPACITY):
+        self.lock = threading.Lock()
+        self.configure(capacity)
+
+    def configure(self, capacity):
+        with self.lock:
+            self.capacity = capacity
+            self.counters = dict((_, SpaceSaving(capacity)) for _ in KINDS)
+
+    def hit(self, kind, *keys):
+        "Counts one request for each of the given keys"
+
+        if not self.capacity:
+            return
+        with self.lock:
+            counter = self.counters[kind]
+            for key in keys:
+                counter.add(key)
+
+    def top(self, limit=None):
+        with self.lock:
+            return dict(
+                (kind, {'total': counter.total, 'top': counter.top(limit)})
+                for kind, counter in self.counters.items()
+            )
+
+    def reset(self):
+        self.configure(self.capacity)
+
+
+TRACKER = Tracker()
+
+
+def hit(kind, *keys):
+    "Counts one request for each of the given keys of the given kind"
+
+    TRACKER.hit(kind, *keys)
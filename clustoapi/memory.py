@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Memory diagnostics for the ``/__memory__`` endpoint.
+
+Every request records how much memory it needed: the growth of the traced
+peak when ``tracemalloc`` is tracing, or the growth of the process maximum
+resident set size otherwise. The endpoint reports that peak for the slowest
+routes, which is usually enough to tell which listing keeps the workers
+growing.
+
+When ``tracemalloc`` is available (it is an optional dependency) it can be
+started on demand and snapshots can be taken, the endpoint then returns the
+top allocation sites of a snapshot, or the difference between two of them,
+grouped by source line.
+"""
+
+import resource
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+MAX_SNAPSHOTS = 5
+MAX_ROUTES = 20
+TOP_SITES = 20
+
+
+def maxrss():
+    "Returns the maximum resident set size of the process, in bytes"
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def _site(stat):
+    frame = stat.traceback[0]
+    return {
+        'site': '%s:%d' % (frame.filename, frame.lineno),
+        'size': stat.size,
+        'count': stat.count,
+    }
+
+
+def _site_diff(stat):
+    result = _site(stat)
+    result['size_diff'] = stat.size_diff
+    result['count_diff'] = stat.count_diff
+    return result
+
+
+class Tracker(object):
+    """
+Keeps the per-route statistics and the ``tracemalloc`` snapshots taken so
+far. Only the last ``MAX_SNAPSHOTS`` snapshots are kept.
+"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.snapshots = {}
+        self.last = 0
+
+    def record(self, route, elapsed, peak):
+        with self.lock:
+            entry = self.routes.get(route)
+            if entry is None:
+                entry = self.routes[route] = {
+                    'route': route, 'requests': 0, 'slowest': 0.0, 'slowest_peak': 0, 'peak': 0,
+                }
+            entry['requests'] += 1
+            entry['peak'] = max(entry['peak'], peak)
+            if elapsed >= entry['slowest']:
+                entry['slowest'] = elapsed
+                entry['slowest_peak'] = peak
+
+    def slowest(self, limit=MAX_ROUTES):
+        "Returns the statistics of the ``limit`` routes with the slowest requests"
+
+        with self.lock:
+            entries = [dict(_) for _ in self.routes.values()]
+        entries.sort(key=lambda _: _['slowest'], reverse=True)
+        for entry in entries:
+            entry['slowest'] = round(entry['slowest'] * 1000, 3)
+        return entries[:limit]
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+    def start(self, frames=1):
+        tracemalloc.start(frames)
+
+    def stop(self):
+        with self.lock:
+            self.snapshots = {}
+        tracemalloc.stop()
+
+    def snapshot(self):
+        "Takes a snapshot and returns its id"
+
+        snapshot = tracemalloc.take_snapshot()
+        with self.lock:
+            self.last += 1
+            self.snapshots[self.last] = snapshot
+            for old in sorted(self.snapshots)[:-MAX_SNAPSHOTS]:
+                del self.snapshots[old]
+            return self.last
+
+    def top(self, snapshot, limit=TOP_SITES):
+        "Returns the ``limit`` biggest allocation sites of a snapshot"
+
+        stats = self.snapshots[snapshot].statistics('lineno')
+        return [_site(_) for _ in stats[:limit]]
+
+    def diff(self, snapshot, base, limit=TOP_SITES):
+        "Returns the ``limit`` allocation sites that grew the most since ``base``"
+
+        stats = self.snapshots[snapshot].compare_to(self.snapshots[base], 'lineno')
+        return [_site_diff(_) for _ in stats[:limit]]
+
+    def status(self):
+        result = {
+            'tracemalloc': tracemalloc is not None,
+            'tracing': tracing(),
+            'maxrss': maxrss(),
+            'snapshots': sorted(self.snapshots),
+            'routes': self.slowest(),
+        }
+        if result['tracing']:
+            result['traced'], result['traced_peak'] = tracemalloc.get_traced_memory()
+        return result
+
+
+TRACKER = Tracker()
+
+
+class Plugin(object):
+    """
+Bottle plugin that records the time and the peak memory of every request.
+With ``tracemalloc`` running concurrent requests share the traced peak, so
+under load the numbers are an upper bound.
+"""
+
+    name = 'memory'
+    api = 2
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix.rstrip('/')
+
+    def apply(self, callback, route):
+        route_name = '%s %s%s' % (route.method, self.prefix, route.rule,)
+
+        def wrapper(*args, **kwargs):
+            traced = tracing()
+            if traced:
+                if hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            else:
+                before = maxrss()
+            start = time.time()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                if not traced:
+                    peak = maxrss() - before
+                elif tracing():
+                    peak = tracemalloc.get_traced_memory()[1] - before
+                else:
+                    peak = 0
+                TRACKER.record(route_name, elapsed, max(peak, 0))
+
+        return wrapper
+
+
+def install(apps):
+    """
+Installs the memory plugin in the given ``{prefix: bottle app}`` mapping.
+Safe to call more than once.
+"""
+
+    for prefix, app in apps.items():
+        app.uninstall(Plugin.name)
+        app.install(Plugin(prefix))
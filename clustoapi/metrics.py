@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Request metrics for the API server. Every route gets request counters,
+latency and response size histograms, an in-flight gauge and a database
+query histogram, all exported in the Prometheus text format by the
+``/__metrics__`` endpoint.
+
+When ``apiserver.metrics_dir`` is configured every worker process writes a
+snapshot of its own registry to that directory, and the scraped worker
+merges all snapshots so the exported numbers cover all workers.
+"""
+
+import atexit
+import bisect
+import bottle
+import glob
+import json
+import logging
+import os
+from clustoapi import queries
+import tempfile
+import threading
+import time
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# name: (type, help, buckets)
+METRICS = {
+    'clustoapi_requests_total': (
+        'counter', 'Total HTTP requests by route and status.', None),
+    'clustoapi_request_duration_seconds': (
+        'histogram', 'Time spent handling a request.', DURATION_BUCKETS),
+    'clustoapi_response_size_bytes': (
+        'histogram', 'Size of the response body.', SIZE_BUCKETS),
+    'clustoapi_requests_in_flight': (
+        'gauge', 'Requests currently being handled.', None),
+    'clustoapi_db_queries': (
+        'histogram', 'SQL statements issued per request.', QUERY_BUCKETS),
+}
+
+FLUSH_INTERVAL = 1.0
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+log = logging.getLogger(__name__)
+
+
+class Registry(object):
+    """
+Holds all metric samples for this process. Samples are keyed by metric name
+and a tuple of ``(label, value)`` pairs, histograms are kept as a list of
+per-bucket counts followed by the sum and the count of observations.
+"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.directory = None
+        self.last_flush = 0
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                sample = self.samples[key] = [0] * (len(buckets) + 3)
+            sample[bisect.bisect_left(buckets, value)] += 1
+            sample[-2] += value
+            sample[-1] += 1
+
+    def snapshot(self):
+        "Returns a JSON-friendly copy of all samples"
+
+        with self.lock:
+            return [
+                [name, [list(_) for _ in labels], list(value) if isinstance(value, list) else value]
+                for (name, labels), value in self.samples.items()
+            ]
+
+    def flush(self, force=False):
+        """
+Writes this process' snapshot to the metrics directory, at most once every
+``FLUSH_INTERVAL`` seconds unless ``force`` is given. Every flush writes its
+own temporary file, so threads flushing at once don't write over each other,
+and errors are only logged, metrics never fail a request.
+"""
+
+        if not self.directory:
+            return
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_flush < FLUSH_INTERVAL:
+                return
+            self.last_flush = now
+        pid = os.getpid()
+        filename = os.path.join(self.directory, 'metrics-%d.json' % (pid,))
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(prefix='metrics-%d.' % (pid,), suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.rename(tmp, filename)
+        except (IOError, OSError) as e:
+            log.warning('Could not write the metrics of worker %d to %s: %s', pid, self.directory, e)
+            if tmp is not None and os.path.exists(tmp):
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+    def collect(self):
+        """
+Returns the samples of this process merged with the samples every other
+worker flushed to the metrics directory. Gauges of dead workers are dropped.
+"""
+
+        if not self.directory:
+            return self.snapshot()
+        self.flush(force=True)
+        merged = {}
+        for filename in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            pid = int(os.path.basename(filename)[8:-5])
+            try:
+                with open(filename) as f:
+                    samples = json.load(f)
+            except (IOError, ValueError):
+                continue
+            alive = _alive(pid)
+            for name, labels, value in samples:
+                if name not in METRICS:
+                    continue
+                if METRICS[name][0] == 'gauge' and not alive:
+                    continue
+                key = (name, tuple(tuple(_) for _ in labels))
+                if key not in merged:
+                    merged[key] = value
+                elif isinstance(value, list):
+                    merged[key] = [a + b for a, b in zip(merged[key], value)]
+                else:
+                    merged[key] += value
+        return [[name, labels, value] for (name, labels), value in merged.items()]
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join(
+        '%s="%s"' % (k, (u'%s' % (v,)).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    ),)
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(samples):
+    """
+Renders a list of samples (as returned by ``Registry.collect()``) in the
+Prometheus text exposition format.
+"""
+
+    bynames = {}
+    for name, labels, value in samples:
+        bynames.setdefault(name, []).append((tuple(tuple(_) for _ in labels), value))
+
+    lines = []
+    for name in sorted(bynames.keys()):
+        kind, text, buckets = METRICS[name]
+        lines.append('# HELP %s %s' % (name, text,))
+        lines.append('# TYPE %s %s' % (name, kind,))
+        for labels, value in sorted(bynames[name]):
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (name, _labels(labels), _number(value),))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, [('le', _number(bound))]), cumulative,))
+            lines.append('%s_bucket%s %d' % (name, _labels(labels, [('le', '+Inf')]), value[-1],))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), _number(value[-2]),))
+            lines.append('%s_count%s %d' % (name, _labels(labels), value[-1],))
+    return '\n'.join(lines) + '\n'
+
+
+def _measure(response):
+    "Returns the status code and body size of whatever a route returned"
+
+    if isinstance(response, bottle.HTTPResponse):
+        status = response.status_code
+        body = response.body
+    else:
+        status = bottle.response.status_code
+        body = response
+    if isinstance(body, basestring):
+        return status, len(body)
+    return status, 0
+
+
+class Plugin(object):
+    """
+Bottle plugin that records the metrics for every route of the application
+it is installed in. Since mounted applications are not wrapped by the plugins
+of their parent, every application gets its own instance with its own
+``prefix`` so the route labels reflect the full path.
+"""
+
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, registry, prefix=''):
+        self.registry = registry
+        self.prefix = prefix.rstrip('/')
+
+    def apply(self, callback, route):
+        registry = self.registry
+        labels = (('method', route.method), ('route', self.prefix + route.rule),)
+
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            status = 500
+            size = 0
+            environ = bottle.request.environ
+            registry.inc('clustoapi_requests_in_flight', labels)
+            try:
+                response = callback(*args, **kwargs)
+                status, size = _measure(response)
+                return response
+            except bottle.HTTPResponse as e:
+                status, size = _measure(e)
+                raise
+            finally:
+                registry.inc('clustoapi_requests_in_flight', labels, -1)
+                registry.inc('clustoapi_requests_total', labels + (('status', status),))
+                registry.observe('clustoapi_request_duration_seconds', labels, time.time() - start)
+                registry.observe('clustoapi_response_size_bytes', labels, size)
+                querylog = environ.get(queries.ENVIRON_KEY)
+                registry.observe('clustoapi_db_queries', labels, querylog.count if querylog else 0)
+                registry.flush()
+
+        return wrapper
+
+
+REGISTRY = Registry()
+
+
+def install(apps, directory=None):
+    """
+Installs the metrics plugin in the given ``{prefix: bottle app}`` mapping.
+Statement counts come from the ``queries`` plugin. Safe to call more than once.
+"""
+
+    REGISTRY.directory = directory
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    for prefix, app in apps.items():
+        app.uninstall(Plugin.name)
+        app.install(Plugin(REGISTRY, prefix))
+
+
+atexit.register(REGISTRY.flush, force=True)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+On-demand profiling of a single request. A client listed in
+``apiserver.profile_hosts`` can send the ``Clusto-Profile`` header to have
+that one request run under ``cProfile``:
+
+ *  ``Clusto-Profile: true`` saves the ``pstats`` output in
+    ``apiserver.profile_dir`` and returns the normal response, naming the file
+    in the ``Clusto-Profile-File`` response header
+ *  ``Clusto-Profile: text`` returns the ``pstats`` report, sorted by
+    cumulative time, instead of the response body. The original status code
+    is kept
+
+``profile_hosts`` is empty by default, so profiling can't be requested until
+it is explicitly allowed. Without a ``profile_dir`` the report is always
+returned as text. When the profile can't be saved the error is logged and
+the normal response is returned without the ``Clusto-Profile-File`` header.
+"""
+
+import bottle
+import cProfile
+import itertools
+import logging
+import os
+import pstats
+import StringIO
+import time
+
+
+HEADER = 'Clusto-Profile'
+LIMIT = 50
+SEQUENCE = itertools.count(1)
+
+log = logging.getLogger(__name__)
+
+
+def requested(hosts):
+    """
+Returns ``'text'`` or ``'save'`` when the current request asked to be
+profiled and comes from one of the given ``hosts``, ``None`` otherwise.
+"""
+
+    value = bottle.request.headers.get(HEADER, '').lower()
+    if value not in ('true', 'text') or bottle.request.environ.get('REMOTE_ADDR') not in hosts:
+        return None
+    return 'text' if value == 'text' else 'save'
+
+
+def report(profiler, limit=LIMIT):
+    "Returns the ``pstats`` report for the given profiler as text"
+
+    stream = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+
+def filename(route, prefix=''):
+    "Builds a unique, filesystem-safe name for the profile of the current request"
+
+    rule = ''.join(c if c.isalnum() else '_' for c in prefix + route.rule).strip('_')
+    return '%s-%d-%d-%s-%s.pstats' % (
+        time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(SEQUENCE), route.method.lower(), rule or 'root',
+    )
+
+
+class Plugin(object):
+    """
+Bottle plugin that runs a route callback under ``cProfile`` when the request
+asks for it.
+"""
+
+    name = 'profiling'
+    api = 2
+
+    def __init__(self, prefix='', hosts=(), directory=None):
+        self.prefix = prefix.rstrip('/')
+        self.hosts = hosts
+        self.directory = directory
+
+    def apply(self, callback, route):
+        prefix = self.prefix
+
+        def wrapper(*args, **kwargs):
+            mode = requested(self.hosts)
+            if mode is None:
+                return callback(*args, **kwargs)
+            if self.directory is None:
+                mode = 'text'
+            raised = False
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                response = callback(*args, **kwargs)
+            except bottle.HTTPResponse as e:
+                response = e
+                raised = True
+            finally:
+                profiler.disable()
+
+            if mode == 'text':
+                if isinstance(response, bottle.HTTPResponse):
+                    status = response.status_code
+                else:
+                    status = bottle.response.status_code
+                return bottle.HTTPResponse(report(profiler), status, content_type='text/plain')
+
+            name = filename(route, prefix)
+            try:
+                profiler.dump_stats(os.path.join(self.directory, name))
+            except (IOError, OSError) as e:
+                log.warning('Could not save the profile %s to %s: %s', name, self.directory, e)
+            else:
+                if isinstance(response, bottle.HTTPResponse):
+                    response.set_header('Clusto-Profile-File', name)
+                else:
+                    bottle.response.set_header('Clusto-Profile-File', name)
+            if raised:
+                raise response
+            return response
+
+        return wrapper
+
+
+def install(apps, hosts=(), directory=None):
+    """
+Installs the profiling plugin in the given ``{prefix: bottle app}`` mapping.
+Safe to call more than once.
+"""
+
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    for prefix, app in apps.items():
+        app.uninstall(Plugin.name)
+        app.install(Plugin(prefix, hosts, directory))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Per-request SQL instrumentation. Every statement the clusto engine runs while
+handling a request is counted and timed, the totals are returned in the
+``Clusto-Query-Count`` and ``Clusto-DB-Time`` response headers, and a warning
+is logged when the same statement shape repeats more than
+``apiserver.query_repeat_threshold`` times in one request, which usually
+means an N+1 query pattern crept in.
+"""
+
+import bottle
+import logging
+import re
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import time
+
+
+log = logging.getLogger(__name__)
+
+ENVIRON_KEY = 'clustoapi.querylog'
+IN_LIST = re.compile(r'\bIN \([^()]*\)', re.IGNORECASE)
+
+
+class QueryLog(object):
+    """
+Statements issued while handling a single request. ``shapes`` maps every
+normalized statement to a ``[count, seconds]`` pair.
+"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.shapes = {}
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+        shape = IN_LIST.sub('IN (...)', statement)
+        entry = self.shapes.get(shape)
+        if entry is None:
+            self.shapes[shape] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def repeated(self, threshold):
+        "Returns ``(count, shape)`` for every shape issued more than ``threshold`` times"
+
+        return sorted(
+            [(count, shape) for shape, (count, _) in self.shapes.items() if count > threshold],
+            reverse=True
+        )
+
+    def top(self, limit=5):
+        "Returns the ``limit`` most expensive shapes as ``(seconds, count, shape)``"
+
+        return sorted(
+            [(elapsed, count, shape) for shape, (count, elapsed) in self.shapes.items()],
+            reverse=True
+        )[:limit]
+
+
+def current():
+    "Returns the query log of the request being handled, if any"
+
+    try:
+        return bottle.request.environ.get(ENVIRON_KEY)
+    except RuntimeError:
+        return None
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._clustoapi_start = time.time()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_clustoapi_start', None)
+    if start is None:
+        return
+    querylog = current()
+    if querylog is not None:
+        querylog.record(statement, time.time() - start)
+
+
+def _set_headers(response, querylog):
+    response.set_header('Clusto-Query-Count', str(querylog.count))
+    response.set_header('Clusto-DB-Time', '%.3f' % (querylog.time * 1000,))
+
+
+class Plugin(object):
+    """
+Bottle plugin that gives every request a fresh ``QueryLog``, adds the query
+headers to the response and warns about repeated statements.
+"""
+
+    name = 'queries'
+    api = 2
+
+    def __init__(self, prefix='', threshold=20):
+        self.prefix = prefix.rstrip('/')
+        self.threshold = threshold
+
+    def apply(self, callback, route):
+        route_name = '%s %s%s' % (route.method, self.prefix, route.rule,)
+        threshold = self.threshold
+
+        def wrapper(*args, **kwargs):
+            querylog = bottle.request.environ[ENVIRON_KEY] = QueryLog()
+            try:
+                response = callback(*args, **kwargs)
+                if isinstance(response, bottle.HTTPResponse):
+                    _set_headers(response, querylog)
+                else:
+                    _set_headers(bottle.response, querylog)
+                return response
+            except bottle.HTTPResponse as e:
+                _set_headers(e, querylog)
+                raise
+            finally:
+                for count, shape in querylog.repeated(threshold):
+                    log.warning(
+                        '%s issued the same statement %d times: %s',
+                        route_name, count, shape
+                    )
+
+        return wrapper
+
+
+def install(apps, threshold=20):
+    """
+Hooks the SQL engine and installs the query plugin in the given
+``{prefix: bottle app}`` mapping. Safe to call more than once.
+"""
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+    for prefix, app in apps.items():
+        app.uninstall(Plugin.name)
+        app.install(Plugin(prefix, threshold))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Low overhead sampling profiler. A background thread in every worker looks at
+the stacks of the threads that are handling a request ``apiserver.sample_rate``
+times per second (``SAMPLE_RATE`` by default) and counts each distinct stack.
+
+The counts are served by the ``/__profile__`` endpoint in the folded stack
+format, one ``frame;frame;frame count`` line per stack, which is what
+flame graph tools (``flamegraph.pl``, speedscope, etc.) expect. Frames are
+named ``module:function``. Memory is bounded: once ``MAX_STACKS`` distinct
+stacks have been seen, samples of new stacks are only counted as dropped.
+"""
+
+import os
+import sys
+import thread
+import threading
+import time
+
+
+MAX_STACKS = 10000
+MAX_DEPTH = 100
+# Frequent enough for a useful profile after a few minutes of traffic, rare
+# enough that sampling costs next to nothing
+SAMPLE_RATE = 10
+
+
+def _fold(frame, depth=MAX_DEPTH):
+    "Returns the folded representation of the stack ending in ``frame``"
+
+    names = []
+    while frame is not None and len(names) < depth:
+        code = frame.f_code
+        names.append('%s:%s' % (frame.f_globals.get('__name__', '?'), code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+class Sampler(object):
+    """
+Samples the stacks of the threads registered with ``enter`` every
+``1 / hz`` seconds. The sampling thread is started lazily so forked workers
+get their own.
+"""
+
+    def __init__(self, hz=0, max_stacks=MAX_STACKS):
+        self.lock = threading.Lock()
+        self.active = set()
+        self.stacks = {}
+        self.samples = 0
+        self.dropped = 0
+        self.pid = None
+        self.configure(hz, max_stacks)
+
+    def configure(self, hz, max_stacks=MAX_STACKS):
+        self.hz = hz
+        self.max_stacks = max_stacks
+
+    def enter(self):
+        "Registers the current thread as handling a request"
+
+        if self.hz and self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    worker = threading.Thread(target=self._run, name='clustoapi-sampler')
+                    worker.daemon = True
+                    worker.start()
+        self.active.add(thread.get_ident())
+
+    def leave(self):
+        self.active.discard(thread.get_ident())
+
+    def _run(self):
+        pid = self.pid
+        while self.hz and self.pid == pid:
+            time.sleep(1.0 / self.hz)
+            active = list(self.active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            stacks = [_fold(frames[_]) for _ in active if _ in frames]
+            del frames
+            self.add(stacks)
+        with self.lock:
+            if self.pid == pid:
+                self.pid = None
+
+    def add(self, stacks):
+        with self.lock:
+            for stack in stacks:
+                self.samples += 1
+                if stack in self.stacks:
+                    self.stacks[stack] += 1
+                elif len(self.stacks) < self.max_stacks:
+                    self.stacks[stack] = 1
+                else:
+                    self.dropped += 1
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+            self.dropped = 0
+
+    def folded(self):
+        "Returns the collected samples in the folded stack format"
+
+        with self.lock:
+            lines = ['%s %d' % (stack, count) for stack, count in sorted(self.stacks.items())]
+            if self.dropped:
+                lines.append('(dropped) %d' % (self.dropped,))
+        return ''.join(_ + '\n' for _ in lines)
+
+
+SAMPLER = Sampler()
+
+
+def _enter():
+    SAMPLER.enter()
+
+
+def _leave():
+    SAMPLER.leave()
+
+
+def install(root, hz=0, max_stacks=MAX_STACKS):
+    """
+Starts sampling requests handled by the ``root`` application ``hz`` times
+per second, sampling is disabled when ``hz`` is ``0``. Safe to call more
+than once.
+"""
+
+    SAMPLER.configure(hz, max_stacks)
+    root.remove_hook('before_request', _enter)
+    root.remove_hook('after_request', _leave)
+    if hz:
+        root.add_hook('before_request', _enter)
+        root.add_hook('after_request', _leave)
@@ -54,6 +54,30 @@ multiple operations.
 :Clusto-Minify: If set to ``True`` (not case sensitive), clusto will not
   give a response that has been pretty-printed.
 
+:Clusto-Return: Set to ``detail`` when creating several entities at once to
+  get what happened to each of them (created or already existing) instead
+  of just their list. Set to ``minimal`` when adding, setting or deleting
+  attributes to get only the attributes written or deleted instead of
+  every attribute of the object, which saves reading them all back.
+  ``Prefer: return=minimal`` does the same and is acknowledged with
+  ``Preference-Applied: return=minimal``.
+
+:Clusto-Query-Count: Response only. The number of SQL statements issued
+  while handling the request.
+
+:Clusto-DB-Time: Response only. The time spent running those statements,
+  in milliseconds.
+
+:Clusto-Timing: If set to ``True`` by a client in ``admin_hosts``, the
+  response will carry a ``Server-Timing`` header with the time spent
+  routing, looking up, serializing and encoding the result.
+
+:Clusto-Profile: If set to ``True`` by a client in ``profile_hosts``, the
+  request is run under ``cProfile`` and the stats are saved in
+  ``profile_dir``, named by the ``Clusto-Profile-File`` response header. If
+  set to ``Text``, the profile report is returned instead of the response
+  body.
+
 
 Configurable Response Headers
 -----------------------------
@@ -65,6 +89,65 @@ response headers within the ``clusto.conf``.
   ``response_headers = Access-Control-Allow-Origin:*``
 
 
+Metrics
+-------
+
+Request counts, latencies, response sizes, requests in flight and SQL
+statements per request are recorded for every route and exported by the
+``/__metrics__`` endpoint in the Prometheus text format.
+
+:metrics: Set to ``false`` to disable recording altogether. Defaults to
+  ``true``.
+
+:metrics_dir: A directory where every worker process writes its own
+  metrics, so multi-process servers export the aggregate of all workers.
+
+:query_repeat_threshold: A warning naming the route is logged whenever a
+  request issues the same SQL statement more than this many times, which
+  usually means an N+1 query pattern. Defaults to ``20``.
+
+:server_timing: Set to ``true`` to return the ``Server-Timing`` header with
+  every response. Defaults to ``false``.
+
+:admin_hosts: Comma separated list of client addresses allowed to use the
+  administrative request headers and endpoints, like ``/__memory__`` and
+  ``/__hotkeys__``.
+  Defaults to ``127.0.0.1``.
+
+:slow_request_threshold: Requests slower than this many seconds are logged
+  to the ``clustoapi.slowlog`` logger as a JSON record with their route,
+  parameters, ``Clusto-Mode``, result count, most expensive SQL statements
+  and time spent per phase. Disabled by default.
+
+:sample_rate: How many times per second the stacks of the requests being
+  handled are sampled, for the flame graph served by ``/__profile__``.
+  ``0`` disables sampling. Defaults to ``10``.
+
+:hotkeys_capacity: How many entity names, pools and attribute keys of each
+  kind are counted to find the most requested ones, served by
+  ``/__hotkeys__``. ``0`` disables counting. Defaults to ``100``.
+
+:profile_hosts: Comma separated list of client addresses allowed to use the
+  ``Clusto-Profile`` header. Empty by default, so profiling has to be
+  explicitly allowed.
+
+:profile_dir: A directory where the profiles requested with
+  ``Clusto-Profile`` are saved. Without it, profiles are always returned as
+  text.
+
+:capture_file: A file every request is appended to, one JSON line with its
+  method, path, parameters, ``Clusto-*`` headers, status and duration, so
+  the traffic can be replayed with ``tests/benchmarks/replay.py``. Disabled
+  by default.
+
+:batch_limit: The most operations a single ``/batch`` request can run, in
+  one transaction. Defaults to ``500``.
+
+:max_body: The largest request body, in bytes, the JSON endpoints accept
+  before answering ``413``. Bulk attribute writes, reconciles and batches
+  easily go over bottle's own ``102400``. Defaults to ``33554432``.
+
+
 API Docs
 --------
 
@@ -74,12 +157,25 @@ import bottle
 import clusto
 from clusto import script_helper
 import clustoapi
+from clustoapi import capture
+from clustoapi import hotkeys
+from clustoapi import memory
+from clustoapi import metrics
+from clustoapi import profiling
+from clustoapi import sampler
+from clustoapi import queries
+from clustoapi import slowlog
+from clustoapi import timing
 import functools
 import importlib
 import inspect
+import io
+import json
 import os
+import sqlalchemy
 import string
 import sys
+import urllib
 import util
 
 
@@ -93,9 +189,28 @@ DOC_SUBSTITUTIONS = {
     'delete': "curl -X DELETE -s -w '\\nHTTP: %{http_code}\\nContent-type: %{content_type}'",
     'delete_i': "curl -X DELETE -si",
     'head': "curl -s -I",
-    'sample_json_attrs': '[{"key":"group","subkey":"admin","value":"apache"},{"key":"group","subkey":"member","value":"webapp"}]'
+    'sample_json_attrs': '[{"key":"group","subkey":"admin","value":"apache"},{"key":"group","subkey":"member","value":"webapp"}]',
+    'sample_batch': '[{"method":"POST","path":"/entity/basicserver","params":{"name":"batchserver1"}},'
+                    '{"method":"POST","path":"/entity/pool/emptypool","params":{"device":"batchserver1","action":"insert"}},'
+                    '{"method":"POST","path":"/attribute/batchserver1","params":{"key":"owner","value":"ops"}},'
+                    '{"method":"POST","path":"/resourcemanager/simpleentitynamemanager/testnames","params":{"driver":"basicserver"}}]',
+    'sample_batch_failure': '[{"method":"POST","path":"/entity/basicserver","params":{"name":"batchserver2"}},'
+                            '{"method":"POST","path":"/entity/pool/nopool","params":{"device":"batchserver2","action":"insert"}}]',
+    'sample_bulk_attrs': '{"bulkattrserver1":[{"key":"rack","value":"r1"}],"bulkattrserver2":{"key":"rack","value":"r2"}}',
+    'sample_bulk_attrs_missing': '{"bulkattrserver1":{"key":"rack","value":"r3"},"nonserver":{"key":"rack","value":"r4"}}',
+    'sample_bulk_attrs_invalid': '{"bulkattrserver1":{"key":"rack","value":"r3"},'
+                                 '"bulkattrserver2":{"key":"rack","value":"r4","number":"one"}}',
+    'sample_sync_attrs': '[{"key":"group","subkey":"admin","value":"nginx"},{"key":"group","subkey":"member","value":"webapp"},'
+                         '{"key":"rack","value":"r1"}]',
+    'sample_reconcile': '{"recpool1":["recserver2","recserver3"],"recpool2":["recserver1"]}',
 }
 
+# Most operations a single /batch request can run, see ``batch_limit``
+BATCH_LIMIT = 500
+
+# Largest request body in bytes, see ``max_body``
+MAX_BODY = 32 * 1024 * 1024
+
 root_app = bottle.Bottle(autojson=False)
 
 
@@ -150,11 +265,13 @@ resource is requested.
     HTTP/1.0 204 No Content
     ...
     Content-Length: 0
+    ...
 
     $ ${head} -X OPTIONS ${server_url}/return/headers/no/matter/where
     HTTP/1.0 204 No Content
     ...
     Content-Length: 0
+    ...
 
 
 The same applies to any mounted application:
@@ -165,11 +282,13 @@ The same applies to any mounted application:
     HTTP/1.0 204 No Content
     ...
     Content-Length: 0
+    ...
 
     $ ${head} -X OPTIONS ${server_url}/attribute/who/knows/where
     HTTP/1.0 204 No Content
     ...
     Content-Length: 0
+    ...
 
 """
 
@@ -230,6 +349,315 @@ This call just returns a mapping of all currently installed applications.
     return clustoapi.util.dumps(_get_mounts_and_modules())
 
 
+@root_app.get('/__metrics__')
+def get_metrics():
+    """
+Returns the request metrics of all workers in the Prometheus text format.
+
+.. code:: bash
+
+    $ ${get} ${server_url}/__metrics__
+    # HELP clustoapi_db_queries SQL statements issued per request.
+    # TYPE clustoapi_db_queries histogram
+    ...
+    # TYPE clustoapi_request_duration_seconds histogram
+    ...
+    # TYPE clustoapi_requests_total counter
+    ...
+    HTTP: 200
+    Content-type: text/plain; version=0.0.4
+
+Every route is labeled with its method and its full rule, for example:
+
+.. code:: bash
+
+    $ ${get} -o /dev/null ${server_url}/__version__
+    HTTP: 200
+    Content-type: application/json
+
+    $ curl -s ${server_url}/__metrics__ | grep '^clustoapi_requests_total.*route=./__version__.,status=.200.' | cut -d' ' -f1
+    clustoapi_requests_total{method="GET",route="/__version__",status="200"}
+
+"""
+
+    return bottle.HTTPResponse(
+        metrics.render(metrics.REGISTRY.collect()),
+        200,
+        content_type=metrics.CONTENT_TYPE
+    )
+
+
+@root_app.get('/__profile__')
+def get_profile():
+    """
+Returns the stacks sampled in this worker since the last reset, in the folded
+stack format flame graph tools accept, at the ``sample_rate`` setting. Only
+available to ``admin_hosts``.
+
+.. code:: bash
+
+    $ ${get} -o /dev/null ${server_url}/__profile__
+    HTTP: 200
+    Content-type: text/plain
+
+Feed it to a flame graph tool, for example:
+
+.. code:: bash
+
+    curl -s http://localhost:9664/__profile__ | flamegraph.pl > profile.svg
+
+"""
+
+    if not _is_admin():
+        return util.dumps('Only admin hosts can inspect the profile', 403)
+
+    return bottle.HTTPResponse(
+        sampler.SAMPLER.folded(),
+        200,
+        content_type='text/plain'
+    )
+
+
+@root_app.delete('/__profile__')
+def reset_profile():
+    """
+Discards the stacks sampled in this worker so far. Only available to
+``admin_hosts``.
+
+.. code:: bash
+
+    $ ${delete} ${server_url}/__profile__
+    HTTP: 204
+    Content-type:
+
+"""
+
+    if not _is_admin():
+        return util.dumps('Only admin hosts can reset the profile', 403)
+
+    sampler.SAMPLER.reset()
+    return bottle.HTTPResponse('', status=204)
+
+
+def _is_admin():
+    """
+Returns whether the current request comes from one of the ``admin_hosts``
+"""
+
+    return bottle.request.environ.get('REMOTE_ADDR') in root_app.config.get('clustoapi.admin_hosts', ())
+
+
+@root_app.get('/__memory__')
+def get_memory():
+    """
+Returns the memory usage of this worker. Only available to ``admin_hosts``.
+
+For every route it returns the number of requests, the duration of its
+slowest request in milliseconds, the memory that request needed and the
+most any request needed, in bytes, slowest routes first. The memory needed
+is measured with ``tracemalloc`` while it's tracing, or as the growth of the
+maximum resident set size (``maxrss``) otherwise:
+
+.. code:: bash
+
+    $ ${get} -o /dev/null ${server_url}/__version__
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${get} -d 'limit=0' ${server_url}/__memory__ | grep -e '.tracing.:' -e '.route.: .GET /__version__.'
+            "route": "GET /__version__",
+        "tracing": false
+
+With ``snapshot`` it returns the top allocation sites of that snapshot, and
+with ``snapshot`` and ``base`` the sites that grew the most between the two.
+``limit`` is the number of sites (and routes) to return, ``20`` by default.
+Snapshots need ``tracemalloc``, see ``post_memory``:
+
+.. code:: bash
+
+    $ ${get} -d 'snapshot=1' ${server_url}/__memory__
+    "Snapshot 1 does not exist"
+    HTTP: 404
+    Content-type: application/json
+
+"""
+
+    if not _is_admin():
+        return util.dumps('Only admin hosts can inspect memory', 403)
+
+    try:
+        limit = int(bottle.request.params.get('limit', memory.TOP_SITES))
+        snapshot = bottle.request.params.get('snapshot')
+        base = bottle.request.params.get('base')
+        snapshot = int(snapshot) if snapshot else None
+        base = int(base) if base else None
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+
+    if snapshot is None:
+        result = memory.TRACKER.status()
+        if limit:
+            result['routes'] = result['routes'][:limit]
+        return util.dumps(result)
+
+    for _ in (snapshot, base):
+        if _ is not None and _ not in memory.TRACKER.snapshots:
+            return util.dumps('Snapshot %d does not exist' % (_,), 404)
+    if base is None:
+        return util.dumps(memory.TRACKER.top(snapshot, limit))
+    return util.dumps(memory.TRACKER.diff(snapshot, base, limit))
+
+
+@root_app.post('/__memory__')
+def post_memory():
+    """
+Controls memory tracing in this worker. Only available to ``admin_hosts``.
+The ``action`` parameter is one of:
+
+ *  ``start``: starts ``tracemalloc``, keeping ``frames`` frames per
+    allocation (``1`` by default)
+ *  ``snapshot``: takes a snapshot and returns its id along with its top
+    allocation sites
+ *  ``stop``: stops ``tracemalloc`` and discards all snapshots
+ *  ``reset``: clears the per-route statistics
+
+``start``, ``snapshot`` and ``stop`` return 501 if ``tracemalloc`` is not
+available.
+
+.. code:: bash
+
+    $ ${post} -d 'action=reset' ${server_url}/__memory__
+    "Route statistics cleared"
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${post} -d 'action=grow' ${server_url}/__memory__
+    "Unknown action grow, use one of start, snapshot, stop, reset"
+    HTTP: 400
+    Content-type: application/json
+
+A typical session, comparing the allocations before and after a listing:
+
+.. code:: bash
+
+    curl -X POST -d action=start http://localhost:9664/__memory__
+    curl -X POST -d action=snapshot http://localhost:9664/__memory__
+    curl http://localhost:9664/entity/
+    curl -X POST -d action=snapshot http://localhost:9664/__memory__
+    curl -d snapshot=2 -d base=1 http://localhost:9664/__memory__
+
+"""
+
+    if not _is_admin():
+        return util.dumps('Only admin hosts can control memory tracing', 403)
+
+    actions = ('start', 'snapshot', 'stop', 'reset')
+    action = bottle.request.params.get('action')
+    if action not in actions:
+        return util.dumps('Unknown action %s, use one of %s' % (action, ', '.join(actions)), 400)
+
+    if action == 'reset':
+        memory.TRACKER.reset()
+        return util.dumps('Route statistics cleared')
+
+    if memory.tracemalloc is None:
+        return util.dumps('tracemalloc is not available', 501)
+
+    if action == 'start':
+        try:
+            frames = int(bottle.request.params.get('frames', 1))
+        except ValueError as ve:
+            return util.dumps('%s' % (ve,), 400)
+        memory.TRACKER.start(frames)
+        return util.dumps('Tracing started')
+
+    if action == 'stop':
+        memory.TRACKER.stop()
+        return util.dumps('Tracing stopped')
+
+    if not memory.tracing():
+        return util.dumps('Tracing is not started', 409)
+    snapshot = memory.TRACKER.snapshot()
+    return util.dumps({'snapshot': snapshot, 'top': memory.TRACKER.top(snapshot)}, 201)
+
+
+@root_app.get('/__hotkeys__')
+def get_hotkeys():
+    """
+Returns the most requested entity names, pools and attribute keys (as
+``key`` or ``key:subkey``) in this worker. Only available to
+``admin_hosts``. ``count`` is never under the real number of requests and
+over it by at most ``error``, ``total`` is the number of requests of each
+kind. ``limit`` is the number of keys to return, ``20`` by default:
+
+.. code:: bash
+
+    $ ${delete} -o /dev/null ${server_url}/__hotkeys__
+    HTTP: 204
+    Content-type:
+
+    $ ${get} -o /dev/null ${server_url}/by-name/testserver1
+    HTTP: 200
+    Content-type: application/json
+
+    $ ${get} -d 'limit=1' ${server_url}/__hotkeys__
+    {
+        "attribute": {
+            "top": [],
+            "total": 0
+        },
+        "entity": {
+            "top": [
+                {
+                    "count": 1,
+                    "error": 0,
+                    "key": "testserver1"
+                }
+            ],
+            "total": 1
+        },
+        "pool": {
+            "top": [],
+            "total": 0
+        }
+    }
+    HTTP: 200
+    Content-type: application/json
+
+"""
+
+    if not _is_admin():
+        return util.dumps('Only admin hosts can inspect hot keys', 403)
+
+    try:
+        limit = int(bottle.request.params.get('limit', 20))
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+
+    return util.dumps(hotkeys.TRACKER.top(limit or None))
+
+
+@root_app.delete('/__hotkeys__')
+def reset_hotkeys():
+    """
+Discards the hot key counts of this worker. Only available to
+``admin_hosts``.
+
+.. code:: bash
+
+    $ ${delete} ${server_url}/__hotkeys__
+    HTTP: 204
+    Content-type:
+
+"""
+
+    if not _is_admin():
+        return util.dumps('Only admin hosts can reset hot keys', 403)
+
+    hotkeys.TRACKER.reset()
+    return bottle.HTTPResponse('', status=204)
+
+
 @root_app.get('/')
 @root_app.get('/__doc__')
 def build_docs(module=__name__):
@@ -241,19 +669,19 @@ each mounted application, the main __doc__ endpoint, or on the main endpoint:
 
 .. code:: bash
 
-    $ ${get} ${server_url}/__doc__
-    <?xml version="1.0" encoding="utf-8" ?>
-    ...
+    $ ${get} ${server_url}/__doc__ | tail -n 2
     HTTP: 200
     Content-type: text/html; charset=UTF-8
 
+    $ curl -s ${server_url}/__doc__ | sed -n 1p
+    <?xml version="1.0" encoding="utf-8" ?>
+
 If you pass the ``Accept`` headers and specify ``text/plain``, you should get
 the plain text version back
 
 .. code:: bash
 
-    $ ${get} -H 'Accept: text/plain' ${server_url}/__doc__
-    ...
+    $ ${get} -H 'Accept: text/plain' ${server_url}/__doc__ | tail -n 2
     HTTP: 200
     Content-type: text/plain
 
@@ -525,6 +953,13 @@ Examples:
     HTTP: 200
     Content-type: application/json
 
+Where the time went can be seen in the ``Server-Timing`` header:
+
+.. code:: bash
+
+    $ ${get_i} -H 'Clusto-Timing: true' -d 'pool=multipool' ${server_url}/from-pools | grep '^Server-Timing' | sed 's/dur=[0-9.]*/dur=X/g'
+    Server-Timing: routing;dur=X, lookup;dur=X, serialize;dur=X, encode;dur=X, db;dur=X, app;dur=X
+
 """
 
     pools = bottle.request.params.getall('pool')
@@ -533,6 +968,7 @@ Examples:
     types = bottle.request.params.getall('type')
     drivers = bottle.request.params.getall('driver')
     children = bottle.request.params.get('children', default=True, type=bool)
+    hotkeys.hit('pool', *pools)
     mode = bottle.request.headers.get('Clusto-Mode', default='compact')
     headers = {}
 
@@ -541,9 +977,10 @@ Examples:
         current = int(bottle.request.headers.get('Clusto-Page', default='0'))
         per = int(bottle.request.headers.get('Clusto-Per-Page', default='50'))
 
-        ents = clusto.get_from_pools(
-            pools, clusto_types=types, clusto_drivers=drivers, search_children=children
-        )
+        with timing.phase('lookup'):
+            ents = clusto.get_from_pools(
+                pools, clusto_types=types, clusto_drivers=drivers, search_children=children
+            )
         results = []
         if current:
             ents, total = util.page(list(ents), current=current, per=per)
@@ -625,6 +1062,13 @@ Examples:
     HTTP: 412
     Content-type: application/json
 
+Every response carries the number of SQL statements it took to build it:
+
+.. code:: bash
+
+    $ ${head} ${server_url}/by-name/testserver1 | grep '^Clusto-Query-Count'
+    Clusto-Query-Count: 6
+
 """
 
     driver = bottle.request.params.get('driver', default=None)
@@ -827,11 +1271,13 @@ Examples:
 
     if not kwargs.get('key'):
         return util.dumps('Provide a key to use get_by_attr', 412)
+    hotkeys.hit('attribute', ':'.join(kwargs[_] for _ in ('key', 'subkey') if _ in kwargs))
 
     mode = bottle.request.headers.get('Clusto-Mode', default='compact')
 
     try:
-        ents = clusto.get_by_attr(**kwargs)
+        with timing.phase('lookup'):
+            ents = clusto.get_by_attr(**kwargs)
         results = []
         for ent in ents:
             results.append(util.show(ent, mode))
@@ -844,6 +1290,284 @@ Examples:
         return util.dumps('%s' % (e,), 500)
 
 
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+# Request environment every operation of a batch inherits from the batch
+BATCH_ENVIRON = (
+    'REMOTE_ADDR', 'SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL', 'HTTP_HOST',
+    'wsgi.errors', 'wsgi.multiprocess', 'wsgi.multithread', 'wsgi.run_once', 'wsgi.url_scheme', 'wsgi.version',
+)
+
+# Response state a nested request overwrites
+RESPONSE_STATE = ('_status_line', '_status_code', '_cookies', '_headers', 'body')
+
+
+def _batch_operations(operations, limit):
+    """
+Validates the operations of a batch before any of them runs. Returns them
+as ``(method, path, query string, body, content type, headers)`` tuples,
+raises ``ValueError`` with what is wrong otherwise.
+"""
+
+    if not isinstance(operations, list) or not operations:
+        raise ValueError('Provide a JSON list of operations')
+    if len(operations) > limit:
+        raise ValueError('A batch can have at most %d operations, got %d' % (limit, len(operations)))
+
+    results = []
+    for index, op in enumerate(operations):
+        if not isinstance(op, dict) or not isinstance(op.get('path'), basestring):
+            raise ValueError('Operation %d: provide at least a "path"' % (index,))
+        method = op.get('method', 'GET')
+        method = method.upper() if isinstance(method, basestring) else method
+        if method not in BATCH_METHODS:
+            raise ValueError('Operation %d: "method" must be one of %s' % (index, ', '.join(BATCH_METHODS)))
+        path, _, query = op['path'].encode('utf-8').partition('?')
+        if not path.startswith('/'):
+            raise ValueError('Operation %d: "path" must be absolute' % (index,))
+        if path.rstrip('/') == '/batch':
+            raise ValueError('Operation %d: batches can not be nested' % (index,))
+        headers = op.get('headers', {})
+        if not isinstance(headers, dict):
+            raise ValueError('Operation %d: "headers" must be an object' % (index,))
+
+        params = op.get('params', [])
+        params = sorted(params.items()) if isinstance(params, dict) else params
+        pairs = []
+        try:
+            for k, v in params:
+                for value in v if isinstance(v, list) else [v]:
+                    pairs.append((unicode(k).encode('utf-8'), unicode(value).encode('utf-8')))
+        except (TypeError, ValueError):
+            raise ValueError('Operation %d: "params" must be an object or a list of pairs' % (index,))
+
+        body = content_type = None
+        if 'json' in op:
+            body, content_type = json.dumps(op['json']), 'application/json'
+        elif method != 'GET':
+            body, content_type = urllib.urlencode(pairs), 'application/x-www-form-urlencoded'
+            pairs = []
+        query = '&'.join(_ for _ in (query, urllib.urlencode(pairs)) if _)
+        results.append((method, path, query, body, content_type, headers))
+    return results
+
+
+def _batch_call(environ, operation):
+    """
+Runs one operation of a batch through the whole application, in the current
+thread and transaction. Returns ``(status, headers, body, environ)``, the
+nested request's environment carrying its query log.
+"""
+
+    method, path, query, body, content_type, headers = operation
+    nested = dict((k, environ[k]) for k in BATCH_ENVIRON if k in environ)
+    nested.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body or '')),
+        'wsgi.input': io.BytesIO(body or ''),
+        capture.SKIP_KEY: True,
+    })
+    if content_type is not None:
+        nested['CONTENT_TYPE'] = content_type
+    for header, value in headers.items():
+        nested['HTTP_%s' % (header.upper().replace('-', '_'),)] = unicode(value).encode('utf-8')
+
+    started = []
+
+    def start_response(status, headerlist, exc_info=None):
+        started[:] = [status, headerlist]
+
+    output = root_app(nested, start_response)
+    try:
+        data = ''.join(output)
+    finally:
+        if hasattr(output, 'close'):
+            output.close()
+    status, headerlist = started
+    return int(status.split()[0]), dict(headerlist), data, nested
+
+
+def _batch_result(status, headers, data):
+    "Returns what a batch reports about one of its operations"
+
+    result = {'status': status, 'body': None}
+    if headers.get('Content-Type', '').startswith('application/json'):
+        result['body'] = json.loads(data)
+    elif data:
+        result['body'] = data.decode('utf-8', 'replace')
+    if 'Warnings' in headers:
+        result['warnings'] = headers['Warnings']
+    return result
+
+
+@root_app.post('/batch')
+def post_batch():
+    """
+Runs a list of operations, in order, in a single database transaction that
+is committed once at the end, so provisioning a host (creating it, adding it
+to pools, setting its attributes, allocating it resources) takes a single
+round trip and either happens completely or not at all.
+
+The request body is a JSON list of operations, each of them an object with:
+
+* Required: the ``path`` of any of the other routes, like
+  ``/entity/basicserver`` or ``/attribute/server1``, optionally with a query
+  string
+* Optional: the HTTP ``method``, ``GET`` by default, ``POST``, ``PUT`` or
+  ``DELETE``
+* Optional: the ``params`` of the route, an object (a list as value repeats
+  the parameter) or a list of ``[key, value]`` pairs
+* Optional: a ``json`` body instead of ``params``, for the routes taking one
+* Optional: request ``headers``, like ``Clusto-Mode``
+
+Operations see the changes of the previous ones. The batch stops at the
+first operation failing (returning ``HTTP: 400`` or higher), everything done
+by the batch is rolled back and the response carries the status of that
+operation. Either way it returns whether the batch was ``committed``, the
+``status``, ``body`` and ``warnings``, if any, of every operation that ran
+and the index of the operation that ``failed``. Batches can have up to
+``batch_limit`` operations.
+
+Examples:
+
+.. code:: bash
+
+    $ ${post} -H 'Content-Type: application/json' -d '${sample_batch}' ${server_url}/batch
+    {
+        "committed": true,
+        "results": [
+            {
+                "body": [
+                    "/basicserver/batchserver1"
+                ],
+                "status": 201
+            },
+            {
+                "body": {
+                    "action": "insert",
+                    "changed": [
+                        "/basicserver/batchserver1"
+                    ],
+                    "count": 1,
+                    "driver": "pool",
+                    "name": "emptypool",
+                    "unchanged": []
+                },
+                "status": 200
+            },
+            {
+                "body": [
+                    {
+                        "datatype": "string",
+                        "key": "owner",
+                        "number": null,
+                        "subkey": null,
+                        "value": "ops"
+                    }
+                ],
+                "status": 201
+            },
+            {
+                "body": "/basicserver/s01",
+                "status": 201
+            }
+        ]
+    }
+    HTTP: 200
+    Content-type: application/json
+
+When an operation fails nothing is changed, not even by the operations that
+succeeded before it:
+
+.. code:: bash
+
+    $ ${post} -H 'Content-Type: application/json' -d '${sample_batch_failure}' ${server_url}/batch
+    {
+        "committed": false,
+        "failed": 1,
+        "results": [
+            {
+                "body": [
+                    "/basicserver/batchserver2"
+                ],
+                "status": 201
+            },
+            {
+                "body": "Object \"nopool\" not found (nopool does not exist.)",
+                "status": 404
+            }
+        ]
+    }
+    HTTP: 404
+    Content-type: application/json
+
+    $ ${get} -o /dev/null ${server_url}/by-name/batchserver2
+    HTTP: 404
+    Content-type: application/json
+
+    $ ${post} -H 'Content-Type: application/json' -d '[{"path": "/batch"}]' ${server_url}/batch
+    "Operation 0: batches can not be nested"
+    HTTP: 400
+    Content-type: application/json
+
+"""
+
+    try:
+        operations = _batch_operations(
+            bottle.request.json, root_app.config.get('clustoapi.batch_limit', BATCH_LIMIT)
+        )
+    except ValueError as ve:
+        return util.dumps('%s' % (ve,), 400)
+
+    environ = bottle.request.environ
+    querylog = queries.current()
+    state = dict((_, getattr(bottle.response, _)) for _ in RESPONSE_STATE)
+    results = []
+    failed = error = None
+    committed = False
+    clusto.begin_transaction()
+    try:
+        for index, operation in enumerate(operations):
+            status, headers, data, nested = _batch_call(environ, operation)
+            results.append(_batch_result(status, headers, data))
+            nested_log = nested.get(queries.ENVIRON_KEY)
+            if querylog is not None and nested_log is not None:
+                querylog.count += nested_log.count
+                querylog.time += nested_log.time
+            # An operation may have rolled the transaction back and still succeeded
+            if status >= 400 or not clusto.SESSION.is_active:
+                failed = index
+                break
+        else:
+            bottle.request.bind(environ)
+            try:
+                clusto.commit()
+                committed = True
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                error = e
+    finally:
+        # Nested requests rebound the thread's request and response
+        bottle.request.bind(environ)
+        for name, value in state.items():
+            setattr(bottle.response, name, value)
+        if sampler.SAMPLER.hz:
+            sampler.SAMPLER.enter()
+        if not committed:
+            if clusto.SESSION.is_active:
+                clusto.SESSION.rollback()
+            clusto.clear()
+
+    if error is not None:
+        return util.dumps('The batch could not be committed: %s' % (error,), 409)
+    if failed is None:
+        return util.dumps({'committed': True, 'results': results})
+    return util.dumps(
+        {'committed': False, 'failed': failed, 'results': results}, results[failed]['status']
+    )
+
+
 def _configure(config={}, configfile=None, init_data={}):
     """
 Configure the root app
@@ -929,11 +1653,92 @@ Configure the root app
             cfg, 'apiserver.response_headers', default={}, datatype=dict
         )
     )
+    metrics_enabled = config.get(
+        'metrics',
+        script_helper.get_conf(
+            cfg, 'apiserver.metrics', default=True, datatype=bool
+        )
+    )
+    metrics_dir = config.get(
+        'metrics_dir',
+        script_helper.get_conf(
+            cfg, 'apiserver.metrics_dir', default=None
+        )
+    )
+    query_repeat_threshold = config.get(
+        'query_repeat_threshold',
+        script_helper.get_conf(
+            cfg, 'apiserver.query_repeat_threshold', default=20, datatype=int
+        )
+    )
+    server_timing = config.get(
+        'server_timing',
+        script_helper.get_conf(
+            cfg, 'apiserver.server_timing', default=False, datatype=bool
+        )
+    )
+    admin_hosts = config.get(
+        'admin_hosts',
+        script_helper.get_conf(
+            cfg, 'apiserver.admin_hosts', default=['127.0.0.1'], datatype=list
+        )
+    )
+    slow_request_threshold = config.get(
+        'slow_request_threshold',
+        script_helper.get_conf(
+            cfg, 'apiserver.slow_request_threshold', default=None, datatype=float
+        )
+    )
+    profile_hosts = config.get(
+        'profile_hosts',
+        script_helper.get_conf(
+            cfg, 'apiserver.profile_hosts', default=[], datatype=list
+        )
+    )
+    profile_dir = config.get(
+        'profile_dir',
+        script_helper.get_conf(
+            cfg, 'apiserver.profile_dir', default=None
+        )
+    )
+    sample_rate = config.get(
+        'sample_rate',
+        script_helper.get_conf(
+            cfg, 'apiserver.sample_rate', default=sampler.SAMPLE_RATE, datatype=int
+        )
+    )
+    hotkeys_capacity = config.get(
+        'hotkeys_capacity',
+        script_helper.get_conf(
+            cfg, 'apiserver.hotkeys_capacity', default=hotkeys.CAPACITY, datatype=int
+        )
+    )
+
+    capture_file = config.get(
+        'capture_file',
+        script_helper.get_conf(
+            cfg, 'apiserver.capture_file', default=None
+        )
+    )
+    batch_limit = config.get(
+        'batch_limit',
+        script_helper.get_conf(
+            cfg, 'apiserver.batch_limit', default=BATCH_LIMIT, datatype=int
+        )
+    )
+    max_body = config.get(
+        'max_body',
+        script_helper.get_conf(
+            cfg, 'apiserver.max_body', default=MAX_BODY, datatype=int
+        )
+    )
 
     root_app.route('/__doc__', 'GET', functools.partial(build_docs))
+    instrumented = {'': root_app}
     for mount_point, cls in mount_apps.items():
         module = importlib.import_module(cls)
         root_app.mount(mount_point, module.app)
+        instrumented[mount_point] = module.app
 
         # Documentation endpoints
         module.app.route('/__doc__', 'GET', functools.partial(build_docs, cls))
@@ -943,6 +1748,25 @@ Configure the root app
         module.app.route('/', 'OPTIONS', functools.partial(options))
         module.app.route('/<url:re:.+>', 'OPTIONS', functools.partial(options))
 
+    queries.install(instrumented, threshold=query_repeat_threshold)
+    if metrics_enabled:
+        metrics.install(instrumented, directory=metrics_dir)
+    timing.install(
+        root_app, instrumented, enabled=server_timing, admin_hosts=admin_hosts,
+        record=slow_request_threshold is not None
+    )
+    if slow_request_threshold is not None:
+        slowlog.install(instrumented, slow_request_threshold)
+    profiling.install(instrumented, hosts=profile_hosts, directory=profile_dir)
+    sampler.install(root_app, hz=sample_rate)
+    memory.install(instrumented)
+    if capture_file is not None:
+        capture.install(instrumented, capture_file)
+    hotkeys.TRACKER.configure(hotkeys_capacity)
+    root_app.config['clustoapi.admin_hosts'] = admin_hosts
+    root_app.config['clustoapi.batch_limit'] = batch_limit
+    bottle.BaseRequest.MEMFILE_MAX = max_body
+
     @root_app.hook('before_request')
     def enable_response_headers():
         for header, value in response_headers.items():
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Slow request log. Every request that takes longer than
+``apiserver.slow_request_threshold`` seconds produces one structured (JSON)
+record on the ``clustoapi.slowlog`` logger with the route, its normalized
+parameters, the ``Clusto-Mode`` header, the number of results, the most
+expensive SQL statements and the time spent in each phase.
+
+Records are handed off to a background thread, so a slow log handler never
+makes a slow request any slower. If the thread falls behind, records are
+dropped rather than queued without bounds.
+"""
+
+import bottle
+from clustoapi import queries
+from clustoapi import timing
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+RESULTS_KEY = 'clustoapi.results'
+MAX_VALUES = 10
+TOP_STATEMENTS = 5
+
+
+class Writer(object):
+    """
+Hands records over to a daemon thread that does the actual logging. The
+thread is (re)started lazily so forked workers get their own.
+"""
+
+    def __init__(self, maxsize=1000):
+        self.queue = Queue.Queue(maxsize)
+        self.pid = None
+        self.dropped = 0
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            log.warning('slow request %s', json.dumps(record, sort_keys=True))
+
+    def put(self, record):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='clustoapi-slowlog')
+            thread.daemon = True
+            thread.start()
+        if self.dropped:
+            record['dropped'] = self.dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except Queue.Full:
+            self.dropped += 1
+
+
+WRITER = Writer()
+
+
+def _normalize(params):
+    "Sorted, de-duplicated parameter values, long lists are cut short"
+
+    result = {}
+    for key in params.keys():
+        values = sorted(set(params.getall(key)))
+        if len(values) > MAX_VALUES:
+            values = values[:MAX_VALUES] + ['(%d more)' % (len(values) - MAX_VALUES,)]
+        result[key] = values
+    return result
+
+
+def record(route, args, status, elapsed):
+    "Builds the slow log record for the request being handled"
+
+    request = bottle.request
+    environ = request.environ
+    result = {
+        'method': route.method,
+        'route': route.rule,
+        'path': request.path,
+        'args': args,
+        'params': _normalize(request.params),
+        'mode': request.headers.get('Clusto-Mode'),
+        'status': status,
+        'results': environ.get(RESULTS_KEY),
+        'duration': round(elapsed * 1000, 3),
+    }
+    timer = environ.get(timing.ENVIRON_KEY)
+    if timer is not None:
+        result['phases'] = dict((k, round(v * 1000, 3)) for k, v in timer.phases.items())
+    querylog = environ.get(queries.ENVIRON_KEY)
+    if querylog is not None:
+        result['queries'] = querylog.count
+        result['db'] = round(querylog.time * 1000, 3)
+        result['statements'] = [
+            {'duration': round(seconds * 1000, 3), 'count': count, 'statement': shape}
+            for seconds, count, shape in querylog.top(TOP_STATEMENTS)
+        ]
+    return result
+
+
+class Plugin(object):
+    """
+Bottle plugin that times every request and queues a record for those
+slower than ``threshold`` seconds.
+"""
+
+    name = 'slowlog'
+    api = 2
+
+    def __init__(self, prefix='', threshold=1.0):
+        self.prefix = prefix.rstrip('/')
+        self.threshold = threshold
+
+    def apply(self, callback, route):
+        threshold = self.threshold
+        prefix = self.prefix
+
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            status = 500
+            try:
+                response = callback(*args, **kwargs)
+                if isinstance(response, bottle.HTTPResponse):
+                    status = response.status_code
+                else:
+                    status = bottle.response.status_code
+                return response
+            except bottle.HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                elapsed = time.time() - start
+                if elapsed > threshold:
+                    entry = record(route, kwargs, status, elapsed)
+                    entry['route'] = prefix + entry['route']
+                    WRITER.put(entry)
+
+        return wrapper
+
+
+def install(apps, threshold):
+    """
+Installs the slow log plugin in the given ``{prefix: bottle app}`` mapping.
+Safe to call more than once.
+"""
+
+    for prefix, app in apps.items():
+        app.uninstall(Plugin.name)
+        app.install(Plugin(prefix, threshold))
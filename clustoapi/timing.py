@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Per-request phase timing, reported in the standard ``Server-Timing`` response
+header. Phases are recorded where the work actually happens:
+
+ *  ``routing``: from the moment the request is received until the route
+    callback is invoked
+ *  ``lookup``: fetching objects from clusto (``util.get`` and the listing
+    queries)
+ *  ``serialize``: turning clusto objects into plain data (``util.show``)
+ *  ``encode``: encoding that data as JSON (``util.dumps``)
+
+along with ``db`` (the SQL time measured by the ``queries`` module) and
+``app`` (the whole callback). The time spent writing the body to the socket
+is not known until after the headers are sent, so it can't be reported here.
+
+Timing is off by default, it is enabled for every request with
+``apiserver.server_timing`` or for a single request by sending the
+``Clusto-Timing: true`` header from one of the ``apiserver.admin_hosts``.
+"""
+
+import bottle
+from clustoapi import queries
+import time
+
+
+ENVIRON_KEY = 'clustoapi.timer'
+START_KEY = 'clustoapi.start'
+PHASES = ('routing', 'lookup', 'serialize', 'encode')
+
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_PHASE = _NoPhase()
+
+
+class _Phase(object):
+
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.active.add(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        timer = self.timer
+        timer.phases[self.name] = timer.phases.get(self.name, 0.0) + time.time() - self.start
+        timer.active.discard(self.name)
+        return False
+
+
+class Timer(object):
+    """
+Accumulates the time spent in each phase of a single request. Nested calls
+to the same phase (``util.get`` from within a lookup, for instance) are only
+counted once.
+"""
+
+    def __init__(self):
+        self.phases = {}
+        self.active = set()
+
+    def phase(self, name):
+        if name in self.active:
+            return NO_PHASE
+        return _Phase(self, name)
+
+    def header(self, extra=()):
+        "Returns the value for the ``Server-Timing`` header, durations in milliseconds"
+
+        entries = [(_, self.phases[_]) for _ in PHASES if _ in self.phases]
+        entries.extend(extra)
+        return ', '.join('%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in entries)
+
+
+def current():
+    "Returns the timer of the request being handled, if timing is enabled for it"
+
+    try:
+        return bottle.request.environ.get(ENVIRON_KEY)
+    except RuntimeError:
+        return None
+
+
+def phase(name):
+    """
+Returns a context manager that adds the time spent in its block to the given
+phase of the current request. Does nothing when timing is disabled.
+"""
+
+    timer = current()
+    if timer is None:
+        return NO_PHASE
+    return timer.phase(name)
+
+
+def _stamp():
+    bottle.request.environ[START_KEY] = time.time()
+
+
+class Plugin(object):
+    """
+Bottle plugin that enables phase timing for a request when configured (or
+asked to) and adds the ``Server-Timing`` header to its response.
+"""
+
+    name = 'timing'
+    api = 2
+
+    def __init__(self, enabled=False, admin_hosts=(), record=False):
+        self.enabled = enabled
+        self.admin_hosts = admin_hosts
+        self.record = record
+
+    def wanted(self):
+        if self.enabled:
+            return True
+        request = bottle.request
+        return request.headers.get('Clusto-Timing', '').lower() == 'true' \
+            and request.environ.get('REMOTE_ADDR') in self.admin_hosts
+
+    def apply(self, callback, route):
+
+        def wrapper(*args, **kwargs):
+            header = self.wanted()
+            if not header and not self.record:
+                return callback(*args, **kwargs)
+            environ = bottle.request.environ
+            timer = environ[ENVIRON_KEY] = Timer()
+            start = time.time()
+            if START_KEY in environ:
+                timer.phases['routing'] = start - environ[START_KEY]
+            response = None
+            try:
+                response = callback(*args, **kwargs)
+                return response
+            except bottle.HTTPResponse as e:
+                response = e
+                raise
+            finally:
+                if header:
+                    extra = [('app', time.time() - start)]
+                    querylog = environ.get(queries.ENVIRON_KEY)
+                    if querylog is not None:
+                        extra.insert(0, ('db', querylog.time))
+                    if not isinstance(response, bottle.HTTPResponse):
+                        response = bottle.response
+                    response.set_header('Server-Timing', timer.header(extra))
+
+        return wrapper
+
+
+def install(root, apps, enabled=False, admin_hosts=(), record=False):
+    """
+Installs the timing plugin in the given ``{prefix: bottle app}`` mapping and
+stamps the arrival time of every request on the ``root`` application. With
+``record`` the phases of every request are recorded (for the slow log) even
+when no header is returned. Safe to call more than once.
+"""
+
+    root.remove_hook('before_request', _stamp)
+    root.add_hook('before_request', _stamp)
+    for prefix, app in apps.items():
+        app.uninstall(Plugin.name)
+        app.install(Plugin(enabled, admin_hosts, record))
@@ -6,10 +6,18 @@
 
 import bottle
 import clusto
+from clusto.drivers.base import Driver
+from clusto.schema import Entity
+from clustoapi import hotkeys
+from clustoapi import timing
 import json
 import datetime
 
 
+# Names per lookup query, SQLite takes at most 999 bound parameters
+NAMES_PER_QUERY = 500
+
+
 def get(name, driver=None):
     """
 Tries to fetch a clusto object from a given name, optionally validating
@@ -27,11 +35,13 @@ the driver given. Returns:
         status = 412
         msg = u'The driver "%s" is not a valid driver' % (driver,)
     else:
+        hotkeys.hit('entity', name)
         try:
-            if driver:
-                obj = clusto.get_by_name(name, assert_driver=clusto.driverlist[driver])
-            else:
-                obj = clusto.get_by_name(name)
+            with timing.phase('lookup'):
+                if driver:
+                    obj = clusto.get_by_name(name, assert_driver=clusto.driverlist[driver])
+                else:
+                    obj = clusto.get_by_name(name)
 
         except LookupError as le:
             status = 404
@@ -44,6 +54,23 @@ the driver given. Returns:
     return obj, status, msg
 
 
+def get_by_names(names):
+    """
+Returns a ``{name: clusto object}`` dictionary of those ``names`` that exist,
+looking them up in as few queries as the database allows. Names that don't
+exist are simply not in it.
+"""
+
+    unique = sorted(set(unicode(_) for _ in names))
+    found = {}
+    with timing.phase('lookup'):
+        for start in range(0, len(unique), NAMES_PER_QUERY):
+            chunk = unique[start:start + NAMES_PER_QUERY]
+            for entity in Entity.query().filter(Entity.name.in_(chunk)):
+                found[entity.name] = Driver(entity)
+    return found
+
+
 def dumps(obj, code=200, headers={}):
     """
 Dumps a given object as a JSON string in an HTTP Response object.
@@ -61,14 +88,34 @@ Will circumvent pretty-printing if Clusto-Minify header is True.
         kwargs['indent'] = 4
         kwargs['separators'] = (',', ': ')
 
+    with timing.phase('encode'):
+        body = json.dumps(obj, **kwargs)
+    # Remember how many results went out, for the slow request log
+    bottle.request.environ['clustoapi.results'] = len(obj) if isinstance(obj, list) else None
+
     return bottle.HTTPResponse(
-        json.dumps(obj, **kwargs),
+        body,
         code,
         content_type='application/json',
         **headers
     )
 
 
+def return_minimal():
+    """
+Returns whether the client asked for minimal write responses, only what was
+written instead of the whole object, with ``Clusto-Return: minimal`` or
+``Prefer: return=minimal``, and the response headers acknowledging it.
+"""
+
+    if bottle.request.headers.get('Clusto-Return', '').lower() == 'minimal':
+        return True, {}
+    preferences = bottle.request.headers.get('Prefer', '').replace(';', ',').split(',')
+    if 'return=minimal' in [_.strip().lower() for _ in preferences]:
+        return True, {'Preference-Applied': 'return=minimal'}
+    return False, {}
+
+
 def unclusto(obj):
     """
 Convert an object to a representation that can be safely serialized into
@@ -131,7 +178,8 @@ Will return the expanded or compact representation of a given object
         )
         raise TypeError('{0} {1}'.format(mode_error, valid_mode_tip))
 
-    return valid_modes[mode]()
+    with timing.phase('serialize'):
+        return valid_modes[mode]()
 
 
 def page(ents, current=1, per=50):
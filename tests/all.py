@@ -14,6 +14,9 @@ def test_suites():
     for s in (
         suites.coding_style,
         suites.shell_docs,
+        suites.versioning,
+        suites.bodies,
+        suites.resources,
     ):
         allsuites.append(s.test_cases())
     alltests = unittest.TestSuite(allsuites)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Benchmarks for the clusto API server. These are not run as part of the test
+suite, every benchmark is a script with its own ``--help``:
+
+ *  ``inventory.py``: generates a synthetic inventory (datacenters, racks,
+    pools, servers, attributes and IP allocations) and bulk loads it into a
+    database
+ *  ``serve.py``: runs the API server against that database with a given
+    server adapter
+ *  ``scaling.py``: compares throughput and tail latency of every server
+    adapter over cheap, medium and heavy requests as concurrency grows
+ *  ``routes.py``: drives every read route (and optionally the write ones)
+    with configurable concurrency and reports latency percentiles,
+    throughput and SQL statements per request
+ *  ``allocation.py``: hammers a name manager and an IP manager with
+    concurrent allocators, reporting allocation rate, conflicts, retries,
+    lock wait and duplicates
+ *  ``serialization.py``: times ``util.unclusto``, ``util.show`` and
+    ``util.dumps`` by themselves, per operation
+ *  ``replay.py``: replays traffic captured with ``apiserver.capture_file``
+    and compares its latency per route with the recorded one
+ *  ``gate.py``: runs the two above and fails if they regressed against
+    ``baseline.json``
+"""
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Resource allocation under contention. ``N`` concurrent allocators hammer a
+single resource manager, the inventory's ``SimpleEntityNameManager``
+(``servernames``, creating a server per name) or one of its ``IPManager``
+(allocating IPs to existing servers), and every allocated IP is deallocated
+again afterwards, as concurrently. Per manager and concurrency it reports:
+
+ *  allocations (and deallocations) per second
+ *  conflicts: attempts that failed, by status; they are retried up to
+    ``--retries`` times with a random backoff, failures ran out of retries
+ *  retries per allocation
+ *  time in the database per allocation (from ``Server-Timing``) and lock
+    wait, estimated as how much longer than with a single allocator that
+    time got, since waiting on database locks happens inside the statements
+ *  duplicates: resources handed out more than once, according to the
+    responses and to the database itself
+
+Usage::
+
+    python tests/benchmarks/allocation.py --dsn sqlite:////tmp/bench.db --servers 1000 \\
+        --concurrency 1,4,16 --allocations 200 --json allocation.json
+"""
+
+import argparse
+import client
+import clusto
+from clusto.schema import ATTR_TABLE, ENTITY_TABLE
+import httplib
+import inventory
+import itertools
+import json
+import os
+import random
+import routes
+import serve
+import socket
+from sqlalchemy import and_, func, select
+import sys
+import struct
+import threading
+import time
+import urllib
+
+
+MANAGERS = ('name', 'ip')
+
+
+def call(host, port, method, url, params, timeout=60):
+    """
+Issues one request asking for ``Server-Timing``, returns ``(status, body,
+seconds, server timings)``. The status is ``None`` if it failed altogether.
+"""
+
+    body = urllib.urlencode(params)
+    headers = {'Clusto-Timing': 'true', 'Content-Type': 'application/x-www-form-urlencoded'}
+    start = time.time()
+    conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, url, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        timings = {}
+        for entry in (response.getheader('Server-Timing') or '').split(','):
+            name, _, duration = entry.strip().partition(';dur=')
+            if duration:
+                timings[name] = float(duration)
+        return response.status, data, time.time() - start, timings
+    except (httplib.HTTPException, IOError):
+        return None, None, time.time() - start, {}
+    finally:
+        conn.close()
+
+
+class Outcome(object):
+    "What the allocators of one run did"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.db = []
+        self.resources = []
+        self.conflicts = {}
+        self.retries = 0
+        self.failures = 0
+        self.elapsed = 0.0
+
+    def success(self, resource, latency, db):
+        with self.lock:
+            self.resources.append(resource)
+            self.latencies.append(latency)
+            if db is not None:
+                self.db.append(db)
+
+    def conflict(self, status):
+        with self.lock:
+            key = str(status)
+            self.conflicts[key] = self.conflicts.get(key, 0) + 1
+
+
+def hammer(count, concurrency, attempt, retries, backoff):
+    """
+Runs ``attempt(index)`` until it succeeds ``count`` times from
+``concurrency`` threads. ``attempt`` returns ``(status, resource, db ms)``,
+``resource`` being ``None`` when it failed.
+"""
+
+    outcome = Outcome()
+    counter = itertools.count()
+    last = count
+
+    def worker():
+        while True:
+            with outcome.lock:
+                index = next(counter)
+            if index >= last:
+                return
+            start = time.time()
+            for tries in range(retries + 1):
+                status, resource, db = attempt(index)
+                if resource is not None:
+                    outcome.success(resource, time.time() - start, db)
+                    break
+                outcome.conflict(status)
+                if tries < retries:
+                    with outcome.lock:
+                        outcome.retries += 1
+                    time.sleep(random.uniform(0, backoff * (tries + 1)))
+            else:
+                with outcome.lock:
+                    outcome.failures += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    outcome.elapsed = time.time() - start
+    return outcome
+
+
+def name_attempt(host, port, inv):
+    url = '/resourcemanager/simpleentitynamemanager/servernames'
+
+    def attempt(index):
+        status, body, _, timings = call(host, port, 'POST', url, [('driver', 'basicserver')])
+        if status != 201:
+            return status, None, None
+        return status, json.loads(body), timings.get('db')
+
+    return attempt
+
+
+def ip_attempt(host, port, inv, allocated):
+    url = '/resourcemanager/ipmanager/%s' % (inv.ipmanager_name(0),)
+    # Servers of the first datacenter, so the IPs come out of its manager
+    servers = [inv.server_name(_) for _ in range(0, inv.servers, inv.datacenters)]
+
+    def attempt(index):
+        server = servers[index % len(servers)]
+        status, body, _, timings = call(host, port, 'POST', url, [('object', server)])
+        if status != 201:
+            return status, None, None
+        value = json.loads(body)['value']
+        allocated.append((server, value))
+        return status, value, timings.get('db')
+
+    return attempt
+
+
+def ipstring(value):
+    "``IPManager`` stores IPs as integers shifted into the signed range"
+
+    return socket.inet_ntoa(struct.pack('!I', value + 2 ** 31))
+
+
+def deallocate_attempt(host, port, inv, allocated):
+    url = '/resourcemanager/ipmanager/%s' % (inv.ipmanager_name(0),)
+
+    def attempt(index):
+        server, value = allocated[index]
+        params = [('object', server), ('resource', ipstring(value))]
+        status, _, _, timings = call(host, port, 'DELETE', url, params)
+        if status != 204:
+            return status, None, None
+        return status, value, timings.get('db')
+
+    return attempt
+
+
+def stored_duplicates(manager):
+    "Resources the database itself holds more than once"
+
+    if manager == 'name':
+        column, table = ENTITY_TABLE.c.name, ENTITY_TABLE
+        where = ENTITY_TABLE.c.deleted_at_version == None  # noqa
+    else:
+        column, table = ATTR_TABLE.c.int_value, ATTR_TABLE
+        where = and_(
+            ATTR_TABLE.c.key == 'ip', ATTR_TABLE.c.subkey == None,  # noqa
+            ATTR_TABLE.c.deleted_at_version == None,  # noqa
+        )
+    query = select([column]).where(where).group_by(column).having(func.count() > 1)
+    return len(clusto.SESSION.get_bind(mapper=None).execute(query).fetchall())
+
+
+def summarize(manager, operation, concurrency, outcome, baseline_db=None):
+    "Returns the outcome as a dictionary, times in milliseconds"
+
+    done = len(outcome.resources)
+    db = sum(outcome.db) / len(outcome.db) if outcome.db else None
+    latencies = sorted(outcome.latencies)
+    result = {
+        'manager': manager,
+        'operation': operation,
+        'concurrency': concurrency,
+        'done': done,
+        'rate': round(done / outcome.elapsed, 2) if outcome.elapsed else None,
+        'conflicts': sum(outcome.conflicts.values()),
+        'statuses': outcome.conflicts,
+        'retries': round(float(outcome.retries) / done, 3) if done else None,
+        'failures': outcome.failures,
+        'db': round(db, 3) if db is not None else None,
+        'lock_wait': round(max(0.0, db - baseline_db), 3) if db is not None and baseline_db is not None else None,
+    }
+    if operation == 'allocate':
+        result['duplicates'] = done - len(set(json.dumps(_) for _ in outcome.resources))
+    for pct in (50, 99):
+        value = client.percentile(latencies, pct)
+        result['p%d' % (pct,)] = round(value * 1000, 3) if value is not None else None
+    return result
+
+
+def run(args, inv, host, port, manager, levels):
+    "Runs every concurrency level for one manager"
+
+    results = []
+    baseline = {}
+    for concurrency in levels:
+        allocated = []
+        if manager == 'name':
+            attempt = name_attempt(host, port, inv)
+        else:
+            attempt = ip_attempt(host, port, inv, allocated)
+        outcome = hammer(args.allocations, concurrency, attempt, args.retries, args.backoff)
+        summary = summarize(manager, 'allocate', concurrency, outcome, baseline.get('allocate'))
+        baseline.setdefault('allocate', summary['db'])
+        summary['stored_duplicates'] = stored_duplicates(manager)
+        results.append(summary)
+        sys.stderr.write('%s allocate x%d: %s/s, %d conflicts, %d duplicates\n' % (
+            manager, concurrency, summary['rate'], summary['conflicts'], summary['duplicates'],
+        ))
+
+        if allocated:
+            outcome = hammer(
+                len(allocated), concurrency, deallocate_attempt(host, port, inv, allocated), args.retries, args.backoff
+            )
+            summary = summarize(manager, 'deallocate', concurrency, outcome, baseline.get('deallocate'))
+            baseline.setdefault('deallocate', summary['db'])
+            results.append(summary)
+            sys.stderr.write('%s deallocate x%d: %s/s, %d conflicts\n' % (
+                manager, concurrency, summary['rate'], summary['conflicts'],
+            ))
+    return results
+
+
+COLUMNS = (
+    ('manager', '%s'), ('operation', '%s'), ('concurrency', '%d'), ('done', '%d'), ('rate', '%.1f'),
+    ('p50', '%.2f'), ('p99', '%.2f'), ('db', '%.2f'), ('lock_wait', '%.2f'), ('conflicts', '%d'),
+    ('retries', '%.2f'), ('failures', '%d'), ('duplicates', '%d'), ('stored_duplicates', '%d'),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks resource allocation under contention')
+    parser.add_argument('--dsn', required=True, help='benchmark database, e.g. sqlite:////tmp/bench.db')
+    parser.add_argument('--server', default='threaded', help='server adapter (default: %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='API server setting')
+    parser.add_argument('--manager', action='append', choices=MANAGERS, help='manager to benchmark (default: both)')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma separated allocators (default: %(default)s)')
+    parser.add_argument('--allocations', type=int, default=200, help='allocations per level (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=3, help='retries per allocation (default: %(default)s)')
+    parser.add_argument('--backoff', type=float, default=0.01, help='retry backoff in seconds (default: %(default)s)')
+    parser.add_argument('--json', help='also write the results to this file')
+    inventory.add_arguments(parser)
+    args = parser.parse_args()
+
+    inv = inventory.from_arguments(args)
+    routes.prepare(args.dsn, inv)
+    levels = [int(_) for _ in args.concurrency.split(',')]
+    process, port = serve.spawn(args.dsn, adapter=args.server, settings=args.set)
+    results = []
+    try:
+        for manager in args.manager or MANAGERS:
+            results.extend(run(args, inv, '127.0.0.1', port, manager, levels))
+    finally:
+        process.terminate()
+        process.wait()
+
+    print(client.table(results, COLUMNS))
+    duplicated = sum(_.get('duplicates', 0) + _.get('stored_duplicates', 0) for _ in results)
+    if duplicated:
+        print('')
+        print('Duplicate resources were handed out')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'inventory': vars(inv), 'server': args.server, 'results': results}, f, indent=4, sort_keys=True)
+            f.write(os.linesep)
+    return 1 if duplicated else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+HTTP load driver for the benchmarks. A ``Scenario`` describes one kind of
+request, ``run`` issues it a number of times from a number of threads and
+returns a ``Result`` with the latency of every request, the statuses and the
+``Clusto-Query-Count`` header the server returns.
+"""
+
+import httplib
+import itertools
+import math
+import threading
+import time
+import urllib
+
+
+class Scenario(object):
+    """
+A request to benchmark. ``path``, ``params`` and ``headers`` can be
+callables taking the index of the request, so a scenario can walk through
+different entities instead of hitting the same one over and over.
+"""
+
+    def __init__(self, name, path, params=(), method='GET', headers=None):
+        self.name = name
+        self.path = path
+        self.params = params
+        self.method = method
+        self.headers = headers or {}
+
+    def build(self, index):
+        "Returns ``(method, url, body, headers)`` for the ``index``-th request"
+
+        path = self.path(index) if callable(self.path) else self.path
+        params = self.params(index) if callable(self.params) else self.params
+        headers = self.headers(index) if callable(self.headers) else dict(self.headers)
+        query = urllib.urlencode(params)
+        if self.method in ('GET', 'HEAD', 'DELETE'):
+            return self.method, path + ('?' + query if query else ''), None, headers
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return self.method, path, query, headers
+
+
+def percentile(values, pct):
+    "Nearest rank percentile of an already sorted list"
+
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class Result(object):
+    "Outcome of running a scenario"
+
+    def __init__(self, scenario, concurrency):
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.latencies = []
+        self.queries = []
+        self.statuses = {}
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def add(self, status, latency, queries):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status is None or status >= 500:
+            self.errors += 1
+        if queries is not None:
+            self.queries.append(queries)
+
+    def summary(self):
+        "Returns the result as a dictionary, times in milliseconds"
+
+        latencies = sorted(self.latencies)
+        requests = len(latencies)
+        result = {
+            'scenario': self.scenario.name,
+            'concurrency': self.concurrency,
+            'requests': requests,
+            'errors': self.errors,
+            'statuses': dict((str(k), v) for k, v in self.statuses.items()),
+            'throughput': round(requests / self.elapsed, 2) if self.elapsed else None,
+            'mean': round(sum(latencies) / requests * 1000, 3) if requests else None,
+            'queries': round(float(sum(self.queries)) / len(self.queries), 2) if self.queries else None,
+        }
+        for pct in (50, 95, 99):
+            value = percentile(latencies, pct)
+            result['p%d' % (pct,)] = round(value * 1000, 3) if value is not None else None
+        return result
+
+
+def request(host, port, method, url, body=None, headers=None, timeout=60):
+    """
+Issues one request, returns ``(status, seconds, query count)``. The status
+is ``None`` if the request failed altogether.
+"""
+
+    start = time.time()
+    conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request(method, url, body, headers or {})
+        response = conn.getresponse()
+        response.read()
+        queries = response.getheader('Clusto-Query-Count')
+        return response.status, time.time() - start, int(queries) if queries is not None else None
+    except (httplib.HTTPException, IOError):
+        return None, time.time() - start, None
+    finally:
+        conn.close()
+
+
+def run(host, port, scenario, requests=100, concurrency=1, warmup=0):
+    """
+Issues ``requests`` requests of the given scenario from ``concurrency``
+threads, after ``warmup`` requests that are not measured.
+"""
+
+    for index in range(warmup):
+        method, url, body, headers = scenario.build(index)
+        request(host, port, method, url, body, headers)
+
+    result = Result(scenario, concurrency)
+    counter = itertools.count(warmup)
+    lock = threading.Lock()
+    last = warmup + requests
+
+    def worker():
+        while True:
+            with lock:
+                index = next(counter)
+            if index >= last:
+                return
+            method, url, body, headers = scenario.build(index)
+            status, latency, queries = request(host, port, method, url, body, headers)
+            with lock:
+                result.add(status, latency, queries)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed = time.time() - start
+    return result
+
+
+COLUMNS = (
+    ('scenario', '%s'), ('concurrency', '%d'), ('requests', '%d'), ('errors', '%d'),
+    ('throughput', '%.1f'), ('p50', '%.2f'), ('p95', '%.2f'), ('p99', '%.2f'), ('queries', '%.1f'),
+)
+
+
+def table(rows, columns=COLUMNS):
+    "Formats a list of summaries as a text table"
+
+    lines = [[name for name, _ in columns]]
+    for row in rows:
+        lines.append([fmt % (row[name],) if row.get(name) is not None else '-' for name, fmt in columns])
+    widths = [max(len(line[_]) for line in lines) for _ in range(len(columns))]
+    return '\n'.join(
+        '  '.join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width) in enumerate(zip(line, widths)))
+        for line in lines
+    )
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Benchmark regression gate. Runs the route scenarios and the serialization
+microbenchmarks with the settings stored in a baseline file, compares the
+results against it and exits with a non-zero status, printing what got worse,
+if anything went past its tolerance:
+
+ *  p50, p95 and p99 latency and errors of every route scenario
+ *  SQL statements per request of every route scenario, so an N+1 query
+    can't sneak back into a listing
+ *  the maximum resident set size of the API server after all the scenarios
+ *  time, peak traced memory and objects per operation of every
+    serialization benchmark
+
+A metric regresses when it's over ``baseline * ratio + slack``, see
+``TOLERANCES``, the ratios can be changed with ``--tolerance``. The baseline
+has to be recorded on the machine the gate runs on, timings don't travel:
+
+    python tests/benchmarks/gate.py --update
+    python tests/benchmarks/gate.py
+"""
+
+import argparse
+import client
+import httplib
+import inventory
+import json
+import os
+import routes
+import serve
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+SETTINGS = {
+    'inventory': {
+        'servers': 1000, 'datacenters': 2, 'servers_per_rack': 40, 'pools': 20,
+        'pools_per_server': 3, 'attrs_per_server': 8, 'seed': 0,
+    },
+    'server': 'threaded',
+    'concurrency': '1,4',
+    'requests': 50,
+    'warmup': 5,
+    'attrs': '10,100',
+    'min_time': 0.2,
+}
+
+# metric: (ratio, slack), slack in the unit of the metric
+TOLERANCES = {
+    'p50': (2.0, 1.0),
+    'p95': (2.0, 2.0),
+    'p99': (2.5, 5.0),
+    'queries': (1.0, 0.5),
+    'errors': (1.0, 0),
+    'maxrss': (1.5, 16 * 1024 * 1024),
+    'ns': (2.0, 500),
+    'bytes': (1.5, 1024),
+    'objects': (1.25, 1.0),
+}
+
+ROUTE_METRICS = ('p50', 'p95', 'p99', 'queries', 'errors')
+SERIALIZATION_METRICS = ('ns', 'bytes', 'objects')
+
+
+def server_memory(host, port):
+    "Returns the API server ``/__memory__`` status, ``None`` if it isn't available"
+
+    conn = httplib.HTTPConnection(host, port, timeout=60)
+    try:
+        conn.request('GET', '/__memory__?limit=0')
+        response = conn.getresponse()
+        body = response.read()
+        return json.loads(body) if response.status == 200 else None
+    except (httplib.HTTPException, IOError, ValueError):
+        return None
+    finally:
+        conn.close()
+
+
+def run_routes(args, settings):
+    """
+Loads the inventory (in a temporary database unless ``--dsn`` is given),
+runs the route scenarios and returns ``(summaries, server maxrss)``.
+"""
+
+    inv = inventory.Inventory(**settings['inventory'])
+    options = argparse.Namespace(
+        dsn=args.dsn, server=settings['server'], set=args.set, only=[], writes=False,
+        concurrency=settings['concurrency'], requests=settings['requests'], warmup=settings['warmup'],
+    )
+    tempdir = None
+    if options.dsn is None:
+        tempdir = tempfile.mkdtemp(prefix='clustoapi-gate-')
+        options.dsn = 'sqlite:///%s' % (os.path.join(tempdir, 'bench.db'),)
+    try:
+        routes.prepare(options.dsn, inv)
+        process, port = serve.spawn(options.dsn, adapter=options.server, settings=options.set)
+        try:
+            results = routes.drive('127.0.0.1', port, options, inv)
+            status = server_memory('127.0.0.1', port)
+        finally:
+            process.terminate()
+            process.wait()
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+    return results, status['maxrss'] if status else None
+
+
+def run_serialization(settings):
+    "Runs ``serialization.py`` in its own process and returns its results"
+
+    fd, output = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serialization.py')
+        subprocess.check_call([
+            sys.executable, script, '--attrs', settings['attrs'], '--min-time', str(settings['min_time']),
+            '--json', output,
+        ], stdout=open(os.devnull, 'w'))
+        with open(output) as f:
+            return json.load(f)['results']
+    finally:
+        os.unlink(output)
+
+
+def measure(args, settings):
+    "Runs every benchmark, returns ``{benchmark: {metric: value}}``"
+
+    result = {}
+    summaries, maxrss = run_routes(args, settings)
+    for summary in summaries:
+        name = 'route %s x%d' % (summary['scenario'], summary['concurrency'])
+        result[name] = dict((_, summary[_]) for _ in ROUTE_METRICS)
+    result['server'] = {'maxrss': maxrss}
+    if not args.skip_serialization:
+        for row in run_serialization(settings):
+            result['serialization %s' % (row['benchmark'],)] = dict((_, row[_]) for _ in SERIALIZATION_METRICS)
+    return result
+
+
+def compare(baseline, current, tolerances):
+    """
+Compares every metric of the baseline with the current one, returns the
+comparisons as a list of dictionaries, with ``regressed`` set for the ones
+past their tolerance or missing from the current results.
+"""
+
+    rows = []
+    for benchmark in sorted(baseline):
+        for metric, before in sorted(baseline[benchmark].items()):
+            if before is None:
+                continue
+            ratio, slack = tolerances[metric]
+            limit = before * ratio + slack
+            after = current.get(benchmark, {}).get(metric)
+            row = {
+                'benchmark': benchmark, 'metric': metric, 'baseline': before, 'current': after, 'limit': limit,
+                'change': '%+.0f%%' % ((after - before) * 100.0 / before,) if after is not None and before else None,
+            }
+            if after is None:
+                row['status'] = 'missing'
+            elif after > limit:
+                row['status'] = 'REGRESSED'
+            else:
+                row['status'] = 'ok'
+            row['regressed'] = row['status'] != 'ok'
+            rows.append(row)
+    return rows
+
+
+COLUMNS = (
+    ('benchmark', '%s'), ('metric', '%s'), ('baseline', '%.2f'), ('current', '%.2f'),
+    ('change', '%s'), ('limit', '%.2f'), ('status', '%s'),
+)
+
+
+def parse_tolerances(overrides):
+    "Applies ``metric=ratio`` overrides to the default tolerances"
+
+    tolerances = dict(TOLERANCES)
+    for override in overrides:
+        metric, _, ratio = override.partition('=')
+        if metric not in tolerances:
+            raise ValueError('Unknown metric %s, choose from %s' % (metric, ', '.join(sorted(tolerances))))
+        tolerances[metric] = (float(ratio), tolerances[metric][1])
+    return tolerances
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fails if the benchmarks regressed against a baseline')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file (default: %(default)s)')
+    parser.add_argument('--update', action='store_true', help='record the results as the new baseline')
+    parser.add_argument('--dsn', help='benchmark database, a temporary one by default')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='API server setting')
+    parser.add_argument('--tolerance', action='append', default=[], metavar='METRIC=RATIO', help='override a ratio')
+    parser.add_argument('--skip-serialization', action='store_true', help='only run the route scenarios')
+    parser.add_argument('--verbose', action='store_true', help='show every metric, not only the regressions')
+    args = parser.parse_args()
+
+    try:
+        tolerances = parse_tolerances(args.tolerance)
+    except ValueError as ve:
+        parser.error('%s' % (ve,))
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.update:
+        parser.error('%s does not exist, record it first with --update' % (args.baseline,))
+
+    settings = baseline['settings'] if baseline else SETTINGS
+    current = measure(args, settings)
+
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump({'settings': settings, 'results': current}, f, indent=4, sort_keys=True)
+            f.write(os.linesep)
+        sys.stderr.write('Recorded %d benchmarks in %s\n' % (len(current), args.baseline))
+        return 0
+
+    results = baseline['results']
+    if args.skip_serialization:
+        results = dict((k, v) for k, v in results.items() if not k.startswith('serialization '))
+    rows = compare(results, current, tolerances)
+    regressed = [_ for _ in rows if _['regressed']]
+    if args.verbose or regressed:
+        print(client.table(rows if args.verbose else regressed, COLUMNS))
+    print('%d of %d metrics regressed' % (len(regressed), len(rows)))
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
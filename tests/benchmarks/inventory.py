@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Synthetic inventory generator. Builds a realistic clusto database:
+
+ *  datacenters containing racks, racks containing servers at their RU
+ *  role pools, every server being a member of a few of them
+ *  servers named by a ``SimpleEntityNameManager``, with system attributes
+    of every datatype
+ *  one ``IPManager`` per datacenter, with one IP allocated per server
+
+Going through the clusto drivers flushes every attribute on its own, which
+takes hours for a million servers. Instead the rows the drivers would write
+(including the counters they keep for numbered attributes) are computed here
+and bulk inserted with SQLAlchemy core, in one transaction and in chunks, so
+memory stays flat no matter the size of the inventory. The result is the
+same database the drivers would have built, so it's meant for a fresh one.
+
+Usage::
+
+    python tests/benchmarks/inventory.py --servers 100000 --dsn sqlite:////tmp/bench.db
+"""
+
+import argparse
+import clusto
+from clusto.drivers.resourcemanagers.ipmanager import IPManager
+from clusto.schema import ATTR_TABLE, COUNTER_TABLE, ENTITY_TABLE, working_version
+import ConfigParser
+import datetime
+import IPy
+import itertools
+import random
+import sys
+import time
+
+
+CHUNK = 10000
+ROLES = ('web', 'db', 'cache', 'queue', 'search', 'batch', 'proxy', 'monitor')
+COLUMNS = {'int': 'int_value', 'string': 'string_value', 'datetime': 'datetime_value', 'relation': 'relation_id'}
+
+
+class Inventory(object):
+    """
+Describes an inventory. Everything is derived from the parameters and the
+``seed``, so the same ``Inventory`` can be used to generate the database and
+later to know what's in it (names, pools, etc.) without querying it.
+"""
+
+    def __init__(self, servers=10000, datacenters=2, servers_per_rack=40, pools=50,
+                 pools_per_server=3, attrs_per_server=8, seed=0):
+        self.servers = servers
+        self.datacenters = datacenters
+        self.servers_per_rack = servers_per_rack
+        self.pools = pools
+        self.pools_per_server = min(pools_per_server, pools)
+        self.attrs_per_server = attrs_per_server
+        self.seed = seed
+        self.digits = max(5, len(str(servers)))
+        per_dc = (servers + datacenters - 1) // datacenters
+        self.prefixlen = min(16, 32 - (per_dc + 2).bit_length())
+
+    @property
+    def datacenter_names(self):
+        return ['dc%02d' % (_ + 1,) for _ in range(self.datacenters)]
+
+    @property
+    def pool_names(self):
+        return ['%s%03d' % (ROLES[_ % len(ROLES)], _ + 1) for _ in range(self.pools)]
+
+    def server_name(self, index):
+        "Name of the ``index``-th server (0 based), as the name manager would give it"
+
+        return 's%s' % (str(index + 1).rjust(self.digits, '0'),)
+
+    def datacenter_of(self, index):
+        return index % self.datacenters
+
+    def rack_name(self, datacenter, rack):
+        return '%s-rack%04d' % (self.datacenter_names[datacenter], rack + 1)
+
+    def ipmanager_name(self, datacenter):
+        return '%s-ips' % (self.datacenter_names[datacenter],)
+
+    def network(self, datacenter):
+        "Returns the ``IPy.IP`` network managed by the IP manager of a datacenter"
+
+        size = 2 ** (32 - self.prefixlen)
+        return IPy.IP('%s/%d' % (IPy.IP(IPy.IP('10.0.0.0').int() + datacenter * size), self.prefixlen))
+
+    def pools_of(self, index):
+        "Indexes of the pools the ``index``-th server is a member of"
+
+        rng = random.Random(self.seed * 1000003 + index)
+        return sorted(rng.sample(range(self.pools), self.pools_per_server))
+
+    def attrs_of(self, index):
+        "``(key, subkey, datatype, value)`` for the attributes of a server"
+
+        rng = random.Random(self.seed * 7919 + index)
+        attrs = [
+            ('system', 'serial', 'string', 'SN%010d' % (rng.randint(0, 10 ** 10),)),
+            ('system', 'cpucount', 'int', rng.choice((8, 16, 32, 64))),
+            ('system', 'memory', 'int', rng.choice((32, 64, 128, 256)) * 1024),
+            ('system', 'purchased', 'datetime', datetime.datetime(2010, 1, 1) + datetime.timedelta(days=rng.randint(0, 3650))),
+            ('role', None, 'string', ROLES[index % len(ROLES)]),
+            ('environment', None, 'string', rng.choice(('production', 'staging', 'development'))),
+        ]
+        for extra in range(len(attrs), self.attrs_per_server):
+            attrs.append(('custom', 'key%02d' % (extra,), 'string', 'value%d' % (rng.randint(0, 100),)))
+        return attrs[:self.attrs_per_server]
+
+
+def _entity(entity_id, name, type, driver, version):
+    return {
+        'entity_id': entity_id, 'name': name, 'type': type, 'driver': driver,
+        'version': version, 'deleted_at_version': None,
+    }
+
+
+def _attr(entity_id, key, value, datatype, version, subkey=None, number=None):
+    row = {
+        'entity_id': entity_id, 'key': key, 'subkey': subkey, 'number': number,
+        'datatype': datatype, 'int_value': None, 'string_value': None,
+        'datetime_value': None, 'relation_id': None, 'version': version,
+        'deleted_at_version': None,
+    }
+    row[COLUMNS[datatype]] = value
+    return row
+
+
+def _property(entity_id, key, value, version):
+    datatype = 'int' if isinstance(value, int) else 'string'
+    return _attr(entity_id, key, value, datatype, version, subkey='property')
+
+
+def rows(inventory, first_id, version, meta_id):
+    """
+Yields ``(table, row)`` for every row of the inventory, entity ids start at
+``first_id``. Rows referencing an entity always come after it.
+"""
+
+    ids = itertools.count(first_id)
+    dc_ids = []
+    rack_ids = {}
+    ipm_ids = []
+    pool_ids = []
+    counters = {}
+
+    for name in inventory.datacenter_names:
+        dc_ids.append(next(ids))
+        yield ENTITY_TABLE, _entity(dc_ids[-1], name, 'datacenter', 'basicdatacenter', version)
+
+    for dc in range(inventory.datacenters):
+        ipm_ids.append(next(ids))
+        network = inventory.network(dc)
+        yield ENTITY_TABLE, _entity(ipm_ids[-1], inventory.ipmanager_name(dc), 'resourcemanager', 'ipmanager', version)
+        yield ATTR_TABLE, _property(ipm_ids[-1], 'baseip', str(network.net()), version)
+        yield ATTR_TABLE, _property(ipm_ids[-1], 'netmask', str(network.netmask()), version)
+
+    for name in inventory.pool_names:
+        pool_ids.append(next(ids))
+        yield ENTITY_TABLE, _entity(pool_ids[-1], name, 'pool', 'pool', version)
+
+    names_id = next(ids)
+    yield ENTITY_TABLE, _entity(names_id, 'servernames', 'resourcemanager', 'simpleentitynamemanager', version)
+    for key, value in (('digits', inventory.digits), ('basename', 's'), ('leadingZeros', 1), ('next', 1)):
+        yield ATTR_TABLE, _property(names_id, key, value, version)
+
+    ip_number = 0
+    last_ips = {}
+    for index in range(inventory.servers):
+        dc = inventory.datacenter_of(index)
+        position = index // inventory.datacenters
+        rack = position // inventory.servers_per_rack
+        if (dc, rack) not in rack_ids:
+            rack_id = rack_ids[(dc, rack)] = next(ids)
+            yield ENTITY_TABLE, _entity(rack_id, inventory.rack_name(dc, rack), 'rack', 'basicrack', version)
+            yield ATTR_TABLE, _property(rack_id, 'minu', 1, version)
+            yield ATTR_TABLE, _property(rack_id, 'maxu', 45, version)
+            number = counters[(dc_ids[dc], '_contains')] = counters.get((dc_ids[dc], '_contains'), -1) + 1
+            yield ATTR_TABLE, _attr(dc_ids[dc], '_contains', rack_id, 'relation', version, number=number)
+
+        server_id = next(ids)
+        yield ENTITY_TABLE, _entity(server_id, inventory.server_name(index), 'server', 'basicserver', version)
+        ru = position % inventory.servers_per_rack + 1
+        yield ATTR_TABLE, _attr(rack_ids[(dc, rack)], '_contains', server_id, 'relation', version, subkey='ru', number=ru)
+
+        for pool in inventory.pools_of(index):
+            key = (pool_ids[pool], '_contains')
+            number = counters[key] = counters.get(key, -1) + 1
+            yield ATTR_TABLE, _attr(pool_ids[pool], '_contains', server_id, 'relation', version, number=number)
+
+        for key, subkey, datatype, value in inventory.attrs_of(index):
+            yield ATTR_TABLE, _attr(server_id, key, value, datatype, version, subkey=subkey)
+
+        ip = IPy.IP(inventory.network(dc).int() + position + 1)
+        value = int(ip.int() - IPManager._int_ip_const)
+        last_ips[dc] = value
+        yield ATTR_TABLE, _attr(server_id, 'ip', value, 'int', version, number=ip_number)
+        yield ATTR_TABLE, _attr(server_id, 'ip', ipm_ids[dc], 'relation', version, subkey='manager', number=ip_number)
+        yield ATTR_TABLE, _attr(server_id, 'ip', str(ip), 'string', version, subkey='ipstring', number=ip_number)
+        yield ATTR_TABLE, _attr(
+            server_id, 'ip', '%s/%d' % (ip, inventory.prefixlen), 'string', version, subkey='cidr', number=ip_number
+        )
+        ip_number += 1
+
+    for dc, value in last_ips.items():
+        yield ATTR_TABLE, _attr(ipm_ids[dc], '_lastip', value, 'int', version)
+
+    counters[(meta_id, 'ip')] = ip_number
+    counters[(names_id, 'next')] = inventory.servers + 1
+    for (entity_id, key), value in sorted(counters.items()):
+        yield COUNTER_TABLE, {'entity_id': entity_id, 'attr_key': key, 'value': value}
+
+
+def load(inventory, chunk=CHUNK, progress=None):
+    """
+Bulk loads the inventory in the database clusto is connected to, in one
+transaction. ``progress`` is called with the number of rows written after
+every chunk. Returns the number of rows written.
+"""
+
+    engine = clusto.SESSION.get_bind(mapper=None)
+    conn = engine.connect()
+    existing = conn.execute(ENTITY_TABLE.select().where(ENTITY_TABLE.c.type != 'clustometa').limit(1)).first()
+    if existing is not None:
+        raise ValueError('The database already has entities, load the inventory in a fresh one')
+    version = conn.execute(working_version()).scalar()
+    meta_id = conn.execute(ENTITY_TABLE.select().where(ENTITY_TABLE.c.type == 'clustometa')).first()['entity_id']
+    first_id = meta_id + 1
+
+    if engine.dialect.name == 'sqlite':
+        conn.execute('PRAGMA synchronous = OFF')
+    written = 0
+    pending = dict((_, []) for _ in (ENTITY_TABLE, ATTR_TABLE, COUNTER_TABLE))
+    transaction = conn.begin()
+    try:
+        for table, row in rows(inventory, first_id, version, meta_id):
+            pending[table].append(row)
+            if len(pending[table]) >= chunk:
+                # Entities go first, the other tables reference them
+                for flushed in (ENTITY_TABLE, ATTR_TABLE, COUNTER_TABLE):
+                    if pending[flushed]:
+                        conn.execute(flushed.insert(), pending[flushed])
+                        written += len(pending[flushed])
+                        pending[flushed] = []
+                if progress:
+                    progress(written)
+        for table in (ENTITY_TABLE, ATTR_TABLE, COUNTER_TABLE):
+            if pending[table]:
+                conn.execute(table.insert(), pending[table])
+                written += len(pending[table])
+        transaction.commit()
+    except Exception:
+        transaction.rollback()
+        raise
+    finally:
+        conn.close()
+    return written
+
+
+def write_config(filename, dsn):
+    "Writes a clusto config file pointing to ``dsn``"
+
+    with open(filename, 'w') as f:
+        f.write('[clusto]\ndsn = %s\n' % (dsn,))
+    return filename
+
+
+def add_arguments(parser):
+    "Adds the inventory options to an ``argparse`` parser"
+
+    parser.add_argument('--servers', type=int, default=10000, help='number of servers (default: %(default)s)')
+    parser.add_argument('--datacenters', type=int, default=2, help='number of datacenters (default: %(default)s)')
+    parser.add_argument('--servers-per-rack', type=int, default=40, help='servers per rack (default: %(default)s)')
+    parser.add_argument('--pools', type=int, default=50, help='number of pools (default: %(default)s)')
+    parser.add_argument('--pools-per-server', type=int, default=3, help='pools per server (default: %(default)s)')
+    parser.add_argument('--attrs-per-server', type=int, default=8, help='attributes per server (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+
+
+def from_arguments(args):
+    return Inventory(
+        servers=args.servers, datacenters=args.datacenters, servers_per_rack=args.servers_per_rack,
+        pools=args.pools, pools_per_server=args.pools_per_server, attrs_per_server=args.attrs_per_server,
+        seed=args.seed,
+    )
+
+
+def connect(dsn):
+    "Connects clusto to ``dsn`` and creates the schema if needed"
+
+    config = ConfigParser.SafeConfigParser()
+    config.add_section('clusto')
+    config.set('clusto', 'dsn', dsn)
+    clusto.connect(config)
+    clusto.init_clusto()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic clusto inventory')
+    parser.add_argument('--dsn', required=True, help='database to load, e.g. sqlite:////tmp/bench.db')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    inventory = from_arguments(args)
+    connect(args.dsn)
+    start = time.time()
+
+    def progress(written):
+        sys.stderr.write('\r%d rows, %.1fs' % (written, time.time() - start))
+
+    written = load(inventory, progress=progress)
+    sys.stderr.write('\r%d rows written in %.1fs\n' % (written, time.time() - start))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
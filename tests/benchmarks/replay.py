@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Replays traffic captured with ``apiserver.capture_file`` against an API
+server. Every request is issued at its original offset from the first one,
+divided by ``--speed``, from its own thread, so requests that overlapped
+when captured overlap again and the concurrency profile is kept (scaled by
+the speed). At the end it reports, per route, the recorded and the replayed
+p50, p95 and p99 latency, the peak number of requests in flight both times
+and how many replayed requests got a different status.
+
+Write requests are replayed too unless ``--skip-writes`` is given, point it
+at a copy of the database.
+
+Usage::
+
+    python tests/benchmarks/replay.py capture.jsonl --url 127.0.0.1:9664 --speed 2 --json replay.json
+"""
+
+import argparse
+import client
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+import urllib
+
+
+WRITES = ('POST', 'PUT', 'DELETE')
+
+
+def load(path, skip_writes=False, limit=None):
+    "Reads the captured records, sorted by start time"
+
+    opener = gzip.open if path.endswith('.gz') else open
+    records = []
+    with opener(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if skip_writes and entry['m'] in WRITES:
+                continue
+            records.append(entry)
+    records.sort(key=lambda _: _['t'])
+    return records[:limit] if limit else records
+
+
+def build(entry):
+    "Returns ``(method, url, body, headers)`` to re-issue a captured request"
+
+    headers = dict((str(k), v.encode('utf-8')) for k, v in entry.get('h', {}).items())
+    url = entry['p'].encode('utf-8')
+    query = [(k.encode('utf-8'), v.encode('utf-8')) for k, v in entry.get('q', ())]
+    if query:
+        url += '?' + urllib.urlencode(query)
+    body = None
+    if 'b' in entry:
+        body = entry['b'].encode('utf-8')
+        headers['Content-Type'] = entry['c'].encode('utf-8')
+    elif 'f' in entry:
+        body = urllib.urlencode([(k.encode('utf-8'), v.encode('utf-8')) for k, v in entry['f']])
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    return entry['m'], url, body, headers
+
+
+def peak_in_flight(intervals):
+    "Most ``(start, end)`` intervals overlapping at any time"
+
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    current = peak = 0
+    for _, change in events:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+def replay(host, port, records, speed=1.0, max_in_flight=512):
+    """
+Re-issues ``records`` keeping their relative timing, divided by ``speed``.
+Returns ``(outcomes, lag)``, ``outcomes`` being ``(status, start, seconds)``
+per record and ``lag`` how late, at most, a request was issued.
+"""
+
+    outcomes = [None] * len(records)
+    slots = threading.Semaphore(max_in_flight)
+    threads = []
+    lag = 0.0
+
+    def issue(index, request):
+        try:
+            start = time.time()
+            status, seconds, _ = client.request(host, port, *request)
+            outcomes[index] = (status, start, seconds)
+        finally:
+            slots.release()
+
+    if not records:
+        return outcomes, lag
+    first = records[0]['t']
+    began = time.time()
+    for index, entry in enumerate(records):
+        due = began + (entry['t'] - first) / speed
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        slots.acquire()
+        lag = max(lag, time.time() - due)
+        thread = threading.Thread(target=issue, args=(index, build(entry)))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return outcomes, lag
+
+
+def report(records, outcomes):
+    "Summarizes the recorded and the replayed latency per route"
+
+    routes = {}
+    for entry, outcome in zip(records, outcomes):
+        routes.setdefault('%s %s' % (entry['m'], entry['r']), []).append((entry, outcome))
+
+    rows = []
+    for route, pairs in sorted(routes.items()):
+        recorded = sorted(entry['d'] for entry, _ in pairs)
+        replayed = sorted(outcome[2] * 1000 for _, outcome in pairs if outcome[0] is not None)
+        row = {
+            'route': route,
+            'requests': len(pairs),
+            'errors': sum(1 for _, outcome in pairs if outcome[0] is None or outcome[0] >= 500),
+            'changed': sum(1 for entry, outcome in pairs if outcome[0] != entry['s']),
+        }
+        for pct in (50, 95, 99):
+            before = client.percentile(recorded, pct)
+            after = client.percentile(replayed, pct)
+            row['recorded_p%d' % (pct,)] = before
+            row['replayed_p%d' % (pct,)] = round(after, 3) if after is not None else None
+            row['ratio_p%d' % (pct,)] = round(after / before, 2) if after is not None and before else None
+        rows.append(row)
+    return rows
+
+
+COLUMNS = (
+    ('route', '%s'), ('requests', '%d'), ('errors', '%d'), ('changed', '%d'),
+    ('recorded_p50', '%.2f'), ('replayed_p50', '%.2f'), ('ratio_p50', '%.2fx'),
+    ('recorded_p99', '%.2f'), ('replayed_p99', '%.2f'), ('ratio_p99', '%.2fx'),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays captured traffic against an API server')
+    parser.add_argument('capture', help='file written by apiserver.capture_file, optionally gzipped')
+    parser.add_argument('--url', default='127.0.0.1:9664', help='API server host:port (default: %(default)s)')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay this many times faster (default: %(default)s)')
+    parser.add_argument('--skip-writes', action='store_true', help='do not replay POST, PUT and DELETE requests')
+    parser.add_argument('--limit', type=int, help='replay only the first LIMIT requests')
+    parser.add_argument('--max-in-flight', type=int, default=512, help='cap on concurrent requests (default: %(default)s)')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    host, _, port = args.url.partition(':')
+    port = int(port or 80)
+    records = load(args.capture, args.skip_writes, args.limit)
+    if not records:
+        parser.error('%s has no requests to replay' % (args.capture,))
+
+    sys.stderr.write('Replaying %d requests spanning %.1fs at %gx\n' % (
+        len(records), records[-1]['t'] - records[0]['t'], args.speed,
+    ))
+    outcomes, lag = replay(host, port, records, args.speed, args.max_in_flight)
+    rows = report(records, outcomes)
+    recorded = peak_in_flight([(_['t'], _['t'] + _['d'] / 1000.0) for _ in records])
+    replayed = peak_in_flight([(start, start + seconds) for _, start, seconds in outcomes])
+
+    print(client.table(rows, COLUMNS))
+    print('')
+    print('Peak requests in flight: %d recorded, %d replayed' % (recorded, replayed))
+    print('Latest request was issued %.1f ms late' % (lag * 1000,))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'capture': args.capture, 'speed': args.speed, 'lag': round(lag * 1000, 3),
+                'in_flight': {'recorded': recorded, 'replayed': replayed}, 'routes': rows,
+            }, f, indent=4, sort_keys=True)
+            f.write(os.linesep)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+End to end benchmark. Generates an inventory (unless the database already
+has one), starts the API server against it and drives every route at every
+given concurrency, reporting per scenario:
+
+ *  throughput, in requests per second
+ *  p50, p95 and p99 latency, in milliseconds
+ *  SQL statements per request, from the ``Clusto-Query-Count`` header
+
+Write scenarios modify the database and are only run with ``--writes``.
+
+Usage::
+
+    python tests/benchmarks/routes.py --dsn sqlite:////tmp/bench.db --servers 10000 \\
+        --concurrency 1,8 --requests 200 --json results.json
+"""
+
+import argparse
+import client
+import clusto
+from clusto.schema import ENTITY_TABLE
+import inventory
+import json
+import os
+import serve
+import sys
+import time
+
+
+def scenarios(inv, writes=False, run_id=None):
+    "Returns the list of scenarios for the given inventory"
+
+    servers = inv.servers
+    pools = inv.pool_names
+    name = lambda i: inv.server_name(i % servers)
+    pool = lambda i: pools[i % len(pools)]
+    result = [
+        client.Scenario('version', '/__version__'),
+        client.Scenario('driverlist', '/driverlist'),
+        client.Scenario('typelist', '/typelist'),
+        client.Scenario('by-name', lambda i: '/by-name/%s' % (name(i * 7919),)),
+        client.Scenario('by-names', '/by-names', lambda i: [('name', name(i * 7919 + _)) for _ in range(10)]),
+        client.Scenario('by-attr', '/by-attr', lambda i: [
+            ('key', 'system'), ('subkey', 'serial'), ('value', inv.attrs_of(i * 7919 % servers)[0][3]),
+        ]),
+        client.Scenario('from-pools', '/from-pools', lambda i: [('pool', pool(i))]),
+        client.Scenario(
+            'from-pools-paged', '/from-pools', lambda i: [('pool', pool(i))], headers={'Clusto-Page': '1'}
+        ),
+        client.Scenario(
+            'from-pools-expanded', '/from-pools', lambda i: [('pool', pool(i))],
+            headers={'Clusto-Mode': 'expanded', 'Clusto-Page': '1'}
+        ),
+        client.Scenario('entity-list-pools', '/entity/pool'),
+        client.Scenario('entity-list-servers', '/entity/basicserver', headers={'Clusto-Page': '1'}),
+        client.Scenario('entity-show', lambda i: '/entity/basicserver/%s' % (name(i * 7919),)),
+        client.Scenario('entity-show-pool', lambda i: '/entity/pool/%s' % (pool(i),)),
+        client.Scenario('attribute-list', lambda i: '/attribute/%s' % (name(i * 7919),)),
+        client.Scenario('attribute-key', lambda i: '/attribute/%s/system' % (name(i * 7919),)),
+        client.Scenario('resourcemanager-list', '/resourcemanager/ipmanager'),
+        client.Scenario(
+            'resourcemanager-show', '/resourcemanager/simpleentitynamemanager/servernames',
+        ),
+    ]
+    if writes:
+        run_id = run_id or int(time.time())
+        result.extend([
+            client.Scenario(
+                'attribute-add', lambda i: '/attribute/%s' % (name(i * 7919),),
+                lambda i: [('key', 'benchmark'), ('subkey', 'run%d' % (run_id,)), ('value', str(i))], method='POST'
+            ),
+            client.Scenario(
+                'attribute-set', lambda i: '/attribute/%s/benchmark/set' % (name(i * 7919),),
+                lambda i: [('value', str(i))], method='PUT'
+            ),
+            client.Scenario(
+                'entity-create', '/entity/basicserver',
+                lambda i: [('name', 'bench%d-%06d' % (run_id, i))], method='POST'
+            ),
+            client.Scenario(
+                'entity-insert', lambda i: '/entity/pool/%s' % (pool(i),),
+                lambda i: [('action', 'insert'), ('device', name(i * 7919))], method='POST'
+            ),
+            client.Scenario(
+                'name-allocate', '/resourcemanager/simpleentitynamemanager/servernames',
+                [('driver', 'basicserver')], method='POST'
+            ),
+        ])
+    return result
+
+
+def prepare(dsn, inv):
+    "Loads the inventory unless the database already has one"
+
+    inventory.connect(dsn)
+    loaded = clusto.SESSION.execute(
+        ENTITY_TABLE.select().where(ENTITY_TABLE.c.name == 'servernames')
+    ).first()
+    if loaded is not None:
+        sys.stderr.write('Reusing the inventory already in %s\n' % (dsn,))
+        return
+    start = time.time()
+    written = inventory.load(inv)
+    sys.stderr.write('Loaded %d rows in %.1fs\n' % (written, time.time() - start))
+
+
+def add_arguments(parser):
+    "Adds the options shared by the scripts running the route scenarios"
+
+    parser.add_argument('--dsn', required=True, help='benchmark database, e.g. sqlite:////tmp/bench.db')
+    parser.add_argument('--server', default='threaded', help='server adapter (default: %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='API server setting')
+    parser.add_argument('--url', help='benchmark an API server already running at host:port instead')
+    parser.add_argument('--concurrency', default='1,8', help='comma separated client concurrency levels (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per scenario (default: %(default)s)')
+    parser.add_argument('--only', action='append', default=[], help='run only the given scenario (repeatable)')
+    parser.add_argument('--writes', action='store_true', help='also run the write scenarios')
+    inventory.add_arguments(parser)
+
+
+def drive(host, port, args, inv):
+    "Runs the selected scenarios at every concurrency against a running server"
+
+    selected = [_ for _ in scenarios(inv, args.writes) if not args.only or _.name in args.only]
+    levels = [int(_) for _ in args.concurrency.split(',')]
+    results = []
+    for scenario in selected:
+        for concurrency in levels:
+            summary = client.run(host, port, scenario, args.requests, concurrency, args.warmup).summary()
+            results.append(summary)
+            sys.stderr.write('%s x%d: %s req/s\n' % (scenario.name, concurrency, summary['throughput']))
+    return results
+
+
+def execute(args, inv):
+    "Runs the selected scenarios at every concurrency, returns their summaries"
+
+    process = None
+    if args.url:
+        host, _, port = args.url.partition(':')
+        port = int(port or 80)
+    else:
+        process, port = serve.spawn(args.dsn, adapter=args.server, settings=args.set)
+        host = '127.0.0.1'
+    try:
+        return drive(host, port, args, inv)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks every route of the API server')
+    add_arguments(parser)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    inv = inventory.from_arguments(args)
+    prepare(args.dsn, inv)
+    results = execute(args, inv)
+    print(client.table(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'inventory': vars(inv), 'server': args.server, 'results': results}, f, indent=4, sort_keys=True)
+            f.write(os.linesep)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
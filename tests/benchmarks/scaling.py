@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Server adapter scaling benchmark. Starts the API server under every
+available adapter (``wsgiref``, ``threaded``, ``prefork``, and ``gevent``,
+``eventlet``, ``paste``, ``cherrypy``, ``waitress`` or ``tornado`` when
+installed) and sweeps client concurrency over three kinds of requests:
+
+ *  cheap: ``/__version__``, no database at all
+ *  medium: ``/by-name``, one entity
+ *  heavy: ``/from-pools`` of a whole pool in ``expanded`` mode
+
+For every kind it charts the throughput and the p99 latency of every
+adapter at every concurrency, the full results can be written as JSON.
+
+Usage::
+
+    python tests/benchmarks/scaling.py --dsn sqlite:////tmp/bench.db --servers 2000 \\
+        --concurrency 1,4,16,64 --json scaling.json
+"""
+
+import argparse
+import client
+import inventory
+import json
+import os
+import routes
+import serve
+import sys
+
+
+KINDS = (
+    ('cheap', 'version'),
+    ('medium', 'by-name'),
+    ('heavy', 'from-pools-expanded'),
+)
+
+# Requests per concurrency level, heavy requests take a lot longer
+REQUESTS = {'cheap': 400, 'medium': 200, 'heavy': 20}
+
+# Adapter: module it needs
+CANDIDATES = (
+    ('wsgiref', None),
+    ('threaded', None),
+    ('prefork', None),
+    ('gevent', 'gevent'),
+    ('eventlet', 'eventlet'),
+    ('paste', 'paste'),
+    ('cherrypy', 'cherrypy'),
+    ('waitress', 'waitress'),
+    ('tornado', 'tornado'),
+)
+
+WIDTH = 40
+
+
+def available():
+    "Returns the adapters that can run here"
+
+    result = []
+    for adapter, module in CANDIDATES:
+        if module is not None:
+            try:
+                __import__(module)
+            except ImportError:
+                continue
+        result.append(adapter)
+    return result
+
+
+def parse_requests(values):
+    "Applies ``kind=N`` overrides to the default requests per level"
+
+    result = dict(REQUESTS)
+    for value in values:
+        kind, _, number = value.partition('=')
+        if kind not in result:
+            raise ValueError('Unknown kind %s, choose from %s' % (kind, ', '.join(sorted(result))))
+        result[kind] = int(number)
+    return result
+
+
+def sweep(args, inv, adapter, requests):
+    "Runs every kind at every concurrency under one adapter"
+
+    settings = list(args.set)
+    if adapter == 'prefork':
+        settings.append('server_kwargs=%s' % (json.dumps({'workers': args.workers}),))
+    selected = dict((_.name, _) for _ in routes.scenarios(inv))
+    levels = [int(_) for _ in args.concurrency.split(',')]
+    process, port = serve.spawn(args.dsn, adapter=adapter, settings=settings)
+    results = []
+    try:
+        for kind, name in KINDS:
+            for concurrency in levels:
+                summary = client.run(
+                    '127.0.0.1', port, selected[name], requests[kind], concurrency, max(args.warmup, concurrency)
+                ).summary()
+                summary.update(adapter=adapter, kind=kind)
+                results.append(summary)
+                sys.stderr.write('%s %s x%d: %s req/s, p99 %s ms\n' % (
+                    adapter, kind, concurrency, summary['throughput'], summary['p99'],
+                ))
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def chart(results, kind, metric, unit):
+    "Draws a horizontal bar per adapter and concurrency for one metric of one kind"
+
+    rows = [_ for _ in results if _['kind'] == kind and _[metric] is not None]
+    if not rows:
+        return '%s: no results' % (kind,)
+    top = max(_[metric] for _ in rows) or 1
+    label = max(len('%s x%d' % (_['adapter'], _['concurrency'])) for _ in rows)
+    lines = ['%s %s (%s)' % (kind, metric, unit)]
+    for row in rows:
+        name = '%s x%d' % (row['adapter'], row['concurrency'])
+        bar = '#' * max(1, int(round(row[metric] * WIDTH / top)))
+        errors = ', %d errors' % (row['errors'],) if row['errors'] else ''
+        lines.append('  %s  %s %.1f%s' % (name.ljust(label), bar.ljust(WIDTH), row[metric], errors))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the throughput and latency of server adapters')
+    parser.add_argument('--dsn', required=True, help='benchmark database, e.g. sqlite:////tmp/bench.db')
+    parser.add_argument('--adapters', help='comma separated adapters (default: every available one)')
+    parser.add_argument('--workers', type=int, default=4, help='prefork worker processes (default: %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='API server setting')
+    parser.add_argument(
+        '--concurrency', default='1,2,4,8,16,32', help='comma separated client concurrency levels (default: %(default)s)'
+    )
+    parser.add_argument('--requests', action='append', default=[], metavar='KIND=N', help='requests per level')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per level (default: %(default)s)')
+    parser.add_argument('--json', help='also write the results to this file')
+    inventory.add_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        requests = parse_requests(args.requests)
+    except ValueError as ve:
+        parser.error('%s' % (ve,))
+    adapters = args.adapters.split(',') if args.adapters else available()
+    skipped = [_ for _, _module in CANDIDATES if _ not in adapters]
+    if skipped and not args.adapters:
+        sys.stderr.write('Not installed, skipping: %s\n' % (', '.join(skipped),))
+
+    inv = inventory.from_arguments(args)
+    routes.prepare(args.dsn, inv)
+    results = []
+    for adapter in adapters:
+        results.extend(sweep(args, inv, adapter, requests))
+
+    columns = (('adapter', '%s'), ('kind', '%s')) + client.COLUMNS[1:]
+    print(client.table(results, columns))
+    for kind, _ in KINDS:
+        print('')
+        print(chart(results, kind, 'throughput', 'requests per second'))
+        print('')
+        print(chart(results, kind, 'p99', 'milliseconds'))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'inventory': vars(inv), 'workers': args.workers, 'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+            f.write(os.linesep)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
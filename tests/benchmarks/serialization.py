@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Microbenchmarks for the serialization pipeline, by itself:
+
+ *  ``util.unclusto`` on attributes of every datatype and on a driver
+ *  ``util.show`` in ``compact`` and ``expanded`` mode
+ *  ``util.dumps`` pretty printed and minified
+
+The entities are stand-ins: real clusto attributes, created in an in-memory
+database, behind an object that returns them (and the contents, parents and
+IPs) from memory, so no SQL is timed. Every benchmark reports the time per
+operation and what it allocates: the peak memory traced by ``tracemalloc``
+while running one operation when it's available, and the number of objects
+the garbage collector tracks that one operation leaves behind (its result,
+mostly) everywhere.
+
+Usage::
+
+    python tests/benchmarks/serialization.py --attrs 10,100,1000 --json serialization.json
+"""
+
+import argparse
+import bottle
+import clusto
+from clusto import drivers
+from clustoapi import util
+import datetime
+import gc
+import inventory
+import json
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class StandIn(object):
+    """
+Quacks like the driver ``util.show`` expects, with everything it asks for
+already in memory.
+"""
+
+    def __init__(self, obj):
+        self.name = obj.name
+        self.driver = obj.driver
+        self.type = obj.type
+        self._attrs = list(obj.attrs())
+        self._contents = list(obj.contents())
+        self._parents = list(obj.parents())
+        self._ips = obj.get_ips()
+        for attr in self._attrs:
+            # Loads relations, so later reads come from the identity map
+            attr.value
+
+    def attrs(self):
+        return self._attrs
+
+    def contents(self):
+        return self._contents
+
+    def parents(self):
+        return self._parents
+
+    def get_ips(self):
+        return self._ips
+
+
+def build(attrs):
+    """
+Creates a server with ``attrs`` attributes (the four of its IP included),
+cycling through every datatype, in two pools, and returns its stand-in.
+"""
+
+    name = 'standin%d' % (attrs,)
+    server = drivers.BasicServer(name)
+    pools = [drivers.Pool('%s-pool%d' % (name, _)) for _ in range(2)]
+    for pool in pools:
+        pool.insert(server)
+    ipm = clusto.get_or_create('standin-ips', drivers.IPManager, baseip='10.0.0.0', netmask='255.255.0.0')
+    ipm.allocate(server)
+    values = (
+        lambda i: i,
+        lambda i: 'value%d' % (i,),
+        lambda i: datetime.datetime(2015, 1, 1) + datetime.timedelta(days=i),
+        lambda i: pools[i % len(pools)],
+        lambda i: {'index': i, 'tags': ['a', 'b']},
+    )
+    for i in range(max(0, attrs - 4)):
+        server.add_attr('standin', values[i % len(values)](i), subkey='key%04d' % (i,))
+    return StandIn(server)
+
+
+def attribute(standin, datatype):
+    return [_ for _ in standin.attrs() if _.datatype == datatype][0]
+
+
+def bind(minify=False):
+    "Binds a request, so ``util.dumps`` can read its headers"
+
+    bottle.request.bind({'HTTP_CLUSTO_MINIFY': str(minify)})
+    bottle.response.bind()
+
+
+def timeit(func, min_time=0.2, repeat=5):
+    "Returns the best time per operation, in nanoseconds, of ``repeat`` runs"
+
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time / repeat:
+            break
+        number *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        best = min(best, time.time() - start)
+    return best / number * 1e9
+
+
+def traced_peak(func, number=20):
+    "Average peak memory, in bytes, traced by ``tracemalloc`` while running ``func``"
+
+    if tracemalloc is None:
+        return None
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(number):
+            tracemalloc.clear_traces()
+            func()
+            total += tracemalloc.get_traced_memory()[1]
+        return total / number
+    finally:
+        if started:
+            tracemalloc.stop()
+
+
+def tracked_objects(func, number=20):
+    "Objects tracked by the garbage collector each call leaves behind (its result)"
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        results = [func() for _ in range(number)]
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    del results
+    # The list holding the results is tracked too
+    return max(0, after - before - 1) / float(number)
+
+
+def benchmarks(sizes):
+    "Returns ``(name, function)`` for every benchmark"
+
+    standins = dict((size, build(size)) for size in sizes)
+    largest = standins[max(sizes)]
+    result = []
+    for datatype in ('int', 'string', 'datetime', 'relation', 'json'):
+        attr = attribute(largest, datatype)
+        result.append(('unclusto-%s' % (datatype,), lambda attr=attr: util.unclusto(attr)))
+    driver = attribute(largest, 'relation').value
+    result.append(('unclusto-driver', lambda: util.unclusto(driver)))
+
+    for size in sizes:
+        standin = standins[size]
+        for mode in ('compact', 'expanded'):
+            result.append(('show-%s-%d' % (mode, size), lambda standin=standin, mode=mode: util.show(standin, mode)))
+
+    for size in sizes:
+        expanded = util.show(standins[size], 'expanded')
+        listing = [util.show(standins[size], 'expanded')] * 50
+        for minify in (False, True):
+            suffix = 'minified' if minify else 'pretty'
+            result.append((
+                'dumps-%s-%d' % (suffix, size), lambda obj=expanded, minify=minify: (bind(minify), util.dumps(obj))
+            ))
+            result.append((
+                'dumps-%s-list50x%d' % (suffix, size), lambda obj=listing, minify=minify: (bind(minify), util.dumps(obj))
+            ))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks util.unclusto, util.show and util.dumps')
+    parser.add_argument('--attrs', default='10,100,1000', help='comma separated attribute counts (default: %(default)s)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds to run each benchmark for (default: %(default)s)')
+    parser.add_argument('--only', action='append', default=[], help='run only benchmarks starting with this (repeatable)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    inventory.connect('sqlite://')
+    bind()
+    sizes = [int(_) for _ in args.attrs.split(',')]
+    results = []
+    for name, func in benchmarks(sizes):
+        if args.only and not any(name.startswith(_) for _ in args.only):
+            continue
+        results.append({
+            'benchmark': name,
+            'ns': round(timeit(func, args.min_time), 1),
+            'bytes': traced_peak(func),
+            'objects': tracked_objects(func),
+        })
+        sys.stderr.write('%s: %.0f ns/op\n' % (name, results[-1]['ns']))
+
+    print('%-32s %14s %12s %10s' % ('benchmark', 'ns/op', 'bytes/op', 'objects/op'))
+    for row in results:
+        print('%-32s %14.0f %12s %10.1f' % (
+            row['benchmark'], row['ns'], '-' if row['bytes'] is None else '%d' % (row['bytes'],), row['objects'],
+        ))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'tracemalloc': tracemalloc is not None, 'results': results}, f, indent=4, sort_keys=True)
+            f.write(os.linesep)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Runs the API server, with every app mounted, against a benchmark database.
+Besides the bottle adapters (``--server wsgiref``, ``--server paste``, etc.)
+it provides:
+
+ *  ``threaded``, a ``wsgiref`` server handling every request in its own
+    thread, since plain ``wsgiref`` serves one request at a time
+ *  ``prefork``, ``workers`` (``4`` by default) forked ``wsgiref`` processes
+    accepting connections on the same socket, each serving one request at a
+    time, set with ``--set 'server_kwargs={"workers": 8}'``
+
+``gevent`` and ``eventlet`` monkey patch the standard library before the
+server starts, as they need.
+
+Extra API server settings can be passed as ``--set key=value``, the value is
+parsed as JSON when possible.
+
+Usage::
+
+    python tests/benchmarks/serve.py --dsn sqlite:////tmp/bench.db --port 9664 --server threaded
+"""
+
+import argparse
+import bottle
+import clusto
+from clustoapi import apps
+from clustoapi import server
+import json
+import os
+import signal
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import time
+from wsgiref import simple_server
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_request(*args, **kwargs):
+        pass
+
+
+class ThreadedServer(bottle.ServerAdapter):
+    "``wsgiref`` handling every request in its own thread"
+
+    def run(self, app):
+
+        class Server(SocketServer.ThreadingMixIn, simple_server.WSGIServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        srv = simple_server.make_server(self.host, self.port, app, Server, _QuietHandler)
+        srv.serve_forever()
+
+
+class PreforkServer(bottle.ServerAdapter):
+    "``workers`` forked ``wsgiref`` processes sharing the listening socket"
+
+    def run(self, app):
+        workers = int(self.options.get('workers', 4))
+
+        class Server(simple_server.WSGIServer):
+            request_queue_size = 128
+
+        srv = simple_server.make_server(self.host, self.port, app, Server, _QuietHandler)
+        children = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                # Connections opened before forking can't be shared
+                clusto.SESSION.get_bind(mapper=None).dispose()
+                try:
+                    srv.serve_forever()
+                finally:
+                    os._exit(0)
+            children.append(pid)
+
+        def stop(signum, frame):
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in children:
+                os.waitpid(pid, 0)
+            os._exit(0)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        while True:
+            signal.pause()
+
+
+ADAPTERS = {
+    'threaded': ThreadedServer,
+    'prefork': PreforkServer,
+}
+
+# Adapters that need the standard library monkey patched before serving
+PATCHES = {
+    'gevent': lambda: __import__('gevent.monkey').monkey.patch_all(),
+    'eventlet': lambda: __import__('eventlet').monkey_patch(),
+}
+
+
+def mount_apps():
+    return dict(('/%s' % (_,), 'clustoapi.apps.%s' % (_,)) for _ in apps.__all__)
+
+
+def parse_settings(settings):
+    "Parses ``key=value`` settings, values are JSON when possible"
+
+    result = {}
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        try:
+            result[key] = json.loads(value)
+        except ValueError:
+            result[key] = value
+    return result
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for(port, timeout=30.0):
+    "Waits until something listens on ``port``"
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def spawn(dsn, port=None, adapter='threaded', settings=()):
+    """
+Starts the API server in a separate process and waits for it to listen.
+Returns ``(process, port)``, stop it with ``process.terminate()``.
+"""
+
+    port = port or free_port()
+    command = [
+        sys.executable, os.path.abspath(__file__), '--dsn', dsn, '--port', str(port), '--server', adapter,
+    ]
+    for setting in settings:
+        command.extend(['--set', setting])
+    process = subprocess.Popen(command)
+    if not wait_for(port):
+        process.terminate()
+        raise RuntimeError('The API server did not start listening on port %d' % (port,))
+    return process, port
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the API server for benchmarks')
+    parser.add_argument('--dsn', required=True, help='database to serve, e.g. sqlite:////tmp/bench.db')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=9664, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--server', default='threaded', help='server adapter (default: %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='API server setting')
+    args = parser.parse_args()
+
+    if args.server in PATCHES:
+        PATCHES[args.server]()
+    config = {
+        'host': args.host,
+        'port': args.port,
+        'quiet': True,
+        'apps': mount_apps(),
+        'server': ADAPTERS.get(args.server, args.server),
+    }
+    config.update(parse_settings(args.set))
+
+    fd, configfile = tempfile.mkstemp(suffix='.conf')
+    os.write(fd, '[clusto]\ndsn = %s\n' % (args.dsn,))
+    os.close(fd)
+    try:
+        kwargs = server._configure(config=config, configfile=configfile)
+    finally:
+        os.unlink(configfile)
+    kwargs.update(kwargs.pop('server_kwargs'))
+    server.root_app.run(**kwargs)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
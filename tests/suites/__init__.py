@@ -7,7 +7,13 @@
 import python_docs
 import shell_docs
 import coding_style
+import versioning
+import bodies
+import resources
 
 assert python_docs
 assert shell_docs
 assert coding_style
+assert versioning
+assert bodies
+assert resources
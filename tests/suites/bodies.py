@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Sends the JSON endpoints bodies larger than bottle's default limit, which
+are too long to go in a shell doctest's command line.
+"""
+
+import json
+import sys
+import unittest
+import util
+
+
+class BodiesTest(util.ServerTestCase):
+
+    def test_bulk_attrs(self):
+        "Bulk attribute bodies over 100KB are accepted"
+
+        attrs = [{'key': 'bulk%d' % (i,), 'value': 'x'} for i in range(4000)]
+        data = json.dumps({'testserver1': attrs})
+        self.assertTrue(len(data) > 102400)
+        status, body = self.request('PUT', '/attribute/', data, 'application/json')
+        self.assertEqual(status, 200, body)
+        self.assertEqual(body['added'], 4000)
+        self.assertEqual(body['changed'], ['/basicserver/testserver1'])
+
+
+def test_cases():
+    return unittest.TestLoader().loadTestsFromTestCase(BodiesTest)
+
+
+def main():
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(test_cases())
+    return (len(result.errors) + len(result.failures)) > 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Changes resources with clusto itself, without going through the API, the way
+other clients of the same database do.
+"""
+
+import clusto
+import sys
+import unittest
+import urllib
+import util
+
+
+class ResourcesTest(util.ServerTestCase):
+
+    def free(self, name, refresh=False):
+        status, body = self.request('GET', '/resourcemanager/ipmanager/%s/free%s' % (name, '?refresh=true' if refresh else ''))
+        self.assertEqual(status, 200, body)
+        return body['free']
+
+    def test_free_outside(self):
+        "Addresses freed outside the API are seen once the index is refreshed"
+
+        data = urllib.urlencode([('name', 'outman'), ('netmask', '255.255.255.0'), ('baseip', '10.2.0.0')])
+        status, body = self.request('POST', '/resourcemanager/ipmanager', data)
+        self.assertEqual(status, 201, body)
+        data = urllib.urlencode([('object', 'testserver1'), ('count', '2')])
+        status, body = self.request('POST', '/resourcemanager/ipmanager/outman', data)
+        self.assertEqual(status, 201, body)
+        self.assertEqual(self.free('outman'), 252)
+
+        manager = clusto.get_by_name('outman')
+        manager.deallocate(clusto.get_by_name('testserver1'), '10.2.0.1')
+        clusto.commit()
+        self.assertEqual(self.free('outman'), 252)
+        self.assertEqual(self.free('outman', refresh=True), 253)
+        self.assertEqual(self.free('outman'), 253)
+
+
+def test_cases():
+    return unittest.TestLoader().loadTestsFromTestCase(ResourcesTest)
+
+
+def main():
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(test_cases())
+    return (len(result.errors) + len(result.failures)) > 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
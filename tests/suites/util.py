@@ -6,13 +6,17 @@
 
 import bottle
 import clusto
-import clustoapi
+import clustoapi.server
 from clustoapi import apps as api_apps
 import inspect
+import json
 import os
+import port_for
 import socket
 import threading
 import time
+import unittest
+import urllib2
 from wsgiref import simple_server
 
 
@@ -45,12 +49,13 @@ class TestingWSGIServer(bottle.ServerAdapter):
 
 class TestingServer(threading.Thread):
 
-    def __init__(self, port):
+    def __init__(self, port, versioning=False):
         self.port = port
+        self.versioning = versioning
         threading.Thread.__init__(self)
 
     def run(self):
-        conffile = config_for_testing()
+        conffile = config_for_testing(versioning=self.versioning)
         self.server = TestingWSGIServer()
         self.kwargs = clustoapi.server._configure(
             config={
@@ -105,10 +110,52 @@ class TestingServer(threading.Thread):
         self.server.stop()
 
 
-def config_for_testing():
+class ServerTestCase(unittest.TestCase):
+
+    """
+Runs a testing server on a random port for the tests of the class, with
+clusto's versioning turned on if ``versioning`` is set.
+    """
+
+    versioning = False
+    port = None
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.port = port_for.select_random()
+        cls.server = TestingServer(cls.port, versioning=cls.versioning)
+        cls.server.start()
+        count = 0
+        while not ping(cls.port) and count < 50:
+            count += 1
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        count = 0
+        while ping(cls.port) and count < 50:
+            count += 1
+
+    def request(self, method, path, data=None, content_type=None):
+        "Returns the status and the decoded JSON body of the response"
+
+        req = urllib2.Request('http://127.0.0.1:%s%s' % (self.port, path,), data=data)
+        req.get_method = lambda: method
+        if content_type:
+            req.add_header('Content-Type', content_type)
+        try:
+            response = urllib2.urlopen(req)
+        except urllib2.HTTPError as response:
+            pass
+        return response.code, json.loads(response.read())
+
+
+def config_for_testing(versioning=False):
     """
 Write a clusto config file for testing purposes, also unlink any sqlite
-databases around in preparation to run a new test suite.
+databases around in preparation to run a new test suite. Turns clusto's
+versioning on if ``versioning`` is true.
     """
 
     conf_file = os.path.join(TEST_DIR, 'clustotest.conf')
@@ -116,7 +163,10 @@ databases around in preparation to run a new test suite.
     if os.path.isfile(sqlite_file):
         os.unlink(sqlite_file)
     f = open(conf_file, 'wb')
-    f.writelines(['[clusto]\n', 'dsn = sqlite:///%s' % (sqlite_file,)])
+    lines = ['[clusto]\n', 'dsn = sqlite:///%s\n' % (sqlite_file,)]
+    if versioning:
+        lines.append('versioning = true\n')
+    f.writelines(lines)
     f.close()
     return conf_file
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# -*- mode:python; sh-basic-offset:4; indent-tabs-mode:nil; coding:utf-8 -*-
+# vim:set tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8:
+#
+
+"""
+Runs the endpoints that write outside of the clusto ORM against a server
+with clusto's versioning turned on, where deleting means soft-deleting.
+"""
+
+import sys
+import unittest
+import urllib
+import util
+
+
+class VersioningTest(util.ServerTestCase):
+
+    versioning = True
+
+    def members(self, name):
+        status, body = self.request('GET', '/entity/pool/%s' % (name,))
+        self.assertEqual(status, 200)
+        return body['contents']
+
+    def test_remove(self):
+        "Removing members soft-deletes them"
+
+        data = urllib.urlencode([('device', 'testserver1'), ('device', 'testserver2'), ('action', 'insert')])
+        status, body = self.request('POST', '/entity/pool/emptypool', data)
+        self.assertEqual(status, 200, body)
+        self.assertEqual(len(self.members('emptypool')), 2)
+
+        data = urllib.urlencode([('device', 'testserver2'), ('action', 'remove')])
+        status, body = self.request('POST', '/entity/pool/emptypool', data)
+        self.assertEqual(status, 200, body)
+        self.assertEqual(self.members('emptypool'), ['/basicserver/testserver1'])
+
+    def test_reconcile(self):
+        "Reconciling soft-deletes the members that are not given"
+
+        status, body = self.request('PUT', '/entity/pool/multipool', '["testserver1"]', 'application/json')
+        self.assertEqual(status, 200, body)
+        self.assertEqual(body['removed'], ['/basicserver/testserver2'])
+        self.assertEqual(self.members('multipool'), ['/basicserver/testserver1'])
+
+        status, body = self.request('PUT', '/entity/', '{"multipool": [], "singlepool": []}', 'application/json')
+        self.assertEqual(status, 200, body)
+        self.assertEqual([_['removed'] for _ in body], [['/basicserver/testserver1']] * 2)
+        self.assertEqual(self.members('multipool'), [])
+        self.assertEqual(self.members('singlepool'), [])
+
+        status, body = self.request('PUT', '/entity/', '{"multipool": [1]}', 'application/json')
+        self.assertEqual(status, 400, body)
+
+
+def test_cases():
+    return unittest.TestLoader().loadTestsFromTestCase(VersioningTest)
+
+
+def main():
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(test_cases())
+    return (len(result.errors) + len(result.failures)) > 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())